@@ -0,0 +1,473 @@
+# The ASGI entry point, run with
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+# (the Dockerfile does this when SERVER_MODE=asgi).
+#
+# The read only /api/* routes the pages call the most are served natively here with
+# async psycopg, so a slow query only holds up its own request instead of a whole worker.
+# Everything else falls through to the Flask app in main.py, which runs in a thread pool
+# like it would under gunicorn's sync workers.
+
+import asyncio, binascii, contextlib, functools, warnings
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route, Mount
+from werkzeug.http import parse_etags, quote_etag
+from itsdangerous import BadSignature
+import config, logs, database, cache, encoder, queries, search, pagination, metrics
+import main
+
+# Starlette wants people to move to a2wsgi, but this does everything we need
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+JSON_MIMETYPE = 'application/json'
+
+# Flask's session cookie is signed with SECRET_KEY, this lets us read it without Flask
+session_serializer = main.app.session_interface.get_signing_serializer(main.app)
+
+def json_response(obj) -> Response:
+    return Response(encoder.dumps(obj), media_type=JSON_MIMETYPE)
+
+# Runs one query on its own pooled connection. Each call gets a different connection,
+# so independent queries can be run at the same time with asyncio.gather()
+async def fetchone(query: queries.PreparedQuery, params: tuple | dict) -> tuple | None:
+    async with database.get_async_database_connection() as con:
+        res = await query.execute_async(con.cursor(), params)
+        return await res.fetchone()
+
+async def fetchall(query: queries.PreparedQuery, params: tuple | dict) -> list[tuple]:
+    async with database.get_async_database_connection() as con:
+        res = await query.execute_async(con.cursor(), params)
+        return await res.fetchall()
+
+# For SQL that's built per request and can't be in the queries registry
+async def fetchall_sql(sql: str, params: list) -> list[tuple]:
+    async with database.get_async_database_connection() as con:
+        res = await con.execute(sql, params)
+        return await res.fetchall()
+
+# The same as main.catalog_response()
+def catalog_response(view):
+    @functools.wraps(view)
+    async def wrapper(request: Request):
+        generation = await cache.check_catalog_generation_async()
+        etag = main.catalog_etag(generation, request.method, request.url.path, request.query_params.multi_items(), await request.body())
+
+        if parse_etags(request.headers.get('If-None-Match')).contains_weak(etag):
+            response = Response(status_code=304)
+        else:
+            response = await view(request)
+
+        response.headers['ETag'] = quote_etag(etag)
+        response.headers['Cache-Control'] = f"public, max-age={config.get('CATALOG_MAX_AGE')}"
+        return response
+
+    return wrapper
+
+# Returns the user ID flask_login put in the session, or None if there isn't a valid session
+def get_session_user_id(request: Request):
+    cookie = request.cookies.get(main.app.config['SESSION_COOKIE_NAME'])
+    if cookie == None:
+        return None
+
+    try:
+        session = session_serializer.loads(cookie, max_age=int(main.app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+
+    return session.get('_user_id')
+
+async def get_user_id_from_token(token: str) -> tuple[int, None] | tuple[None, dict]:
+    hashed_token_bytes = main.hash_token(binascii.unhexlify(token))
+
+    await cache.check_token_generation_async()
+    row = main.api_token_cache.get(hashed_token_bytes)
+    if row == None:
+        row = await fetchone(main.API_TOKEN_QUERY, (hashed_token_bytes, ))
+        if row == None:
+            error = {'successful': False, 'error': "Token is invalid"}
+            return None, error
+
+        main.api_token_cache.put(hashed_token_bytes, row)
+
+    return main.check_token_row(row)
+
+# The same as main.get_user_id()
+async def get_user_id(request: Request) -> tuple[int, None] | tuple[None, dict]:
+    auth_header = request.headers.get('Authorization')
+    if auth_header:
+        token, error = main.parse_authorization_header(auth_header)
+        if error:
+            return None, error
+
+        return await get_user_id_from_token(token)
+
+    user_id = get_session_user_id(request)
+    if user_id == None:
+        error = {'successful': False, 'error': f"No Authorization header or session"}
+        return None, error
+
+    return user_id, None
+
+# Checks the request is allowed to see username's collection.
+# The auth lookup and the username lookup don't depend on each other so they run at the same time.
+# Returns the collection owner's ID or an error
+async def authorize_collection(request: Request, username: str) -> tuple[int, None] | tuple[None, dict]:
+    (authed_user_id, error), user_row = await asyncio.gather(
+        get_user_id(request),
+        fetchone(main.USER_ID_BY_USERNAME_QUERY, (username, ))
+    )
+    if error:
+        return None, error
+
+    if user_row == None:
+        return None, {'successful': False, 'error': f"Couldn't find user with username {username}"}
+
+    user_id = user_row[0]
+    if authed_user_id != user_id:
+        error = {'successful': False, 'error': "You are not authorized to access this collection."}
+        return None, error
+
+    return user_id, None
+
+async def get_cards(scryfall_ids: list[str]) -> tuple[list[main.Card], list[str]]:
+    parsed_ids, cards_by_id, uncached_ids = main.get_cached_cards(scryfall_ids)
+    if len(uncached_ids) > 0:
+        rows = await fetchall(main.CARDS_QUERY, (uncached_ids,))
+        main.cache_card_rows(rows, cards_by_id)
+
+    return main.order_cards(scryfall_ids, parsed_ids, cards_by_id)
+
+@catalog_response
+async def api_all_cards_languages(request: Request):
+    scryfall_id = request.query_params.get('scryfall_id')
+
+    if not scryfall_id:
+        error = {'successful': False, 'error': 'Expected query param "scryfall_id"'}
+        return json_response(error)
+
+    languages = main.languages_cache.get(scryfall_id)
+    if languages != None:
+        return json_response(languages)
+
+    rows = await fetchall(main.LANGUAGES_QUERY, (scryfall_id,))
+    if len(rows) == 0:
+        error = {'successful': False, 'error': f"Couldn't find a card with scryfall_id \"{scryfall_id}\""}
+        return json_response(error)
+
+    languages = main.language_dicts(rows)
+    main.languages_cache.put(scryfall_id, languages)
+    return json_response(languages)
+
+@catalog_response
+async def api_by_id(request: Request):
+    scryfall_id = request.query_params.get('scryfall_id')
+
+    if scryfall_id == None:
+        error = {'successful': False, 'error': 'Expected query param "scryfall_id"'}
+        return json_response(error)
+
+    cards, not_found = await get_cards([scryfall_id])
+    if len(not_found) > 0:
+        return json_response({'successful': False, 'error': f"Couldn't find card with ID \"{scryfall_id}\""})
+
+    return json_response(cards[0].get_dict())
+
+# Reads {"scryfall_ids": [...]} from the body of the POST /api/all_cards/.../many routes.
+# Returns (scryfall_ids, None) or (None, error)
+async def get_scryfall_ids(request: Request) -> tuple[list, None] | tuple[None, dict]:
+    content_type = request.headers.get('Content-Type')
+    if (content_type != 'application/json'):
+        return None, {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
+
+    try:
+        request_json = await request.json()
+    except ValueError:
+        request_json = None
+
+    if type(request_json) != dict:
+        return None, {'successful': False, 'error': "Expected json body, but didn't find one"}
+
+    scryfall_ids = request_json.get('scryfall_ids')
+
+    if scryfall_ids == None:
+        return None, {'successful': False, 'error': "Couldn't find expected key \"scryfall_ids\""}
+
+    if type(scryfall_ids) != list:
+        return None, {'successful': False, 'error': f"Expected key \"scryfall_ids\" to be of type list, got {str(type(scryfall_ids).__name__)}"}
+
+    return scryfall_ids, None
+
+@catalog_response
+async def api_all_cards_languages_many(request: Request):
+
+    scryfall_ids, error = await get_scryfall_ids(request)
+    if error:
+        return json_response(error)
+
+    languages_by_id, uncached_ids = main.get_cached_languages(scryfall_ids)
+
+    if len(uncached_ids) > 0:
+        rows = await fetchall(main.LANGUAGES_MANY_QUERY, (uncached_ids,))
+        main.cache_language_rows(rows, languages_by_id)
+
+    return json_response(main.languages_many_response(scryfall_ids, languages_by_id))
+
+@catalog_response
+async def api_all_card_many(request: Request):
+
+    scryfall_ids, error = await get_scryfall_ids(request)
+    if error:
+        return json_response(error)
+
+    cards, not_found = await get_cards(scryfall_ids)
+
+    return_obj = {
+        'data': [card.get_dict() for card in cards],
+        'not_found': not_found
+    }
+
+    return json_response(return_obj)
+
+@catalog_response
+async def api_all_cards(request: Request):
+    args = request.query_params
+    page = int(args.get('page') or 0)
+    cursor = args.get('cursor')
+    default = args.get('default') == 'true'
+    query = args.get('query')
+
+    if cursor != None and query not in (None, 'search'):
+        error = {'successful': False, 'error': 'cursor only works with query=search'}
+        return json_response(error)
+
+    if query in ('search', 'scryfall', 'fulltext'):
+        search_text, error = main.get_search_text(args, query)
+        if error:
+            return json_response(error)
+    else:
+        search_text = ''
+
+    if query == 'fulltext':
+        search_query, count_query = main.FULL_TEXT_SEARCH_QUERIES[default]
+        params = {'text': search_text, 'limit': main.PAGE_SIZE, 'offset': page * main.PAGE_SIZE}
+
+        card_results = await fetchall(search_query, params)
+
+        if len(card_results) > 0:
+            length = card_results[0][1]
+        elif page > 0:
+            length = (await fetchone(count_query, params))[0]
+        else:
+            length = 0
+    elif query == 'scryfall':
+        try:
+            search_query, count_query, params = main.scryfall_search_queries(search_text, default)
+        except search.QuerySyntaxError as e:
+            return json_response({'successful': False, 'error': str(e)})
+
+        card_results = await fetchall_sql(search_query, params + [main.PAGE_SIZE, page * main.PAGE_SIZE])
+
+        if len(card_results) > 0:
+            length = card_results[0][1]
+        elif page > 0:
+            length = (await fetchall_sql(count_query, params))[0][0]
+        else:
+            length = 0
+    elif query and query != 'search':
+        error = {'successful': False, 'error': f'Unsupported value for query parameter "query". Expected "search", "scryfall" or "fulltext". Got {query}'}
+        return json_response(error)
+    else:
+        try:
+            search_query, count_query, params = main.all_cards_search_queries(search_text, default, page, cursor)
+        except pagination.InvalidCursorError as e:
+            return json_response({'successful': False, 'error': str(e)})
+
+        card_results = await fetchall(search_query, params)
+
+        if cursor != None:
+            card_results, next_cursor = pagination.split_page(card_results, main.PAGE_SIZE, main.all_cards_cursor)
+            cards = [{'scryfall_id': card[0]} for card in card_results]
+            return json_response({'cards': cards, 'next_cursor': next_cursor})
+
+        if len(card_results) > 0:
+            length = card_results[0][3]
+        elif page > 0:
+            length = (await fetchone(count_query, params))[0]
+        else:
+            length = 0
+
+        cards = [{'scryfall_id': card[0]} for card in card_results]
+        next_cursor = main.page_next_cursor(card_results, page, length, main.all_cards_cursor)
+        return json_response({'cards': cards, 'length': length, 'next_cursor': next_cursor})
+
+    cards = [{'scryfall_id': card[0]} for card in card_results]
+    return json_response({'cards': cards, 'length': length})
+
+async def api_collection_by_id(request: Request):
+    args = request.query_params
+    collection_id = args.get('collection_id')
+    username = args.get('username')
+
+    if username == None:
+        error = {'successful': False, 'error': "Didn't find expected query parameter \"username\""}
+        return json_response(error)
+    if collection_id == None:
+        error = {'successful': False, 'error': "Didn't find expected query parameter \"collection_id\""}
+        return json_response(error)
+
+    user_id, error = await authorize_collection(request, username)
+    if error:
+        return json_response(error)
+
+    res = await fetchone(main.COLLECTION_CARD_QUERY, (collection_id, user_id))
+    if res == None:
+        error = {'successful': False, 'error': "Couldn't find card in your collection with that ID, data might be old. Try refreshing"}
+        return json_response(error)
+
+    finish, condition, signed, altered, notes, quantity = res
+    card = {
+        'finish': finish,
+        'condition': condition,
+        'signed': signed,
+        'altered': altered,
+        'notes': notes,
+        'quantity': quantity
+    }
+
+    return json_response({'successful': True, 'card': card})
+
+# The same as main.api_collection_stream()
+def api_collection_stream(search_text: str, user_id) -> StreamingResponse:
+    async def generate():
+        async with database.get_async_database_connection() as con:
+            cur = con.cursor(name='collection_stream')
+            cur.itersize = 1000
+            await cur.execute(main.COLLECTION_STREAM_QUERY, (user_id, search_text))
+
+            async for chunk in encoder.stream_array_async(main.collection_card_dict(row) async for row in cur):
+                yield chunk
+
+    return StreamingResponse(generate(), media_type=JSON_MIMETYPE)
+
+# GET /api/collection. POST and PATCH still go to Flask
+async def api_collection(request: Request):
+    args = request.query_params
+    username = args.get('username')
+    query = args.get('query')
+
+    if username == None:
+        error = {'successful': False, 'error': "Didn't find expected query parameter \"username\""}
+        return json_response(error)
+
+    user_id, error = await authorize_collection(request, username)
+    if error:
+        return json_response(error)
+
+    if query and query not in ('search', 'fulltext'):
+        error = {'successful': False, 'error': f'Unsupported value for query parameter "query". Expected "search" or "fulltext". Got {query}'}
+        return json_response(error)
+
+    page = int(args.get('page') or 0)
+    cursor = args.get('cursor')
+    if query:
+        search_text, error = main.get_search_text(args, query)
+        if error:
+            return json_response(error)
+    else:
+        search_text = ''
+
+    # stream=true returns every matching card as one JSON array instead of a page
+    stream = args.get('stream') == 'true'
+
+    if query == 'fulltext':
+        if stream:
+            error = {'successful': False, 'error': 'stream=true only works with query=search'}
+            return json_response(error)
+        if cursor != None:
+            error = {'successful': False, 'error': 'cursor only works with query=search'}
+            return json_response(error)
+
+        params = {'text': search_text, 'user_id': user_id, 'limit': main.PAGE_SIZE, 'offset': page * main.PAGE_SIZE}
+        results = await fetchall(main.COLLECTION_FULL_TEXT_QUERY, params)
+        cards = [main.collection_card_dict(row) for row in results]
+
+        if len(results) > 0:
+            length = results[0][9]
+        elif page > 0:
+            length = (await fetchone(main.COLLECTION_FULL_TEXT_COUNT_QUERY, params))[0]
+        else:
+            length = 0
+
+        return json_response({'successful': True, 'cards': cards, 'length': length})
+    elif stream:
+        return api_collection_stream(search_text, user_id)
+
+    try:
+        search_query, params = main.collection_search_query(search_text, page, cursor, user_id)
+    except pagination.InvalidCursorError as e:
+        return json_response({'successful': False, 'error': str(e)})
+
+    results = await fetchall(search_query, params)
+
+    if cursor != None:
+        results, next_cursor = pagination.split_page(results, main.PAGE_SIZE, main.collection_cursor)
+        cards = [main.collection_card_dict(row) for row in results]
+        return json_response({'successful': True, 'cards': cards, 'next_cursor': next_cursor})
+
+    cards = [main.collection_card_dict(row) for row in results]
+
+    if len(results) > 0:
+        length = results[0][11]
+    elif page > 0:
+        length = (await fetchone(main.COLLECTION_COUNT_QUERY, params))[0]
+    else:
+        length = 0
+
+    next_cursor = main.page_next_cursor(results, page, length, main.collection_cursor)
+    return json_response({'successful': True, 'cards': cards, 'length': length, 'next_cursor': next_cursor})
+
+# A Route whose requests are timed for /metrics and the access log like main.py does for Flask's.
+# Streamed responses are timed until they start, not until the last row is sent
+def timed_route(path: str, endpoint, methods: list[str]) -> Route:
+    @functools.wraps(endpoint)
+    async def wrapper(request: Request):
+        request_id = logs.start_request(request.headers.get('X-Request-ID'))
+        timer = metrics.RequestTimer(request.method, path)
+        status = 500
+        try:
+            response = await endpoint(request)
+            response.headers['X-Request-ID'] = request_id
+            status = response.status_code
+            return response
+        finally:
+            duration = timer.finish(status)
+            database.record_pool_metrics()
+            logs.log_access(request.method, request.url.path, path, status, duration, timer.db.seconds, timer.db.queries,
+                            request.client.host if request.client else None)
+
+    return Route(path, wrapper, methods=methods)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await database.open_async_pool()
+    yield
+    await database.close_async_pool()
+
+# Routes that only match some methods fall through to Flask for the others,
+# Starlette only answers 405 when nothing else matches the path
+app = Starlette(
+    routes=[
+        timed_route('/api/all_cards/languages', api_all_cards_languages, methods=['GET']),
+        timed_route('/api/all_cards/languages/many', api_all_cards_languages_many, methods=['POST']),
+        timed_route('/api/by_id', api_by_id, methods=['GET']),
+        timed_route('/api/all_cards/many', api_all_card_many, methods=['POST']),
+        timed_route('/api/all_cards', api_all_cards, methods=['GET']),
+        timed_route('/api/collection/by_id', api_collection_by_id, methods=['GET']),
+        timed_route('/api/collection', api_collection, methods=['GET']),
+        Mount('', app=WSGIMiddleware(main.app))
+    ],
+    lifespan=lifespan
+)
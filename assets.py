@@ -0,0 +1,99 @@
+import os, re, gzip, hashlib, mimetypes, logging
+
+# Brotli is optional, without it we only serve gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only bother compressing files that are actually worth it
+MIN_COMPRESS_SIZE = 256
+
+# Matches relative ES module imports like
+#   import {add_page} from './paged_cards.js'
+# so we can point them at the fingerprinted file
+JS_IMPORT_RE = re.compile(r'''(\bfrom\s*|\bimport\s*)(['"])(\.{1,2}/[^'"]+)\2''')
+
+class Asset:
+    def __init__(self, path: str, fingerprinted_path: str, content: bytes):
+        self.path = path
+        self.fingerprinted_path = fingerprinted_path
+        self.content = content
+        self.etag = hashlib.sha256(content).hexdigest()
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        # Maps Content-Encoding -> body
+        self.encodings = {}
+        if len(content) >= MIN_COMPRESS_SIZE:
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gzipped) < len(content):
+                self.encodings['gzip'] = gzipped
+
+            if brotli != None:
+                brotlied = brotli.compress(content, quality=11)
+                if len(brotlied) < len(content):
+                    self.encodings['br'] = brotlied
+
+# Fingerprints everything under static_folder by content hash when it's created.
+# collection.js is served as both js/collection.js and js/collection.<hash>.js,
+# the second one never changes so it can be cached forever.
+class AssetManifest:
+    def __init__(self, static_folder: str):
+        self.static_folder = static_folder
+        # Both the original and fingerprinted paths map to the asset
+        self.assets = {}
+        # Original path -> Asset, used while building so imports are fingerprinted first
+        self._built = {}
+
+        for root, _, files in os.walk(static_folder):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+                self._build(path, [])
+
+        logging.info(f"Fingerprinted {len(self._built)} static assets (brotli {'enabled' if brotli != None else 'unavailable'})")
+
+    def _build(self, path: str, importing: list[str]) -> Asset:
+        asset = self._built.get(path)
+        if asset != None:
+            return asset
+
+        with open(os.path.join(self.static_folder, path), 'rb') as f:
+            content = f.read()
+
+        # Fingerprint the modules this one imports first, and point the imports at them.
+        # That way changing paged_cards.js also changes the hash of collection.js
+        if path.endswith('.js'):
+            def replace_import(match):
+                prefix, quote, import_path = match.groups()
+                target = os.path.normpath(os.path.join(os.path.dirname(path), import_path)).replace(os.sep, '/')
+                # Circular imports and files we don't have are left alone
+                if target in importing or not os.path.isfile(os.path.join(self.static_folder, target)):
+                    return match.group(0)
+
+                imported = self._build(target, importing + [path])
+                fingerprinted_import = import_path[:-len(os.path.basename(import_path))] + os.path.basename(imported.fingerprinted_path)
+                return f"{prefix}{quote}{fingerprinted_import}{quote}"
+
+            content = JS_IMPORT_RE.sub(replace_import, content.decode()).encode()
+
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        base, extension = os.path.splitext(path)
+        asset = Asset(path, f"{base}.{digest}{extension}", content)
+
+        self._built[path] = asset
+        self.assets[path] = asset
+        self.assets[asset.fingerprinted_path] = asset
+        return asset
+
+    def get(self, path: str) -> Asset | None:
+        return self.assets.get(path)
+
+    # The URL templates should use for a file in static/
+    def url(self, path: str) -> str:
+        asset = self._built.get(path)
+        if asset == None:
+            # Still give a working link, just without the long lived caching
+            logging.warning(f"No static asset {path}")
+            return f"/static/{path}"
+
+        return f"/static/{asset.fingerprinted_path}"
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# Benchmarks that run against the database configured in config.py
+# They build their own synthetic data in a separate "benchmark" schema
+# so they never touch the real tables.
+# The serving and logins benchmarks are the exception, they send requests to servers that are already running.
+#
+# Usage: python benchmark.py <benchmark name> [options]
+
+import psycopg, argparse, random, statistics, timeit, config, requests, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE = 25
+
+def get_database_connection():
+    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'))
+    return con
+
+def percentiles(timings: list[float]) -> tuple[float, float]:
+    cuts = statistics.quantiles(timings, n=100)
+    return cuts[49], cuts[98]
+
+def report(label: str, timings: list[float]):
+    p50, p99 = percentiles(timings)
+    print(f"{label:<30} p50 {p50 * 1000:8.2f}ms  p99 {p99 * 1000:8.2f}ms  ({len(timings)} runs)")
+
+def create_synthetic_catalog(cur: psycopg.Cursor, num_cards: int):
+    # The extension has to exist before we switch search_path so gin_trgm_ops resolves
+    cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    cur.execute('DROP SCHEMA IF EXISTS benchmark CASCADE')
+    cur.execute('CREATE SCHEMA benchmark')
+    cur.execute('SET search_path TO benchmark, public')
+
+    cur.execute('''CREATE TABLE Cards
+                (
+                ID          UUID    PRIMARY KEY NOT NULL,
+                Name        VARCHAR             NOT NULL,
+                DefaultLang BOOLEAN             NOT NULL,
+                ReleasedAt  DATE                NOT NULL
+                )
+                ''')
+
+    # Names look like "Ancient Dragon of the Forest 1234", roughly one in eight printings is the default
+    cur.execute('''INSERT INTO Cards
+                SELECT
+                  gen_random_uuid(),
+                  (ARRAY['Ancient', 'Savage', 'Lightning', 'Shivan', 'Serra', 'Llanowar', 'Professor', 'Elvish', 'Goblin', 'Mind'])[1 + i % 10] || ' ' ||
+                  (ARRAY['Dragon', 'Angel', 'Helix', 'Elves', 'Onyx', 'Guide', 'Stone', 'Bolt', 'Wurm', 'Sphinx'])[1 + (i / 10) % 10] || ' of the ' ||
+                  (ARRAY['Forest', 'Island', 'Mountain', 'Plains', 'Swamp', 'Wastes', 'Multiverse'])[1 + (i / 100) % 7] || ' ' || i,
+                  i % 8 = 0,
+                  DATE '1993-08-05' + (i % 10000)
+                FROM generate_series(1, %s) i
+                ''', (num_cards,))
+    cur.execute('ANALYZE Cards')
+
+def all_cards_search_before(cur: psycopg.Cursor, search_text: str, page: int):
+    # What api_all_cards_search used to do, a COUNT and then the page, both sequential scans
+    search_string = f'%{search_text}%'
+    res = cur.execute('''SELECT COUNT(*) FROM Cards
+                      WHERE LOWER(Name) LIKE %s AND DefaultLang = true''',
+                      (search_string,))
+    res.fetchone()
+    res = cur.execute('''SELECT ID FROM Cards
+                      WHERE LOWER(Name) LIKE %s AND DefaultLang = true
+                      ORDER BY Name, ReleasedAt DESC
+                      LIMIT %s OFFSET %s
+                      ''',
+                      (search_string, PAGE_SIZE, page * PAGE_SIZE))
+    res.fetchall()
+
+def all_cards_search_after(cur: psycopg.Cursor, search_text: str, page: int):
+    # Mirrors the current api_all_cards_search
+    search_string = f'%{search_text}%'
+    res = cur.execute('''SELECT ID, COUNT(*) OVER () FROM Cards
+                      WHERE LOWER(Name) LIKE %s AND DefaultLang = true
+                      ORDER BY Name, ReleasedAt DESC
+                      LIMIT %s OFFSET %s
+                      ''',
+                      (search_string, PAGE_SIZE, page * PAGE_SIZE))
+    res.fetchall()
+
+def time_searches(cur: psycopg.Cursor, search, search_texts: list[str], iterations: int) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        search_text = random.choice(search_texts)
+        now = timeit.default_timer()
+        search(cur, search_text, 0)
+        timings.append(timeit.default_timer() - now)
+    return timings
+
+def benchmark_all_cards_search(args):
+    # What people actually type, partial words, full names and a few misses
+    search_texts = ['prof', 'professor onyx', 'dragon', 'angel of the', 'helix', 'guide of the plains', 'wurm', 'xyzzy', 'bolt of the swamp 12']
+
+    with get_database_connection() as con:
+        cur = con.cursor()
+        print(f"Creating synthetic catalog with {args.cards} cards")
+        create_synthetic_catalog(cur, args.cards)
+        con.commit()
+
+        # Warm the cache so the first runs don't skew the numbers
+        time_searches(cur, all_cards_search_before, search_texts, 5)
+        before = time_searches(cur, all_cards_search_before, search_texts, args.iterations)
+
+        cur.execute('''CREATE INDEX CardsLowerNameTrgmIndex
+                    ON Cards USING GIN (LOWER(Name) gin_trgm_ops)
+                    ''')
+        cur.execute('ANALYZE Cards')
+        con.commit()
+
+        time_searches(cur, all_cards_search_after, search_texts, 5)
+        after = time_searches(cur, all_cards_search_after, search_texts, args.iterations)
+
+        report('before (COUNT + page, no index)', before)
+        report('after (window COUNT, trigram)', after)
+
+        cur.execute('DROP SCHEMA benchmark CASCADE')
+        con.commit()
+
+# What the card details modal does, plus a search like the one on the add page
+def get_serving_paths(url: str, num_cards: int) -> list[str]:
+    scryfall_ids = []
+    page = 0
+    while len(scryfall_ids) < num_cards:
+        cards = requests.get(f"{url}/api/all_cards", params={'page': page, 'default': 'true'}).json()['cards']
+        if len(cards) == 0:
+            break
+        scryfall_ids += [card['scryfall_id'] for card in cards]
+        page += 1
+
+    search_texts = ['prof', 'dragon', 'angel of', 'bolt', 'elves', 'xyzzy']
+
+    paths = []
+    for scryfall_id in scryfall_ids:
+        paths.append(f"/api/by_id?scryfall_id={scryfall_id}")
+        paths.append(f"/api/all_cards/languages?scryfall_id={scryfall_id}")
+        paths.append(f"/api/all_cards?query=search&default=true&text={random.choice(search_texts)}")
+    return paths
+
+def time_serving(url: str, paths: list[str], concurrency: int, requests_per_client: int) -> tuple[list[float], int, float]:
+    def client(_):
+        session = requests.Session()
+        timings = []
+        errors = 0
+        for _ in range(requests_per_client):
+            now = timeit.default_timer()
+            response = session.get(url + random.choice(paths))
+            timings.append(timeit.default_timer() - now)
+            if response.status_code != 200:
+                errors += 1
+        return timings, errors
+
+    start = timeit.default_timer()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(client, range(concurrency)))
+    elapsed = timeit.default_timer() - start
+
+    timings = [timing for client_timings, _ in results for timing in client_timings]
+    errors = sum(client_errors for _, client_errors in results)
+    return timings, errors, elapsed
+
+def benchmark_serving(args):
+    # Each server gets the same requests, so run both against the same database
+    paths = get_serving_paths(args.urls[0], args.cards)
+    if len(paths) == 0:
+        print("The catalog is empty, import some cards first")
+        return
+
+    for concurrency in args.concurrency:
+        for url in args.urls:
+            # Warm up so each worker has its pools and caches filled
+            time_serving(url, paths, concurrency, 2)
+            timings, errors, elapsed = time_serving(url, paths, concurrency, args.requests)
+
+            p50, p99 = percentiles(timings)
+            print(f"{url:<30} {concurrency:>4} clients  {len(timings) / elapsed:8.1f} req/s  p50 {p50 * 1000:8.2f}ms  p99 {p99 * 1000:8.2f}ms  ({errors} errors)")
+
+# Signs up users to log in as, each one's password is its username.
+# There's no way to delete them afterwards, so use a database you don't mind leaving them in
+def create_login_users(url: str, count: int) -> list[str]:
+    session = requests.Session()
+    usernames = []
+    while len(usernames) < count:
+        username = f'benchmark-{uuid.uuid4().hex[:12]}'
+        response = session.post(f"{url}/signup", data={'username': username, 'password': username}, allow_redirects=False)
+        if response.status_code == 302:
+            usernames.append(username)
+        # 503 means the server is busy hashing, try again
+        elif response.status_code != 503:
+            raise RuntimeError(f"Signup failed with status {response.status_code}")
+    return usernames
+
+# Login clients log in over and over while API clients request paths, both until duration seconds are up.
+# Returns the successful logins' timings, how many logins were turned away with a 503, the API timings and errors,
+# and how long it ran
+def time_logins_with_api(url: str, usernames: list[str], paths: list[str], login_clients: int, api_clients: int, duration: float):
+    deadline = timeit.default_timer() + duration
+
+    def login_client(_):
+        timings = []
+        rejected = 0
+        while timeit.default_timer() < deadline:
+            username = random.choice(usernames)
+            now = timeit.default_timer()
+            # A new session each time so every login checks the password
+            response = requests.post(f"{url}/login", data={'username': username, 'password': username}, allow_redirects=False)
+            if response.status_code == 302:
+                timings.append(timeit.default_timer() - now)
+            elif response.status_code == 503:
+                rejected += 1
+            else:
+                raise RuntimeError(f"Login failed with status {response.status_code}")
+        return timings, rejected
+
+    def api_client(_):
+        session = requests.Session()
+        timings = []
+        errors = 0
+        while timeit.default_timer() < deadline:
+            now = timeit.default_timer()
+            response = session.get(url + random.choice(paths))
+            timings.append(timeit.default_timer() - now)
+            if response.status_code != 200:
+                errors += 1
+        return timings, errors
+
+    start = timeit.default_timer()
+    with ThreadPoolExecutor(max_workers=login_clients + api_clients) as executor:
+        login_futures = [executor.submit(login_client, i) for i in range(login_clients)]
+        api_futures = [executor.submit(api_client, i) for i in range(api_clients)]
+        login_results = [future.result() for future in login_futures]
+        api_results = [future.result() for future in api_futures]
+    elapsed = timeit.default_timer() - start
+
+    login_timings = [timing for timings, _ in login_results for timing in timings]
+    rejected = sum(client_rejected for _, client_rejected in login_results)
+    api_timings = [timing for timings, _ in api_results for timing in timings]
+    api_errors = sum(client_errors for _, client_errors in api_results)
+    return login_timings, rejected, api_timings, api_errors, elapsed
+
+def benchmark_logins(args):
+    paths = get_serving_paths(args.url, args.cards)
+    if len(paths) == 0:
+        print("The catalog is empty, import some cards first")
+        return
+
+    usernames = create_login_users(args.url, args.users)
+
+    # The first row, without any logins, is the API latency to compare the others to
+    for login_clients in args.login_concurrency:
+        login_timings, rejected, api_timings, api_errors, elapsed = time_logins_with_api(args.url, usernames, paths, login_clients, args.api_concurrency, args.duration)
+
+        api_p50, api_p99 = percentiles(api_timings)
+        line = f"{login_clients:>4} login clients  {len(login_timings) / elapsed:7.1f} logins/s  {rejected / elapsed:7.1f} rejected/s"
+        if len(login_timings) >= 2:
+            login_p50, login_p99 = percentiles(login_timings)
+            line += f"  login p50 {login_p50 * 1000:8.2f}ms  p99 {login_p99 * 1000:8.2f}ms"
+        line += f"  |  api {len(api_timings) / elapsed:8.1f} req/s  p50 {api_p50 * 1000:8.2f}ms  p99 {api_p99 * 1000:8.2f}ms  ({api_errors} errors)"
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for umori. These need a database configured the same way as main.py.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    all_cards_search_parser = subparsers.add_parser('all_cards_search', help='p50/p99 latency of /api/all_cards name searches before and after the trigram index')
+    all_cards_search_parser.add_argument('--cards', type=int, default=300000, help='Number of synthetic cards to create')
+    all_cards_search_parser.add_argument('--iterations', type=int, default=200, help='Number of searches to time for each variant')
+    all_cards_search_parser.set_defaults(func=benchmark_all_cards_search)
+
+    serving_parser = subparsers.add_parser('serving', help='Throughput of the card API with many concurrent clients, e.g. main.py under gunicorn against asgi.py under uvicorn')
+    serving_parser.add_argument('urls', nargs='+', help='Base URLs of the servers to compare, e.g. http://localhost:8000 http://localhost:8001')
+    serving_parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200], help='Numbers of concurrent clients to try')
+    serving_parser.add_argument('--requests', type=int, default=50, help='Requests each client sends')
+    serving_parser.add_argument('--cards', type=int, default=500, help='Number of different cards to request')
+    serving_parser.set_defaults(func=benchmark_serving)
+
+    logins_parser = subparsers.add_parser('logins', help='Logins per second against API latency with both going at once. Signs up users it leaves behind')
+    logins_parser.add_argument('url', help='Base URL of the server, e.g. http://localhost:8000')
+    logins_parser.add_argument('--login-concurrency', type=int, nargs='+', default=[0, 4, 16, 64], help='Numbers of clients logging in to try')
+    logins_parser.add_argument('--api-concurrency', type=int, default=20, help='Clients requesting the card API the whole time')
+    logins_parser.add_argument('--duration', type=float, default=20, help='Seconds to run each number of login clients for')
+    logins_parser.add_argument('--users', type=int, default=20, help='Number of users to sign up and log in as')
+    logins_parser.add_argument('--cards', type=int, default=500, help='Number of different cards to request')
+    logins_parser.set_defaults(func=benchmark_logins)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,251 @@
+import psycopg, config, database, threading, timeit, logging
+from collections import OrderedDict
+
+# Card data only changes when convert_scryfall_to_sql.convert() runs,
+# and it bumps CatalogGeneration.Generation in the same transaction.
+# Every catalog cache is cleared when we see a new generation.
+#
+# Revoking an API token bumps TokenGeneration.Generation the same way (see api_revoke_token in main.py),
+# and every tokens cache is cleared when we see a new one
+_caches = []
+
+class LRUCache:
+    # If ttl is set entries expire that many seconds after they're put.
+    # Set catalog to False for caches that don't hold card data
+    # so they aren't cleared by a new import.
+    # Set tokens to True for caches of API tokens so they're cleared when one is revoked
+    def __init__(self, name: str, max_size: int, ttl: float | None = None, catalog: bool = True, tokens: bool = False):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.catalog = catalog
+        self.tokens = tokens
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        # Flask's dev server (and gthread workers) can call us from multiple threads
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    # Returns None on a miss, so don't cache None
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry == None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at != None and timeit.default_timer() >= expires_at:
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires_at = None
+        if self.ttl != None:
+            expires_at = timeit.default_timer() + self.ttl
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+# The small lookup tables created in init_database.create_schema(), table -> name column.
+# They only change during a scryfall import
+DIMENSION_TABLES = {
+    'Langs': 'Lang',
+    'Layouts': 'Layout',
+    'ImageStatuses': 'ImageStatus',
+    'Legalities': 'Legality',
+    'SetTypes': 'Type',
+    'Rarities': 'Rarity',
+    'BorderColors': 'BorderColor',
+    'Frames': 'Frame',
+    'Colors': 'Color',
+    'Keywords': 'Keyword',
+    'Games': 'Game',
+    'Finishes': 'Finish'
+}
+
+# Reads every dimension table in one query, returns table -> {name: id}
+def load_dimension_maps(cur: psycopg.Cursor) -> dict[str, dict[str, int]]:
+    query = ' UNION ALL '.join(f"SELECT '{table}', ID, {column} FROM {table}" for table, column in DIMENSION_TABLES.items())
+    res = cur.execute(query)
+
+    dimension_maps = {table: {} for table in DIMENSION_TABLES}
+    for table, id_, name in res.fetchall():
+        dimension_maps[table][name] = id_
+
+    return dimension_maps
+
+# Keeps every dimension table in memory so looking up a finish or lang doesn't need a query.
+# Loaded on first use and again after each new catalog generation
+class DimensionCache:
+    def __init__(self, name: str):
+        self.name = name
+        self.catalog = True
+        self.tokens = False
+        self.loads = 0
+        self._maps = None
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def _get_maps(self, cur: psycopg.Cursor) -> dict[str, dict[str, int]]:
+        check_catalog_generation(cur)
+        with self._lock:
+            if self._maps == None:
+                self._maps = load_dimension_maps(cur)
+                self.loads += 1
+            return self._maps
+
+    # Returns None if there's no row with that name
+    def get_id(self, cur: psycopg.Cursor, table: str, name: str) -> int | None:
+        return self._get_maps(cur)[table].get(name)
+
+    def clear(self):
+        with self._lock:
+            self._maps = None
+
+    def get_stats(self) -> dict[str, int]:
+        with self._lock:
+            size = 0 if self._maps == None else sum(len(names) for names in self._maps.values())
+            return {
+                'size': size,
+                'loads': self.loads
+            }
+
+# A single row counter in the database that's bumped whenever some cached data goes stale.
+# kind is the LRUCache flag ('catalog' or 'tokens') of the caches it clears
+class Generation:
+    def __init__(self, table: str, kind: str, interval_config_name: str):
+        self.table = table
+        self.kind = kind
+        self.interval_config_name = interval_config_name
+        self.query = f'SELECT Generation FROM {table} WHERE ID = 1'
+        self._generation = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self, cur: psycopg.Cursor) -> int:
+        res = cur.execute(self.query)
+        return res.fetchone()[0]
+
+    # Returns the generation we last saw if it was checked recently enough to trust, otherwise None
+    def _get_recent(self, now: float) -> int | None:
+        interval = float(config.get(self.interval_config_name))
+        if self._checked_at != None and now - self._checked_at < interval:
+            return self._generation
+        return None
+
+    # Call with _lock held
+    def _set(self, generation: int, now: float) -> int:
+        # Another request asked after us and already saved what it saw, which is at least as new
+        if self._checked_at != None and now < self._checked_at:
+            return self._generation
+
+        if generation != self._generation:
+            if self._generation != None:
+                logging.info("%s changed from %s to %s, clearing caches", self.table, self._generation, generation)
+            for cache in _caches:
+                if getattr(cache, self.kind):
+                    cache.clear()
+            self._generation = generation
+
+        self._checked_at = now
+        return self._generation
+
+    # To keep it cheap we only ask the database every interval_config_name seconds.
+    # If cur is None we only borrow a connection when we need to ask.
+    #
+    # _lock isn't held while waiting on the database. Under asgi.py check_async() takes it on the event loop,
+    # so a Flask thread holding it while it waits for a pooled connection would stop every async request.
+    # A few requests might ask at once when the interval runs out, which is harmless
+    def check(self, cur: psycopg.Cursor | None = None) -> int:
+        now = timeit.default_timer()
+
+        with self._lock:
+            generation = self._get_recent(now)
+        if generation != None:
+            return generation
+
+        if cur == None:
+            with database.get_database_connection() as con:
+                generation = self.get(con.cursor())
+        else:
+            generation = self.get(cur)
+
+        with self._lock:
+            return self._set(generation, now)
+
+    # The same as check() for asgi.py, it borrows from the async pool when it needs to ask
+    async def check_async(self) -> int:
+        now = timeit.default_timer()
+
+        with self._lock:
+            generation = self._get_recent(now)
+        if generation != None:
+            return generation
+
+        async with database.get_async_database_connection() as con:
+            res = await con.execute(self.query)
+            generation = (await res.fetchone())[0]
+
+        with self._lock:
+            return self._set(generation, now)
+
+    # The next check() asks the database
+    def expire(self):
+        with self._lock:
+            self._checked_at = None
+
+catalog_generation = Generation('CatalogGeneration', 'catalog', 'CATALOG_GENERATION_CHECK_INTERVAL')
+token_generation = Generation('TokenGeneration', 'tokens', 'API_TOKEN_REVOCATION_CHECK_INTERVAL')
+
+def get_catalog_generation(cur: psycopg.Cursor) -> int:
+    return catalog_generation.get(cur)
+
+# Call this before reading from any catalog cache. A new import can take
+# up to CATALOG_GENERATION_CHECK_INTERVAL seconds to show up.
+# If cur is None we only borrow a connection when we need to ask.
+def check_catalog_generation(cur: psycopg.Cursor | None = None) -> int:
+    return catalog_generation.check(cur)
+
+async def check_catalog_generation_async() -> int:
+    return await catalog_generation.check_async()
+
+# Call this before reading from the API token cache. A token revoked through
+# another worker can keep working here for up to API_TOKEN_REVOCATION_CHECK_INTERVAL seconds
+def check_token_generation(cur: psycopg.Cursor | None = None) -> int:
+    return token_generation.check(cur)
+
+async def check_token_generation_async() -> int:
+    return await token_generation.check_async()
+
+def get_cache_stats() -> dict[str, dict[str, int]]:
+    return {cache.name: cache.get_stats() for cache in _caches}
@@ -5,7 +5,70 @@ config = {
     'DB_USER': os.environ.get('DB_USER'),
     'DB_PASSWORD': os.environ.get('DB_PASSWORD'),
     'DB_HOST': os.environ.get('DB_HOST', '0.0.0.0'),
-    'DB_PORT': os.environ.get('DB_PORT', '5432')
+    'DB_PORT': os.environ.get('DB_PORT', '5432'),
+    'DB_POOL_MIN_SIZE': os.environ.get('DB_POOL_MIN_SIZE', '1'),
+    'DB_POOL_MAX_SIZE': os.environ.get('DB_POOL_MAX_SIZE', '10'),
+    # Seconds a connection can sit unused before the pool closes it
+    'DB_POOL_MAX_IDLE': os.environ.get('DB_POOL_MAX_IDLE', '600'),
+    # Seconds a request will wait for a free connection before failing
+    'DB_POOL_TIMEOUT': os.environ.get('DB_POOL_TIMEOUT', '30'),
+    # Max number of cards (and language lists) each worker keeps in memory
+    'CARD_CACHE_SIZE': os.environ.get('CARD_CACHE_SIZE', '20000'),
+    # Seconds between checks for a new scryfall import
+    'CATALOG_GENERATION_CHECK_INTERVAL': os.environ.get('CATALOG_GENERATION_CHECK_INTERVAL', '5'),
+    # Seconds a worker trusts a token lookup before checking the database again
+    'API_TOKEN_CACHE_TTL': os.environ.get('API_TOKEN_CACHE_TTL', '30'),
+    # Seconds between checks for a token revoked through another worker.
+    # A revoked token can keep working in the other workers for this long
+    'API_TOKEN_REVOCATION_CHECK_INTERVAL': os.environ.get('API_TOKEN_REVOCATION_CHECK_INTERVAL', '1'),
+    'API_TOKEN_CACHE_SIZE': os.environ.get('API_TOKEN_CACHE_SIZE', '1000'),
+    # Set to "true" while working on the html so changes show up without a restart
+    'TEMPLATES_AUTO_RELOAD': os.environ.get('TEMPLATES_AUTO_RELOAD', 'false'),
+    # Seconds browsers and proxies can reuse card data without asking again.
+    # After that they revalidate with the ETag, which only changes on a new import
+    'CATALOG_MAX_AGE': os.environ.get('CATALOG_MAX_AGE', '300'),
+    # auto uses orjson if it's installed, otherwise json. Can be forced with orjson or json
+    'JSON_ENCODER': os.environ.get('JSON_ENCODER', 'auto'),
+    # Most operations accepted by one POST /api/collection/batch
+    'MAX_BATCH_OPERATIONS': os.environ.get('MAX_BATCH_OPERATIONS', '5000'),
+    # Statements slower than this are logged, see slow_queries.py
+    'SLOW_QUERY_THRESHOLD_MS': os.environ.get('SLOW_QUERY_THRESHOLD_MS', '200'),
+    # Fraction of slow SELECTs that are run again under EXPLAIN (ANALYZE, BUFFERS).
+    # That runs them twice, so keep it low. 0 turns it off
+    'SLOW_QUERY_EXPLAIN_SAMPLE_RATE': os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', '0.05'),
+    # Slow statements each process keeps for /api/admin/slow_queries
+    'SLOW_QUERY_LOG_SIZE': os.environ.get('SLOW_QUERY_LOG_SIZE', '100'),
+    # Comma separated users who can see the /api/admin/* routes
+    'ADMIN_USERNAMES': os.environ.get('ADMIN_USERNAMES', ''),
+    # text or json (one object per line, with the request id), see logs.py
+    'LOG_FORMAT': os.environ.get('LOG_FORMAT', 'text'),
+    # Fraction of successful requests that get an access log line
+    'ACCESS_LOG_SAMPLE_RATE': os.environ.get('ACCESS_LOG_SAMPLE_RATE', '1'),
+    # Requests slower than this always get one, like errors do
+    'ACCESS_LOG_SLOW_MS': os.environ.get('ACCESS_LOG_SLOW_MS', '1000'),
+    # Seconds a job runner holds a job without a heartbeat before another runner can take it, see jobs.py
+    'JOB_LEASE_SECONDS': os.environ.get('JOB_LEASE_SECONDS', '60'),
+    # Seconds between heartbeats, which also save the job's progress. Keep it well under JOB_LEASE_SECONDS
+    'JOB_HEARTBEAT_INTERVAL': os.environ.get('JOB_HEARTBEAT_INTERVAL', '15'),
+    # Seconds an idle runner waits before looking for a job again
+    'JOB_POLL_INTERVAL': os.environ.get('JOB_POLL_INTERVAL', '5'),
+    # Times a job is tried before it's marked failed
+    'JOB_MAX_ATTEMPTS': os.environ.get('JOB_MAX_ATTEMPTS', '3'),
+    # Seconds before a failed job is tried again, doubled after each attempt
+    'JOB_RETRY_DELAY': os.environ.get('JOB_RETRY_DELAY', '60'),
+    # Set to "false" to not have gunicorn start a job runner (and queue a scryfall import) when it starts
+    'START_JOB_RUNNER': os.environ.get('START_JOB_RUNNER', 'true'),
+    # Argon2 parameters for new password hashes, see passwords.py. Memory is in KiB.
+    # Each hash uses up to ARGON2_PARALLELISM cores
+    'ARGON2_TIME_COST': os.environ.get('ARGON2_TIME_COST', '3'),
+    'ARGON2_MEMORY_COST': os.environ.get('ARGON2_MEMORY_COST', '65536'),
+    'ARGON2_PARALLELISM': os.environ.get('ARGON2_PARALLELISM', '4'),
+    # Processes each worker hashes passwords in
+    'PASSWORD_HASH_PROCESSES': os.environ.get('PASSWORD_HASH_PROCESSES', '1'),
+    # Hashes each worker lets run or wait for a process before login and signup answer 503
+    'PASSWORD_HASH_MAX_PENDING': os.environ.get('PASSWORD_HASH_MAX_PENDING', '4'),
+    # Seconds a login waits for its hash before giving up with a 503
+    'PASSWORD_HASH_TIMEOUT': os.environ.get('PASSWORD_HASH_TIMEOUT', '5')
 }
 
 def get(config_name: str):
@@ -16,3 +79,8 @@ def get(config_name: str):
         exit(1)
     return value
 
+
+# For options that are a comma separated list, these can be empty
+def get_list(config_name: str) -> list[str]:
+    value = config.get(config_name) or ''
+    return [item.strip() for item in value.split(',') if item.strip() != '']
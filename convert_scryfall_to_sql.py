@@ -4,11 +4,17 @@
 # Using UNLOGGED tables and then using ALTER TABLE ... SET LOGGED seems the same as just using LOGGED tables to begin with
 # Sqlite3 is waaaay faster, for inserts but waaaay slower on the DELETES. It took about ~15 minutes or so to DELETE all the data in Sqlite3
 
-import psycopg, ijson, sys, os, timeit, requests, config, init_database, logging
-from typing import TextIO
+import psycopg, ijson, sys, os, timeit, requests, config, init_database, migrations, cache, database, logs, logging
+from typing import TextIO, Callable
 
+# How a long running import reports how far along it is: progress(stage, done, total).
+# total is None when we don't know it yet. jobs.Progress is one
+ProgressCallback = Callable[[str, int, int | None], None]
 
-def convert(all_data_file: TextIO, default_data_file: TextIO):
+def no_progress(stage: str, done: int, total: int | None = None):
+    pass
+
+def convert(all_data_file: TextIO, default_data_file: TextIO, progress: ProgressCallback = no_progress):
     all_data = ijson.items(all_data_file, 'item', use_float=True)
 
     default_data = ijson.items(default_data_file, 'item', use_float=True)
@@ -28,9 +34,11 @@ def convert(all_data_file: TextIO, default_data_file: TextIO):
     #if os.path.exists('all.db'):
     #    os.remove('all.db')
 
-    init_database.create_tables()
+    # Run on its own this is the first thing to touch the database
+    migrations.migrate()
 
-    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'))
+    # TimedCursor logs the slow statements, see slow_queries.py
+    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'), cursor_factory = database.TimedCursor)
 
     cur = con.cursor()
 
@@ -80,6 +88,9 @@ def convert(all_data_file: TextIO, default_data_file: TextIO):
     # This allows index to be used after the loop which effectively counts how many card there are
     index = 0
     for index, card in enumerate(all_data):
+        if index % 1000 == 0:
+            progress('discovering', index, None)
+
         # Skip digital only cards
         if card['digital']:
             continue
@@ -146,7 +157,14 @@ def convert(all_data_file: TextIO, default_data_file: TextIO):
     sets_id_map = {}
     set_types_id_map = {}
 
+    # Most of the values in the small tables are already there from the last import,
+    # so we look them up in memory and only go to the database for new ones
+    dimension_maps = cache.load_dimension_maps(cur)
+
     def insert_or_select(table_name: str, column_names: tuple[str], values):
+        known_id = dimension_maps.get(table_name, {}).get(values[0])
+        if known_id != None:
+            return known_id
 
         columns = ""
         for index, name in enumerate(column_names):
@@ -244,7 +262,7 @@ def convert(all_data_file: TextIO, default_data_file: TextIO):
 
             if index % 1000 == 0:
                 logging.info(f"{index}/{num_cards} {index/num_cards:.2f}")
-                pass
+                progress('inserting', index, num_cards)
             lang_id = langs_id_map[card['lang']]
 
             layout_id = layouts_id_map[card['layout']]
@@ -403,12 +421,19 @@ def convert(all_data_file: TextIO, default_data_file: TextIO):
     now = timeit.default_timer()
 
 
-    for face in faces:
+    for index, face in enumerate(faces):
+        if index % 1000 == 0:
+            progress('inserting faces', index, len(faces))
         res = cur.execute('INSERT INTO Faces (CardID, Name, ManaCost, TypeLine, OracleText, FlavorText, Artist, ArtistID, IllustrationID, NormalImageURI) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)', face)
 
     logging.info(f"INSERT faces took {timeit.default_timer() - now:.2f} seconds")
     now = timeit.default_timer()
 
+    # Tells the web workers to drop any card data they've cached,
+    # this is part of the same transaction so they can't see the new generation before the new data
+    cur.execute('UPDATE CatalogGeneration SET Generation = Generation + 1')
+
+    progress('committing', 0, None)
     now = timeit.default_timer()
     con.commit()
     logging.info(f"Commit took {timeit.default_timer() - now:.2f} seconds")
@@ -419,6 +444,7 @@ def convert(all_data_file: TextIO, default_data_file: TextIO):
 
 
 if __name__ == "__main__":
+    logs.setup()
     if len(sys.argv) != 3:
         logging.error("Expected exactly two arguments, the path to the ALL data and the path to the DEFAULT data")
 
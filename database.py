@@ -0,0 +1,150 @@
+import config, metrics, slow_queries, os, logging, timeit
+import psycopg
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
+
+# Each gunicorn worker gets its own pool.
+# We remember which process created the pool because a forked child
+# inherits the parent's pool object, but the sockets in it aren't
+# safe to share between processes.
+_pool = None
+_pool_pid = None
+# Only used by asgi.py. It's tied to the event loop it was opened on
+# so it's opened and closed by the ASGI app's lifespan instead of on first use
+_async_pool = None
+
+# Pooled connections make their cursors with these, so the time every statement takes
+# is added to the database time of the request it ran for (see metrics.py)
+# and slow ones are logged (see slow_queries.py). The scripts use them for their connections too.
+# Named (server side) cursors aren't timed
+class TimedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, *, prepare=None, binary=None):
+        started_at = timeit.default_timer()
+        try:
+            super().execute(query, params, prepare=prepare, binary=binary)
+        finally:
+            elapsed = timeit.default_timer() - started_at
+            metrics.record_query(elapsed)
+        slow_queries.record(self.connection, query, params, elapsed)
+        return self
+
+    def executemany(self, query, params_seq, *, returning=False):
+        started_at = timeit.default_timer()
+        try:
+            super().executemany(query, params_seq, returning=returning)
+        finally:
+            elapsed = timeit.default_timer() - started_at
+            metrics.record_query(elapsed)
+        slow_queries.record(self.connection, query, None, elapsed, can_explain=False)
+
+class AsyncTimedCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, *, prepare=None, binary=None):
+        started_at = timeit.default_timer()
+        try:
+            await super().execute(query, params, prepare=prepare, binary=binary)
+        finally:
+            elapsed = timeit.default_timer() - started_at
+            metrics.record_query(elapsed)
+        await slow_queries.record_async(self.connection, query, params, elapsed)
+        return self
+
+    async def executemany(self, query, params_seq, *, returning=False):
+        started_at = timeit.default_timer()
+        try:
+            await super().executemany(query, params_seq, returning=returning)
+        finally:
+            elapsed = timeit.default_timer() - started_at
+            metrics.record_query(elapsed)
+        await slow_queries.record_async(self.connection, query, None, elapsed, can_explain=False)
+
+def configure_connection(con: psycopg.Connection):
+    con.cursor_factory = TimedCursor
+
+async def configure_async_connection(con: psycopg.AsyncConnection):
+    con.cursor_factory = AsyncTimedCursor
+
+def get_connection_kwargs() -> dict:
+    return {
+        'user': config.get('DB_USER'),
+        'password': config.get('DB_PASSWORD'),
+        'host': config.get('DB_HOST'),
+        'port': config.get('DB_PORT')
+    }
+
+# A connection outside of the pool, for the scripts and for gunicorn's arbiter,
+# which would otherwise leave a pool behind for the workers it forks to inherit.
+# Use it like psycopg.connect(), kwargs are passed on to it
+def connect(**kwargs) -> psycopg.Connection:
+    return psycopg.connect(**get_connection_kwargs(), cursor_factory=TimedCursor, **kwargs)
+
+def get_pool_kwargs() -> dict:
+    return {
+        'kwargs': get_connection_kwargs(),
+        'min_size': int(config.get('DB_POOL_MIN_SIZE')),
+        'max_size': int(config.get('DB_POOL_MAX_SIZE')),
+        'max_idle': float(config.get('DB_POOL_MAX_IDLE')),
+        'timeout': float(config.get('DB_POOL_TIMEOUT'))
+    }
+
+def get_pool() -> ConnectionPool:
+    global _pool, _pool_pid
+
+    pid = os.getpid()
+    if _pool == None or _pool_pid != pid:
+        logging.info(f"Opening database connection pool for pid {pid}")
+        _pool = ConnectionPool(
+            **get_pool_kwargs(),
+            # Runs a cheap query on a connection before handing it out
+            # so we don't give a request a connection the server has dropped
+            check=ConnectionPool.check_connection,
+            configure=configure_connection,
+            name=f'umori-{pid}',
+            open=True
+        )
+        _pool_pid = pid
+
+    return _pool
+
+async def open_async_pool():
+    global _async_pool
+
+    pid = os.getpid()
+    logging.info(f"Opening async database connection pool for pid {pid}")
+    _async_pool = AsyncConnectionPool(
+        **get_pool_kwargs(),
+        check=AsyncConnectionPool.check_connection,
+        configure=configure_async_connection,
+        name=f'umori-async-{pid}',
+        open=False
+    )
+    await _async_pool.open()
+
+async def close_async_pool():
+    global _async_pool
+
+    if _async_pool != None:
+        await _async_pool.close()
+        _async_pool = None
+
+# The async version of get_database_connection(), use it with "async with"
+def get_async_database_connection():
+    return _async_pool.connection()
+
+# Returns a context manager that borrows a connection from the pool.
+# Just like psycopg.connect() the transaction is committed when the
+# block exits normally and rolled back if it raises, but the connection
+# is returned to the pool instead of being closed.
+def get_database_connection():
+    return get_pool().connection()
+
+# Counters since the pool was opened, including how many requests
+# had to wait for a connection (requests_queued) and how long they waited in total (requests_wait_ms)
+def get_pool_stats() -> dict[str, int]:
+    return get_pool().get_stats()
+
+# Copies the stats of this process's pools to the /metrics gauges and counters.
+# Called at the end of each request
+def record_pool_metrics():
+    if _pool != None and _pool_pid == os.getpid():
+        metrics.record_pool_stats('sync', _pool.get_stats())
+    if _async_pool != None:
+        metrics.record_pool_stats('async', _async_pool.get_stats())
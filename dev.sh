@@ -2,5 +2,11 @@
 
 export FLASK_APP=main
 export FLASK_ENV=development
+export TEMPLATES_AUTO_RELOAD=true
 source ./env/bin/activate
+# flask run doesn't use gunicorn.conf.py, so migrate first
+python migrations.py
+# and the job runner gunicorn would have started. Queue an import with python jobs.py enqueue import_scryfall
+python jobs.py run &
+trap "kill $!" EXIT
 python -m flask run
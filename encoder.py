@@ -0,0 +1,77 @@
+import json, uuid, config, logging
+from datetime import date, datetime
+
+# orjson is a lot faster than json and understands UUIDs and datetimes itself.
+# It's optional, without it we fall back to json with a default() that does the same conversions
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Roughly how many bytes stream_array() collects before handing a chunk to the server
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# ensure_ascii=False so non-ASCII text comes out as UTF-8 like orjson's, instead of \u escapes
+def _dumps_json(obj) -> bytes:
+    return json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False).encode()
+
+def _dumps_orjson(obj) -> bytes:
+    return orjson.dumps(obj)
+
+def _get_dumps():
+    name = config.get('JSON_ENCODER')
+    if name == 'orjson' or (name == 'auto' and orjson != None):
+        if orjson == None:
+            logging.error("JSON_ENCODER is orjson, but orjson isn't installed")
+            exit(1)
+        return _dumps_orjson
+    elif name in ('json', 'auto'):
+        return _dumps_json
+    else:
+        logging.error(f"Unknown JSON_ENCODER {name}, expected auto, orjson or json")
+        exit(1)
+
+# Serializes obj to JSON bytes. UUIDs become strings and dates become ISO 8601
+dumps = _get_dumps()
+
+# Yields a JSON array of items in chunks, so a response can be sent
+# while we're still reading rows instead of building it all in memory first
+def stream_array(items):
+    chunk = bytearray(b'[')
+    first = True
+    for item in items:
+        if not first:
+            chunk += b','
+        chunk += dumps(item)
+        first = False
+
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk = bytearray()
+
+    chunk += b']'
+    yield bytes(chunk)
+
+# stream_array() for rows coming from an async cursor
+async def stream_array_async(items):
+    chunk = bytearray(b'[')
+    first = True
+    async for item in items:
+        if not first:
+            chunk += b','
+        chunk += dumps(item)
+        first = False
+
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk = bytearray()
+
+    chunk += b']'
+    yield bytes(chunk)
@@ -0,0 +1,38 @@
+# gunicorn loads this from the working directory on its own, in both SERVER_MODEs
+import os, shutil, subprocess, sys
+
+# Runs once in the arbiter before any worker is started.
+#
+# When PROMETHEUS_MULTIPROC_DIR is set each worker writes its metrics to files there (see metrics.py).
+# Files left over from the last run would be added to this one's.
+#
+# Then the database is migrated, so the workers only have to check the schema version (see migrations.py).
+#
+# Then a scryfall import is queued and a job runner is started to do it (see jobs.py).
+# It's its own process so gunicorn doesn't kill it for not answering like it would a worker
+def on_starting(server):
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    import config, logs, migrations, jobs
+    logs.setup()
+    migrations.migrate()
+
+    server.job_runner = None
+    if config.get('START_JOB_RUNNER') == 'true':
+        jobs.enqueue('import_scryfall')
+        server.job_runner = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.py'), 'run'])
+
+# A job it was in the middle of is taken over by the next runner once its lease runs out
+def on_exit(server):
+    if getattr(server, 'job_runner', None) != None:
+        server.job_runner.terminate()
+        server.job_runner.wait()
+
+# Stops counting a dead worker's in progress requests and open connections
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
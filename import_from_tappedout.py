@@ -9,10 +9,11 @@
 
 # Lightning Helix STA:125 used to show up as STA:62 in csv. This seems to be fixed, but we should watch out for errors in the csv
 
-import re, psycopg, csv, config
+import re, psycopg, csv, config, cache, database, logs, logging
 
 def import_data(user: str):
-    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'))
+    # TimedCursor logs the slow statements, see slow_queries.py
+    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'), cursor_factory = database.TimedCursor)
     cur = con.cursor()
 
     res = cur.execute('SELECT ID FROM Users WHERE Username = %s', (user,))
@@ -20,11 +21,9 @@ def import_data(user: str):
 
     rows_to_insert = []
 
-    res = cur.execute('SELECT ID, Finish FROM Finishes')
-    finishes = res.fetchall()
-
     # Map finish -> id
-    finish_id_map= {}
+    finish_id_map = cache.load_dimension_maps(cur)['Finishes']
+    finishes = list(finish_id_map)
 
     scryfall_to_db_condition = {
         'NM': 'Near Mint',
@@ -33,9 +32,6 @@ def import_data(user: str):
         'HP': 'Heavily Played'
     }
 
-    for finish in finishes:
-        finish_id_map[finish[1]] = finish[0]
-
     # Use local scryfall database for this
     def get_default_collectors_number(name: str, set_abbr: str) -> str:
         # Tappedout does Turn / Burn
@@ -70,17 +66,16 @@ def import_data(user: str):
         # ex. Unfinity attractions have all non-numeric collector numbers
         else:
             if len(collector_numbers) == 0:
-                print(name, set_abbr)
+                logging.error("Didn't find any collector numbers for %s (%s)", name, set_abbr)
             default = min(collector_numbers)
 
             if len(collector_numbers) > 1:
                 # Tappedout doesn't seem to differentiate these so print a warning that we've defaulted to
                 # the first variation
-                print(f"WARNING: Tappedout might not differentiate between the versions of {name} ({set_abbr}), defaulting to collector number {default}.")
+                logging.warning("Tappedout might not differentiate between the versions of %s (%s), defaulting to collector number %s.", name, set_abbr, default)
 
         if len(collector_numbers) == 0:
-            print(collector_numbers)
-            print(name, set_abbr)
+            logging.error("Didn't find any collector numbers for %s (%s): %s", name, set_abbr, collector_numbers)
             exit(1)
 
         assert type(default) == str
@@ -209,7 +204,7 @@ def import_data(user: str):
                     collector_number += 's'
 
             if language == 'zh':
-                print(f"WARNING: Tappedout doesn't have Chinese Traditional as a language option. Verify this card is actually Chinese Simplified. {name} ({set_abbr}:{collector_number})")
+                logging.warning("Tappedout doesn't have Chinese Traditional as a language option. Verify this card is actually Chinese Simplified. %s (%s:%s)", name, set_abbr, collector_number)
                 language = 'zhs'
 
             res = cur.execute('SELECT fc.ID, fc.FinishID FROM FinishCards fc WHERE CardID IN (SELECT c.ID FROM Cards c INNER JOIN Sets s ON c.SetID = s.ID INNER JOIN Langs l ON c.LangID = l.ID WHERE s.Code = %s AND c.CollectorNumber = %s AND l.Lang = %s)', (set_abbr, collector_number, language))
@@ -226,11 +221,11 @@ def import_data(user: str):
                 if len(languages) > 0 and language not in languages:
                     # If the card doesn't come in this language and there's only one option that's probably what they wanted
                     if len(languages) == 1:
-                        print(f"WARNING: {name} ({set_abbr}:{collector_number}) doesn't come in language '{language}', it only comes in {languages[0][0]}. So we're using that.")
+                        logging.warning("%s (%s:%s) doesn't come in language '%s', it only comes in %s. So we're using that.", name, set_abbr, collector_number, language, languages[0][0])
                         language = languages[0][0]
                     else:
                         # This is to cover weird edge cases that I haven't seen yet.
-                        print(f"Card doesn't come in this language and there are multiple to choose from. Fix it in tappedout and try again. Card: {name} ({set_abbr}:{collector_number}) {language}, Available languages: {languages}")
+                        logging.error("Card doesn't come in this language and there are multiple to choose from. Fix it in tappedout and try again. Card: %s (%s:%s) %s, Available languages: %s", name, set_abbr, collector_number, language, languages)
                         exit(1)
 
                 res = cur.execute('SELECT fc.ID, fc.FinishID FROM FinishCards fc WHERE CardID IN (SELECT c.ID FROM Cards c INNER JOIN Sets s ON c.SetID = s.ID INNER JOIN Langs l ON c.LangID = l.ID WHERE s.Code = %s AND c.CollectorNumber = %s AND l.Lang = %s)', (set_abbr, collector_number, language))
@@ -250,19 +245,19 @@ def import_data(user: str):
             # If etched is the only option then we don't need to warn
             if len(id_finishes) > 1:
                 if finish_id_map['etched'] in finish_ids:
-                    print(f"INFO: Tappedout doesn't have etched as an option in their database and {name} ({set_abbr}:{collector_number}) is available in etched. Ensure the data is correct.")
+                    logging.info("Tappedout doesn't have etched as an option in their database and %s (%s:%s) is available in etched. Ensure the data is correct.", name, set_abbr, collector_number)
 
                 if not foil and finish_id_map['nonfoil'] in finish_ids:
                     finish = finish_id_map['nonfoil']
                 elif foil and finish_id_map['foil'] in finish_ids:
                     finish = finish_id_map['foil']
                 else:
-                    print(f"Finish appears to be wrong on card {name} ({set_abbr}:{collector_number}). Valid options are {finishes}")
+                    logging.error("Finish appears to be wrong on card %s (%s:%s). Valid options are %s", name, set_abbr, collector_number, finishes)
                     exit(1)
 
                 finishCardID = [f for f in id_finishes if f[1] == finish]
                 if len(finishCardID) != 1:
-                    print(f"Didn't find exactly one card + finish for card {name} ({set_abbr}:{collector_number}). Options were {finishCardID}")
+                    logging.error("Didn't find exactly one card + finish for card %s (%s:%s). Options were %s", name, set_abbr, collector_number, finishCardID)
                     exit(1)
 
                 finishCardID = finishCardID[0][0]
@@ -270,7 +265,7 @@ def import_data(user: str):
                 # TODO: Warn if the only finish in scryfall doesn't match the one they have in tappedout
                 finishCardID = id_finishes[0][0]
             else:
-                print(row)
+                logging.error("No card + finish + lang matches %s", row)
                 raise ValueError("Didn't find a matching card + finish + lang combo")
 
             condition = row['Condition']
@@ -289,7 +284,8 @@ def import_data(user: str):
 
 import timeit
 
+logs.setup()
 now = timeit.default_timer()
 import_data('me')
 
-print(f"Took {timeit.default_timer() - now} seconds")
+logging.info("Took %.2f seconds", timeit.default_timer() - now)
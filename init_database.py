@@ -1,4 +1,4 @@
-import psycopg, config, convert_scryfall_to_sql, requests, os, logging
+import convert_scryfall_to_sql, database, psycopg, requests, os, logging
 
 def get_stream(url):
     s = requests.Session()
@@ -6,7 +6,11 @@ def get_stream(url):
         for chunk in resp.iter_content(chunk_size=512):
             yield chunk
 
-def import_from_scryfall():
+# Run by the job runner, see jobs.py. progress is a convert_scryfall_to_sql.ProgressCallback
+def import_from_scryfall(progress=None):
+    if progress == None:
+        progress = convert_scryfall_to_sql.no_progress
+
     response = requests.get("https://api.scryfall.com/bulk-data")
     all_cards_path = "all_cards.json"
     default_cards_path = "default_cards.json"
@@ -16,14 +20,12 @@ def import_from_scryfall():
         if bulk_data['type'] == 'all_cards':
             uri = bulk_data['download_uri']
             logging.info(f"Downloading all_cards data from {uri}")
-            for chunk in get_stream(uri):
-                all_data_file.write(chunk)
+            download(uri, all_data_file, 'downloading all_cards', bulk_data.get('size'), progress)
 
         elif bulk_data['type'] == 'default_cards':
             uri = bulk_data['download_uri']
             logging.info(f"Downloading default_cards data from {uri}")
-            for chunk in get_stream(uri):
-                default_data_file.write(chunk)
+            download(uri, default_data_file, 'downloading default_cards', bulk_data.get('size'), progress)
 
     all_data_file.close()
     default_data_file.close()
@@ -33,20 +35,31 @@ def import_from_scryfall():
     default_data_file = open(default_cards_path, 'r')
 
     logging.info(f"Converting scryfall data into database")
-    convert_scryfall_to_sql.convert(all_data_file, default_data_file)
+    convert_scryfall_to_sql.convert(all_data_file, default_data_file, progress)
 
     os.remove(all_cards_path)
     os.remove(default_cards_path)
 
-def create_tables():
-    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'))
-    cur = con.cursor()
-
-    # We use a lock here because multiple concurrent CREATE TABLE commands
-    # cause issues with postgres, see here
-    # https://www.postgresql.org/message-id/CA+TgmoZAdYVtwBfp1FL2sMZbiHCWT4UPrzRLNnX1Nb30Ku3-gg@mail.gmail.com
-    cur.execute('SELECT pg_advisory_lock(0)')
-
+# size is what scryfall says the file is in bytes, if it said
+def download(uri: str, file, stage: str, size: int | None, progress):
+    written = 0
+    for chunk in get_stream(uri):
+        file.write(chunk)
+        written += len(chunk)
+        progress(stage, written, size)
+
+# Oracle text is always English, even on cards printed in other languages
+SEARCH_CONFIG = 'english'
+
+# The SearchVector column on Cards and Faces, they both have Name, TypeLine and OracleText
+def search_vector_expression() -> str:
+    return f"""setweight(to_tsvector('{SEARCH_CONFIG}', COALESCE(Name, '')), 'A') ||
+               setweight(to_tsvector('{SEARCH_CONFIG}', COALESCE(TypeLine, '')), 'B') ||
+               setweight(to_tsvector('{SEARCH_CONFIG}', COALESCE(OracleText, '')), 'C')"""
+
+# Version 1 of the schema, see migrations.py. It's all IF NOT EXISTS
+# so databases made before there were migrations are brought up to it too
+def create_schema(cur: psycopg.Cursor):
     cur.execute('''CREATE TABLE IF NOT EXISTS Langs
                 (
                 ID   INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
@@ -213,6 +226,40 @@ def create_tables():
                    )
                  ''')
 
+    # Name searches are substring matches (LOWER(Name) LIKE '%text%')
+    # which a B-tree can't help with, but a trigram index can
+    cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    cur.execute('''CREATE INDEX IF NOT EXISTS CardsLowerNameTrgmIndex
+                ON Cards USING GIN (LOWER(Name) gin_trgm_ops)
+                ''')
+
+    # The same for the t: and o: terms in scryfall style searches (see search.py)
+    cur.execute('''CREATE INDEX IF NOT EXISTS CardsLowerTypeLineTrgmIndex
+                ON Cards USING GIN (LOWER(TypeLine) gin_trgm_ops)
+                ''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS CardsLowerOracleTextTrgmIndex
+                ON Cards USING GIN (LOWER(OracleText) gin_trgm_ops)
+                ''')
+
+    # For cmc<=3 and friends
+    cur.execute('CREATE INDEX IF NOT EXISTS CardsCmcIndex ON Cards (Cmc)')
+
+    # In the order listings are sorted by, so a page after a cursor (see pagination.py)
+    # starts at the cursor's place in the index instead of counting past the pages before it
+    cur.execute('''CREATE INDEX IF NOT EXISTS CardsNameReleasedAtIDIndex
+                ON Cards (Name, ReleasedAt DESC, ID)
+                ''')
+
+    # Full text search over the rules text, see FULL_TEXT_SEARCH_QUERIES in main.py.
+    # Names count the most and oracle text the least when results are ranked.
+    # It's added separately so databases made before it existed get it too
+    cur.execute(f'''ALTER TABLE Cards ADD COLUMN IF NOT EXISTS SearchVector tsvector
+                GENERATED ALWAYS AS ({search_vector_expression()}) STORED
+                ''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS CardsSearchVectorIndex
+                ON Cards USING GIN (SearchVector)
+                ''')
+
 
 
     # Why UNIQUE(CardID, Name, NormalImageURI)
@@ -236,6 +283,21 @@ def create_tables():
                 )
                 ''')
 
+    # Cards are always loaded with their faces, without this every join scans Faces
+    cur.execute('CREATE INDEX IF NOT EXISTS FacesCardIDIndex ON Faces (CardID)')
+
+    # Cards with more than one face keep their oracle text here
+    cur.execute('''CREATE INDEX IF NOT EXISTS FacesLowerOracleTextTrgmIndex
+                ON Faces USING GIN (LOWER(OracleText) gin_trgm_ops)
+                ''')
+
+    cur.execute(f'''ALTER TABLE Faces ADD COLUMN IF NOT EXISTS SearchVector tsvector
+                GENERATED ALWAYS AS ({search_vector_expression()}) STORED
+                ''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS FacesSearchVectorIndex
+                ON Faces USING GIN (SearchVector)
+                ''')
+
 
     # We _could_ make a table for the MultiverseIDs and
     # have this be forign keys to each table, but that seems
@@ -258,6 +320,12 @@ def create_tables():
                 )
                 ''')
 
+    # The UNIQUE index starts with CardID, searches like c:rg start from the color.
+    # Having CardID in the index too means they never have to visit the table
+    cur.execute('''CREATE INDEX IF NOT EXISTS ColorCardsColorIDCardIDIndex
+                ON ColorCards (ColorID, CardID)
+                ''')
+
 
     cur.execute('''CREATE TABLE IF NOT EXISTS ColorIdentityCards
                 (
@@ -268,6 +336,10 @@ def create_tables():
                 )
                 ''')
 
+    cur.execute('''CREATE INDEX IF NOT EXISTS ColorIdentityCardsColorIDCardIDIndex
+                ON ColorIdentityCards (ColorID, CardID)
+                ''')
+
 
     cur.execute('''CREATE TABLE IF NOT EXISTS Keywords
                 (
@@ -276,6 +348,9 @@ def create_tables():
                 )
                 ''')
 
+    # Keywords are stored like "Flying" but searched for case insensitively
+    cur.execute('CREATE INDEX IF NOT EXISTS KeywordsLowerKeywordIndex ON Keywords (LOWER(Keyword))')
+
 
     cur.execute('''CREATE TABLE IF NOT EXISTS KeywordCards
                 (
@@ -286,6 +361,10 @@ def create_tables():
                 )
                 ''')
 
+    cur.execute('''CREATE INDEX IF NOT EXISTS KeywordCardsKeywordIDCardIDIndex
+                ON KeywordCards (KeywordID, CardID)
+                ''')
+
 
     cur.execute('''CREATE TABLE IF NOT EXISTS Games
                 (
@@ -323,6 +402,20 @@ def create_tables():
                 ''')
 
 
+    # Bumped by convert_scryfall_to_sql.convert() whenever it commits new card data,
+    # workers use it to know when to throw away their cached card data
+    cur.execute('''CREATE TABLE IF NOT EXISTS CatalogGeneration
+                (
+                ID         INTEGER PRIMARY KEY CHECK (ID = 1),
+                Generation BIGINT  NOT NULL
+                )
+                ''')
+    cur.execute('''INSERT INTO CatalogGeneration (ID, Generation)
+                VALUES (1, 0)
+                ON CONFLICT DO NOTHING
+                ''')
+
+
     cur.execute('''CREATE TABLE IF NOT EXISTS Users
                 (
                 ID           INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
@@ -343,6 +436,12 @@ def create_tables():
                 )
                 ''')
 
+    # Lets the expired token sweep find rows without a full scan
+    cur.execute('''CREATE INDEX IF NOT EXISTS APITokensValidUntilIndex
+                ON APITokens (ValidUntil)
+                WHERE ValidUntil IS NOT NULL
+                ''')
+
     res = cur.execute("""
                 SELECT *
                   FROM pg_type typ
@@ -371,6 +470,10 @@ def create_tables():
                 UNIQUE(UserID, FinishCardID, Condition, Signed, Altered, Notes)
                 )
                 ''')
-    con.commit()
-    cur.execute('SELECT pg_advisory_unlock(0)')
-    con.close()
+
+    # Collection searches filter on UserID and then join through FinishCards.
+    # The UNIQUE index above also starts with UserID, but it carries Notes which makes it much wider
+    cur.execute('''CREATE INDEX IF NOT EXISTS CollectionsUserIDFinishCardIDIndex
+                ON Collections (UserID, FinishCardID)
+                INCLUDE (Quantity)
+                ''')
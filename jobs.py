@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+import psycopg, config, database, init_database, logs, logging, os, socket, sys, threading, time, traceback
+from datetime import datetime, timezone
+from psycopg.rows import dict_row
+
+# Background work, like the scryfall import, is done by jobs. A job is a row in the Jobs table (see migrations.py),
+# enqueue() adds one and runner processes (python jobs.py run, gunicorn.conf.py starts one) take them.
+# Runners claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can run and each job is only run by one.
+#
+# A claimed job is leased to its runner for JOB_LEASE_SECONDS. While the job runs a heartbeat thread renews the lease
+# and saves the job's progress every JOB_HEARTBEAT_INTERVAL seconds. If the runner dies the lease runs out
+# and another runner takes the job over. A job that raises (or whose lease runs out) is tried again after
+# JOB_RETRY_DELAY seconds, doubled each attempt, until it's been tried JOB_MAX_ATTEMPTS times and is marked failed
+
+LEASE_SECONDS = float(config.get('JOB_LEASE_SECONDS'))
+HEARTBEAT_INTERVAL = float(config.get('JOB_HEARTBEAT_INTERVAL'))
+POLL_INTERVAL = float(config.get('JOB_POLL_INTERVAL'))
+MAX_ATTEMPTS = int(config.get('JOB_MAX_ATTEMPTS'))
+RETRY_DELAY = float(config.get('JOB_RETRY_DELAY'))
+
+# Kind -> the function that does the job. It's called with a Progress to report how far along it is
+HANDLERS = {
+    'import_scryfall': init_database.import_from_scryfall
+}
+
+ENQUEUE_QUERY = '''INSERT INTO Jobs (Kind, MaxAttempts)
+                   VALUES (%s, %s)
+                   ON CONFLICT (Kind) WHERE Status IN ('queued', 'running') DO NOTHING
+                   RETURNING ID'''
+
+# Jobs whose runner died on their last attempt won't be claimed again
+EXPIRE_QUERY = '''UPDATE Jobs
+                  SET Status = 'failed', FinishedAt = now(), Error = 'The lease ran out on the last attempt'
+                  WHERE Status = 'running' AND LeaseExpiresAt < now() AND Attempts >= MaxAttempts'''
+
+# Takes the oldest job that's due, or that's running on a runner that stopped heartbeating.
+# SKIP LOCKED makes runners claiming at the same time pass over the row the other one is taking instead of waiting for it.
+# Only kinds the runner has a handler for, a runner from an older deploy leaves new kinds of job to the new one
+CLAIM_QUERY = '''UPDATE Jobs
+                 SET Status = 'running', Attempts = Attempts + 1, LeasedBy = %(runner)s,
+                     LeaseExpiresAt = now() + %(lease)s * INTERVAL '1 second',
+                     StartedAt = now(), HeartbeatAt = now(), FinishedAt = NULL,
+                     Stage = NULL, StageStartedAt = NULL, ItemsDone = 0, ItemsTotal = NULL, Progress = NULL
+                 WHERE ID = (
+                     SELECT ID FROM Jobs
+                     WHERE Kind = ANY(%(kinds)s)
+                       AND ((Status = 'queued' AND RunAfter <= now())
+                         OR (Status = 'running' AND LeaseExpiresAt < now() AND Attempts < MaxAttempts))
+                     ORDER BY RunAfter, ID
+                     LIMIT 1
+                     FOR UPDATE SKIP LOCKED
+                 )
+                 RETURNING ID, Kind, Attempts, MaxAttempts'''
+
+# All of these only touch the job while it's still leased to us,
+# if our lease ran out and another runner took it over it's theirs now
+HEARTBEAT_QUERY = '''UPDATE Jobs
+                     SET HeartbeatAt = now(), LeaseExpiresAt = now() + %(lease)s * INTERVAL '1 second',
+                         Stage = %(stage)s, StageStartedAt = %(stage_started_at)s,
+                         ItemsDone = %(done)s, ItemsTotal = %(total)s, Progress = %(progress)s
+                     WHERE ID = %(id)s AND LeasedBy = %(runner)s AND Status = 'running' '''
+
+SUCCEEDED_QUERY = '''UPDATE Jobs
+                     SET Status = 'succeeded', FinishedAt = now(), HeartbeatAt = now(), LeaseExpiresAt = NULL, Error = NULL,
+                         Stage = %(stage)s, StageStartedAt = %(stage_started_at)s,
+                         ItemsDone = %(done)s, ItemsTotal = %(total)s, Progress = 100
+                     WHERE ID = %(id)s AND LeasedBy = %(runner)s AND Status = 'running' '''
+
+FAILED_QUERY = '''UPDATE Jobs
+                  SET Status = CASE WHEN Attempts < MaxAttempts THEN 'queued' ELSE 'failed' END::JobStatus,
+                      RunAfter = now() + %(delay)s * power(2, Attempts - 1) * INTERVAL '1 second',
+                      FinishedAt = CASE WHEN Attempts < MaxAttempts THEN NULL ELSE now() END,
+                      HeartbeatAt = now(), LeaseExpiresAt = NULL, Error = %(error)s
+                  WHERE ID = %(id)s AND LeasedBy = %(runner)s AND Status = 'running'
+                  RETURNING Status'''
+
+# throughput is items per second in the job's current (or last) stage
+JOBS_QUERY = '''SELECT ID AS id, Kind AS kind, Status AS status, Attempts AS attempts, MaxAttempts AS max_attempts,
+                       Stage AS stage, Progress AS progress, ItemsDone AS items_done, ItemsTotal AS items_total,
+                       (ItemsDone / NULLIF(EXTRACT(EPOCH FROM COALESCE(FinishedAt, HeartbeatAt) - StageStartedAt), 0))::FLOAT8 AS throughput,
+                       EXTRACT(EPOCH FROM COALESCE(FinishedAt, now()) - StartedAt)::FLOAT8 AS duration_seconds,
+                       Error AS error, LeasedBy AS leased_by, LeaseExpiresAt AS lease_expires_at, RunAfter AS run_after,
+                       CreatedAt AS created_at, StartedAt AS started_at, HeartbeatAt AS heartbeat_at, FinishedAt AS finished_at
+                FROM Jobs
+                ORDER BY ID DESC
+                LIMIT %s'''
+
+# What a job reports while it runs. The job calls it as progress(stage, done, total), which only keeps the numbers,
+# the heartbeat saves them. Being called often is fine, the import calls it for every chunk it downloads
+class Progress:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage = None
+        self.stage_started_at = None
+        self.done = 0
+        self.total = None
+
+    def __call__(self, stage: str, done: int, total: int | None = None):
+        with self._lock:
+            if stage != self.stage:
+                self.stage = stage
+                self.stage_started_at = datetime.now(timezone.utc)
+            self.done = done
+            self.total = total
+
+    # The parameters of HEARTBEAT_QUERY and SUCCEEDED_QUERY
+    def params(self) -> dict:
+        with self._lock:
+            return {
+                'stage': self.stage,
+                'stage_started_at': self.stage_started_at,
+                'done': self.done,
+                'total': self.total,
+                'progress': min(100, self.done * 100 / self.total) if self.total else None
+            }
+
+class Heartbeat(threading.Thread):
+    def __init__(self, job_id: int, runner: str, progress: Progress):
+        super().__init__(name=f'job-{job_id}-heartbeat', daemon=True)
+        self.job_id = job_id
+        self.runner = runner
+        self.progress = progress
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(HEARTBEAT_INTERVAL):
+            # A new connection each time, it's only every few seconds and a dropped connection can't stop the heartbeats
+            try:
+                with database.connect() as con:
+                    res = con.execute(HEARTBEAT_QUERY, {**self.progress.params(), 'id': self.job_id, 'runner': self.runner, 'lease': LEASE_SECONDS})
+                    if res.rowcount == 0:
+                        logging.error("Job %s isn't leased to us anymore, another runner may be running it too", self.job_id)
+            except psycopg.Error as e:
+                logging.warning("Couldn't save the heartbeat of job %s: %s", self.job_id, e)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+# Returns the new job's id, or None if one of that kind is already queued or running
+def enqueue(kind: str, max_attempts: int = MAX_ATTEMPTS) -> int | None:
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind {kind}")
+
+    with database.connect() as con:
+        row = con.execute(ENQUEUE_QUERY, (kind, max_attempts)).fetchone()
+
+    return row[0] if row != None else None
+
+# How runners are shown in LeasedBy
+def get_runner_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+# Returns (id, kind, attempt, max attempts) of the job it claimed, or None if there wasn't one to claim.
+# kinds defaults to every kind in HANDLERS
+def claim(runner: str, kinds: list[str] | None = None) -> tuple | None:
+    if kinds == None:
+        kinds = list(HANDLERS)
+
+    with database.connect() as con:
+        cur = con.cursor()
+        cur.execute(EXPIRE_QUERY)
+        cur.execute(CLAIM_QUERY, {'runner': runner, 'lease': LEASE_SECONDS, 'kinds': kinds})
+        return cur.fetchone()
+
+# Claims and runs one job. Returns False if there wasn't one to run
+def run_one(runner: str, kinds: list[str] | None = None) -> bool:
+    job = claim(runner, kinds)
+    if job == None:
+        return False
+
+    job_id, kind, attempt, max_attempts = job
+    logging.info("Running job %s (%s), attempt %s of %s", job_id, kind, attempt, max_attempts)
+
+    progress = Progress()
+    heartbeat = Heartbeat(job_id, runner, progress)
+    heartbeat.start()
+    error = None
+    try:
+        HANDLERS[kind](progress)
+    except Exception:
+        logging.exception("Job %s (%s) failed", job_id, kind)
+        error = traceback.format_exc()
+    finally:
+        heartbeat.stop()
+
+    params = {**progress.params(), 'id': job_id, 'runner': runner}
+    with database.connect() as con:
+        if error == None:
+            res = con.execute(SUCCEEDED_QUERY, params)
+            status = 'succeeded' if res.rowcount == 1 else None
+        else:
+            row = con.execute(FAILED_QUERY, {**params, 'error': error, 'delay': RETRY_DELAY}).fetchone()
+            status = row[0] if row != None else None
+
+    if status == None:
+        logging.error("Job %s (%s) finished after its lease ran out, another runner may have run it too", job_id, kind)
+    else:
+        logging.info("Job %s (%s) is %s", job_id, kind, status)
+
+    return True
+
+# Runs jobs until it's killed. A runner killed in the middle of a job leaves it to be taken over once its lease runs out
+def run(runner: str | None = None):
+    if runner == None:
+        runner = get_runner_name()
+
+    logging.info("Job runner %s started", runner)
+    while True:
+        try:
+            ran = run_one(runner)
+        except psycopg.Error as e:
+            logging.warning("Job runner couldn't reach the database: %s", e)
+            ran = False
+
+        if not ran:
+            time.sleep(POLL_INTERVAL)
+
+# The newest jobs first, for /api/admin/jobs
+def get_jobs(con: psycopg.Connection, limit: int = 20) -> list[dict]:
+    cur = con.cursor(row_factory=dict_row)
+    cur.execute(JOBS_QUERY, (limit,))
+    return cur.fetchall()
+
+if __name__ == '__main__':
+    logs.setup()
+
+    if len(sys.argv) == 2 and sys.argv[1] == 'run':
+        run()
+    elif len(sys.argv) == 3 and sys.argv[1] == 'enqueue':
+        job_id = enqueue(sys.argv[2])
+        if job_id == None:
+            print(f"A {sys.argv[2]} job is already queued or running")
+        else:
+            print(f"Queued job {job_id}")
+    else:
+        print("Usage: jobs.py run | jobs.py enqueue <kind>")
+        exit(1)
@@ -0,0 +1,145 @@
+import atexit, config, contextvars, json, logging, logging.handlers, os, queue, random, re, sys, uuid
+from datetime import datetime, timezone
+
+# Log records are put on a queue by whoever logs them and formatted and written to stderr
+# by a listener thread, so a request never waits on formatting or on the write.
+# Use %s style arguments (logging.info("Loaded %s cards", count)) instead of f-strings,
+# the message is only built if and when the listener writes it.
+#
+# LOG_FORMAT=json writes one JSON object per line with the request id and, for the access log, the latency.
+# Each request gets one access log line (see log_access()), only ACCESS_LOG_SAMPLE_RATE of the
+# successful ones are kept. Errors, client errors and slow requests are always kept
+
+TEXT_FORMAT = '[%(asctime)s] <pid:%(process)d> {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
+
+# Logged with the access log line and written as their own keys in JSON
+ACCESS_FIELDS = ['method', 'path', 'route', 'status', 'duration_ms', 'db_ms', 'db_queries', 'remote_addr']
+
+access_logger = logging.getLogger('umori.access')
+
+# The id of the request being handled. Set by start_request(), read by RequestIdFilter
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+# What we accept from a X-Request-ID header set by a proxy in front of us
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+_queue = None
+_queue_handler = None
+_listener = None
+
+# Runs on the thread doing the logging, which is the only place the request's context variables can be read
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+# Also runs on the thread doing the logging, so dropped lines never reach the queue
+class AccessLogSampler(logging.Filter):
+    def __init__(self, sample_rate: float, slow_ms: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'status', 200) >= 400 or getattr(record, 'duration_ms', 0) >= self.slow_ms:
+            return True
+        return random.random() < self.sample_rate
+
+# The standard QueueHandler formats the message before queueing it so the record can be pickled.
+# Our listener is a thread in the same process, so we leave that to the listener
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        obj = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'file': record.filename,
+            'line': record.lineno,
+            'request_id': getattr(record, 'request_id', None)
+        }
+        for field in ACCESS_FIELDS:
+            if hasattr(record, field):
+                obj[field] = getattr(record, field)
+        if record.exc_info:
+            obj['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(obj, default=str)
+
+def get_formatter() -> logging.Formatter:
+    name = config.get('LOG_FORMAT')
+    if name == 'json':
+        return JSONFormatter()
+    elif name == 'text':
+        return logging.Formatter(TEXT_FORMAT)
+    else:
+        print(f"Unknown LOG_FORMAT {name}, expected text or json")
+        exit(1)
+
+def _start_listener():
+    global _queue, _listener
+
+    _queue = queue.SimpleQueue()
+    _queue_handler.queue = _queue
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(get_formatter())
+    _listener = logging.handlers.QueueListener(_queue, stream_handler)
+    _listener.start()
+
+def _stop_listener():
+    if _listener != None:
+        # Writes whatever is still queued
+        _listener.stop()
+
+# Sets up the root logger, call it once before logging anything.
+# Calling it again does nothing
+def setup(level: int = logging.INFO):
+    global _queue_handler
+
+    if _queue_handler != None:
+        return
+
+    _queue_handler = LazyQueueHandler(None)
+    _queue_handler.addFilter(RequestIdFilter())
+    _start_listener()
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(level)
+
+    access_logger.addFilter(AccessLogSampler(float(config.get('ACCESS_LOG_SAMPLE_RATE')), float(config.get('ACCESS_LOG_SLOW_MS'))))
+
+    atexit.register(_stop_listener)
+    # A forked child (a gunicorn worker, forked from the arbiter) doesn't get the listener thread, so it needs its own
+    os.register_at_fork(after_in_child=_start_listener)
+
+# Call at the start of a request. Uses the X-Request-ID of a proxy in front of us if it sent one.
+# Returns the request id so it can be sent back in the response
+def start_request(header_request_id: str | None) -> str:
+    if header_request_id != None and REQUEST_ID_RE.match(header_request_id):
+        request_id = header_request_id
+    else:
+        request_id = uuid.uuid4().hex
+    _request_id.set(request_id)
+    return request_id
+
+# One line per request, call it when the request is done
+def log_access(method: str, path: str, route: str, status: int, duration: float, db_seconds: float, db_queries: int, remote_addr: str | None):
+    duration_ms = round(duration * 1000, 3)
+    access_logger.info('%s %s %s %.1f ms', method, path, status, duration_ms, extra={
+        'method': method,
+        'path': path,
+        'route': route,
+        'status': status,
+        'duration_ms': duration_ms,
+        'db_ms': round(db_seconds * 1000, 3),
+        'db_queries': db_queries,
+        'remote_addr': remote_addr
+    })
+    _request_id.set(None)
@@ -1,54 +1,79 @@
-from flask import Flask, request, url_for, redirect, abort, render_template_string, flash
+from flask import Flask, request, url_for, redirect, abort, render_template, render_template_string, flash, session, Response, make_response, stream_with_context, g
 from urllib.parse import urlparse, urljoin
 from flask_login import LoginManager, login_required, login_user, logout_user
-import json, sqlite3, psycopg
+import sqlite3, psycopg
 import hashlib, binascii
+import uuid
 import flask_login
 import secrets
-import config, init_database
-import multiprocessing, os
+import config, logs, init_database, migrations, database, cache, assets, encoder, queries, search, pagination, metrics, slow_queries, jobs, passwords
+import os
+import functools
 import logging
 from datetime import datetime
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+from jinja2 import ChoiceLoader, FileSystemLoader
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] <pid:%(process)d> {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
-)
+logs.setup()
 
 login_manager = LoginManager()
 
-app = Flask(__name__)
+# We serve static/ ourselves so we can fingerprint and precompress it, see static_asset()
+app = Flask(__name__, static_folder=None)
 login_manager.init_app(app)
 
 HASH_FUNCTION = 'SHA3-512'
 app.config['SECRET_KEY'] = config.get('SECRET_KEY')
+app.config['TEMPLATES_AUTO_RELOAD'] = config.get('TEMPLATES_AUTO_RELOAD') == 'true'
+
+# Pages live in html/ and the pieces they include live in templates/
+app.jinja_loader = ChoiceLoader([
+    FileSystemLoader(os.path.join(app.root_path, 'html')),
+    FileSystemLoader(os.path.join(app.root_path, 'templates'))
+])
+
+PAGE_TEMPLATES = ['signup.html', 'login.html', 'collection.html', 'collection_add.html', 'generate_token.html']
+
+# Compile everything up front so the first request for each page doesn't pay for it.
+# Jinja keeps the compiled templates and (unless TEMPLATES_AUTO_RELOAD is on) never looks at the files again
+for template_name in PAGE_TEMPLATES:
+    app.jinja_env.get_template(template_name)
+
+asset_manifest = assets.AssetManifest(os.path.join(app.root_path, 'static'))
+
+# Lets templates use {{ asset_url('css/common.css') }} to get the fingerprinted URL
+@app.context_processor
+def inject_asset_url():
+    return {'asset_url': asset_manifest.url}
+
+# Times every request for /metrics and the access log. Routes are labeled with their pattern (/<username>/collection)
+# so there's one series per route, requests that don't match one are labeled unmatched
+@app.before_request
+def start_request_timer():
+    g.request_id = logs.start_request(request.headers.get('X-Request-ID'))
+    route = request.url_rule.rule if request.url_rule != None else 'unmatched'
+    g.request_timer = metrics.RequestTimer(request.method, route)
+
+@app.after_request
+def record_request_status(response: Response):
+    g.request_status = response.status_code
+    response.headers['X-Request-ID'] = g.request_id
+    return response
+
+# Runs after after_request, or instead of it when the view raised
+@app.teardown_request
+def finish_request_timer(exc):
+    timer = g.pop('request_timer', None)
+    if timer != None:
+        status = g.pop('request_status', 500)
+        duration = timer.finish(status)
+        database.record_pool_metrics()
+        logs.log_access(request.method, request.path, timer.route, status, duration, timer.db.seconds, timer.db.queries, request.remote_addr)
 
 def get_database_connection():
-    con = psycopg.connect(user = config.get('DB_USER'), password = config.get('DB_PASSWORD'), host = config.get('DB_HOST'), port = config.get('DB_PORT'))
-    return con
+    return database.get_database_connection()
 
-ph = PasswordHasher()
-
-logging.info("Creating tables")
-init_database.create_tables()
-
-# TODO: Seems like the right way to have only one
-# worker do something is to use a message broker
-try:
-    os.mkdir('import_lock')
-    with get_database_connection() as con:
-        cur = con.cursor()
-
-        # We start a new process because gunicorn kills
-        # workers if they don't respond for a while
-        # and importing the database takes forever
-        logging.info("Starting import process")
-        p = multiprocessing.Process(target=init_database.import_from_scryfall)
-        p.start()
-except FileExistsError:
-    pass
+# The migrations are run once per deploy (see migrations.py), each worker only checks they have been
+migrations.check_version()
 
 class User:
     def __init__(self, id, username):
@@ -66,6 +91,15 @@ login_manager.login_view = "login"
 
 PAGE_SIZE = 25
 
+# Rendered pages that don't have any per-user data in them
+rendered_page_cache = cache.LRUCache('rendered_pages', 64, catalog=False)
+
+card_cache = cache.LRUCache('cards', int(config.get('CARD_CACHE_SIZE')))
+languages_cache = cache.LRUCache('languages', int(config.get('CARD_CACHE_SIZE')))
+dimensions = cache.DimensionCache('dimensions')
+# Maps token hash -> (user id, valid until)
+api_token_cache = cache.LRUCache('api_tokens', int(config.get('API_TOKEN_CACHE_SIZE')), ttl=float(config.get('API_TOKEN_CACHE_TTL')), catalog=False, tokens=True)
+
 # Ensures the url isn't leaving our site
 # Good for making sure redirects are safe
 def is_safe_url(target):
@@ -74,14 +108,61 @@ def is_safe_url(target):
     return test_url.scheme in ('http', 'https') and \
            ref_url.netloc == test_url.netloc
 
+# For pages that only change based on whether you're logged in and the path (footer.html uses both).
+# Flashed messages are the only other thing these pages show, so if there are any we render normally
+def render_static_page(template_name: str):
+    if app.config['TEMPLATES_AUTO_RELOAD'] or session.get('_flashes'):
+        return render_template(template_name)
+
+    key = (template_name, request.path, flask_login.current_user.is_anonymous)
+    page = rendered_page_cache.get(key)
+    if page == None:
+        page = render_template(template_name).encode()
+        rendered_page_cache.put(key, page)
+
+    return Response(page, mimetype='text/html')
+
+# Responses from catalog routes only depend on the request and the catalog generation,
+# so that's what the ETag is made from. args is a list of (key, value) pairs
+def catalog_etag(generation: int, method: str, path: str, args: list[tuple[str, str]], body: bytes) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(f"{generation}\0{method}\0{path}\0".encode())
+    # Sorted so the same parameters in a different order share an ETag
+    for key, value in sorted(args):
+        hasher.update(f"{key}={value}\0".encode())
+    hasher.update(body)
+    return hasher.hexdigest()
+
+# For routes that only return card data. If the client already has this
+# version we answer 304 without running the route (or touching the database much)
+def catalog_response(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = cache.check_catalog_generation()
+        etag = catalog_etag(generation, request.method, request.path, list(request.args.items(multi=True)), request.get_data())
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f"public, max-age={config.get('CATALOG_MAX_AGE')}"
+        return response
+
+    return wrapper
+
+# Runs for every request with a session
+USERNAME_BY_ID_QUERY = queries.register('username_by_id', '''SELECT Username FROM Users
+                                                        WHERE ID = %s
+                                                        ''')
+
 @login_manager.user_loader
 def load_user(user_id):
     with get_database_connection() as con:
         cur = con.cursor()
 
-        res = cur.execute('''SELECT Username FROM Users
-                          WHERE ID = %s
-                          ''', (user_id,))
+        res = USERNAME_BY_ID_QUERY.execute(cur, (user_id,))
 
         row = res.fetchone()
         if row == None:
@@ -92,6 +173,41 @@ def load_user(user_id):
         user = User(user_id, username)
         return user
 
+@app.route("/static/<path:filename>")
+def static_asset(filename):
+    asset = asset_manifest.get(filename)
+    if asset == None:
+        return abort(404)
+
+    # The fingerprinted name changes whenever the content does, so it can be cached forever.
+    # The plain name is still served for anything that doesn't use asset_url(), but has to be revalidated
+    if filename == asset.fingerprinted_path:
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = 'no-cache'
+
+    encoding = None
+    for candidate in ['br', 'gzip']:
+        if candidate in asset.encodings and request.accept_encodings.quality(candidate) > 0:
+            encoding = candidate
+            break
+
+    # Each encoding is a different body so it needs a different ETag
+    etag = asset.etag if encoding == None else f"{asset.etag}-{encoding}"
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif encoding == None:
+        response = Response(asset.content, mimetype=asset.mimetype)
+    else:
+        response = Response(asset.encodings[encoding], mimetype=asset.mimetype)
+        response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 @app.route("/")
 def index():
     return '''
@@ -103,18 +219,26 @@ def index():
 </style>
 <div class="grid"></div>'''
 
+# Pulls the token out of an "Authorization: Bearer <token>" header
+def parse_authorization_header(auth_header: str) -> tuple[str, None] | tuple[None, dict]:
+    header_parts = auth_header.split(' ')
+    invalid_format_error = {'successful': False, 'error': f"Authorization header not formatted correctly. Expected \"Bearer <token>\""}
+
+    if len(header_parts) != 2:
+        return None, invalid_format_error
+
+    bearer, token = header_parts
+    if bearer != 'Bearer':
+        return None, invalid_format_error
+
+    return token, None
+
 def get_user_id(cur: psycopg.Cursor) -> tuple[int, None] | tuple[None, dict]:
     auth_header = request.headers.get('Authorization')
     if auth_header:
-        header_parts = auth_header.split(' ')
-        invalid_format_error = {'successful': False, 'error': f"Authorization header not formatted correctly. Expected \"Bearer <token>\""}
-
-        if len(header_parts) != 2:
-            return None, invalid_format_error
-
-        bearer, token = header_parts
-        if bearer != 'Bearer':
-            return None, invalid_format_error
+        token, error = parse_authorization_header(auth_header)
+        if error:
+            return None, error
 
         user_id, error = get_user_id_from_token(cur, token)
         if error:
@@ -127,9 +251,25 @@ def get_user_id(cur: psycopg.Cursor) -> tuple[int, None] | tuple[None, dict]:
 
     return user_id, None
 
+# For the /api/admin/* routes, the user has to be one of ADMIN_USERNAMES
+def get_admin_user_id(cur: psycopg.Cursor) -> tuple[int, None] | tuple[None, dict]:
+    user_id, error = get_user_id(cur)
+    if error:
+        return None, error
+
+    res = USERNAME_BY_ID_QUERY.execute(cur, (user_id,))
+    row = res.fetchone()
+    if row == None or row[0] not in config.get_list('ADMIN_USERNAMES'):
+        error = {'successful': False, 'error': "You are not authorized to access this page."}
+        return None, error
+
+    return user_id, None
+
+USER_ID_BY_USERNAME_QUERY = queries.register('user_id_by_username', '''SELECT ID FROM Users
+                                                                  WHERE Username = %s''')
+
 def get_user_id_by_username(username: str, cur: psycopg.Cursor):
-    res = cur.execute('''SELECT ID FROM Users
-                      WHERE Username = %s''', (username, ))
+    res = USER_ID_BY_USERNAME_QUERY.execute(cur, (username, ))
 
     row = res.fetchone()
     if row == None:
@@ -141,27 +281,9 @@ class NotFoundException(Exception):
     pass
 
 class Card:
-    def __init__(self, cur: psycopg.Cursor, scryfall_id: str):
+    # rows are the results of CARDS_QUERY for this card (without the leading ID column)
+    def __init__(self, scryfall_id: str, rows: list[tuple]):
         self.scryfall_id = scryfall_id
-        # The ORDER BY is a quick and dirty way to make sure that we get the front image first.
-        # This works because the URI follows the format
-        # https://cards.scryfall.io/normal/<front or back>/...
-        # So we just sort it so front is first
-        # TODO: Make this less jank (might require adding which face is which when converting the JSON)
-        res = cur.execute('''
-                      SELECT Cards.Name, Finishes.Finish, Cards.CollectorNumber, Sets.Code, Cards.NormalImageURI, Faces.NormalImageURI, Langs.Lang FROM Cards
-                      INNER JOIN FinishCards ON FinishCards.CardID = Cards.ID
-                      INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
-                      LEFT  JOIN Faces ON Faces.CardID = Cards.ID
-                      INNER JOIN Sets ON Sets.ID = Cards.SetID
-                      INNER JOIN Langs ON Langs.ID = Cards.LangID
-                      WHERE Cards.ID = %s
-                      ORDER BY Faces.NormalImageURI DESC
-                      ''', (scryfall_id,))
-
-        rows = res.fetchall()
-        if len(rows) == 0:
-            raise NotFoundException("Couldn't find card with ID \"{scryfall_id}\"")
 
         # We use set() to dedupe because order doesn't matter
         self.finishes = list(set(row[1] for row in rows))
@@ -209,59 +331,334 @@ class Card:
         }
         return return_card
 
-def get_user_id_from_token(cur: psycopg.Cursor, token: str) -> tuple[int, None] | tuple[None, dict]:
+# The ORDER BY is a quick and dirty way to make sure that we get the front image first.
+# This works because the URI follows the format
+# https://cards.scryfall.io/normal/<front or back>/...
+# So we just sort it so front is first
+# TODO: Make this less jank (might require adding which face is which when converting the JSON)
+CARDS_QUERY = queries.register('cards', '''
+              SELECT Cards.ID, Cards.Name, Finishes.Finish, Cards.CollectorNumber, Sets.Code, Cards.NormalImageURI, Faces.NormalImageURI, Langs.Lang FROM Cards
+              INNER JOIN FinishCards ON FinishCards.CardID = Cards.ID
+              INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
+              LEFT  JOIN Faces ON Faces.CardID = Cards.ID
+              INNER JOIN Sets ON Sets.ID = Cards.SetID
+              INNER JOIN Langs ON Langs.ID = Cards.LangID
+              WHERE Cards.ID = ANY(%s)
+              ORDER BY Faces.NormalImageURI DESC
+              ''')
+
+# Loads all the cards in one query.
+# Returns the cards in the same order as scryfall_ids (duplicates included)
+# and a list of the ids that aren't valid or aren't in the database
+def get_cards(cur: psycopg.Cursor, scryfall_ids: list[str]) -> tuple[list[Card], list[str]]:
+    cache.check_catalog_generation(cur)
+
+    parsed_ids, cards_by_id, uncached_ids = get_cached_cards(scryfall_ids)
+    if len(uncached_ids) > 0:
+        res = CARDS_QUERY.execute(cur, (uncached_ids,))
+        cache_card_rows(res.fetchall(), cards_by_id)
+
+    return order_cards(scryfall_ids, parsed_ids, cards_by_id)
+
+# The parts of get_cards() that don't touch the database, shared with asgi.py.
+# Returns the parsed ids, the cards we already have by id and the ids CARDS_QUERY still needs to load
+def get_cached_cards(scryfall_ids: list[str]) -> tuple[list[uuid.UUID | None], dict[uuid.UUID, Card], list[uuid.UUID]]:
+    parsed_ids = []
+    for scryfall_id in scryfall_ids:
+        try:
+            parsed_ids.append(uuid.UUID(scryfall_id))
+        except (ValueError, TypeError, AttributeError):
+            # Not a UUID so it can't be in the database
+            parsed_ids.append(None)
+
+    cards_by_id = {}
+    uncached_ids = set()
+    for parsed_id in parsed_ids:
+        if parsed_id == None or parsed_id in cards_by_id:
+            continue
+        card = card_cache.get(parsed_id)
+        if card == None:
+            uncached_ids.add(parsed_id)
+        else:
+            cards_by_id[parsed_id] = card
+
+    return parsed_ids, cards_by_id, list(uncached_ids)
+
+# Builds Cards from the rows of CARDS_QUERY, caching them and adding them to cards_by_id
+def cache_card_rows(rows: list[tuple], cards_by_id: dict[uuid.UUID, Card]):
+    rows_by_id = {}
+    # Appending keeps the ORDER BY so each card still gets its front face first
+    for row in rows:
+        rows_by_id.setdefault(row[0], []).append(row[1:])
+
+    for parsed_id, card_rows in rows_by_id.items():
+        card = Card(str(parsed_id), card_rows)
+        card_cache.put(parsed_id, card)
+        cards_by_id[parsed_id] = card
+
+def order_cards(scryfall_ids: list[str], parsed_ids: list[uuid.UUID | None], cards_by_id: dict[uuid.UUID, Card]) -> tuple[list[Card], list[str]]:
+    cards = []
+    not_found = []
+    for scryfall_id, parsed_id in zip(scryfall_ids, parsed_ids):
+        card = cards_by_id.get(parsed_id)
+        if card == None:
+            not_found.append(scryfall_id)
+        else:
+            cards.append(card)
+
+    return cards, not_found
+
+def get_card(cur: psycopg.Cursor, scryfall_id: str) -> Card:
+    cards, not_found = get_cards(cur, [scryfall_id])
+    if len(not_found) > 0:
+        raise NotFoundException(f"Couldn't find card with ID \"{scryfall_id}\"")
+
+    return cards[0]
+
+def hash_token(token_bytes: bytes) -> bytes:
     hasher = hashlib.new(HASH_FUNCTION)
-    hasher.update(binascii.unhexlify(token))
-    hashed_token_bytes = hasher.digest()
+    hasher.update(token_bytes)
+    return hasher.digest()
+
+API_TOKEN_QUERY = queries.register('api_token', '''SELECT Users.ID, APITokens.ValidUntil FROM Users
+                                               INNER JOIN APITokens ON APITokens.UserID = Users.ID
+                                               WHERE APITokens.TokenHash = %s''')
+
+def get_user_id_from_token(cur: psycopg.Cursor, token: str) -> tuple[int, None] | tuple[None, dict]:
+    hashed_token_bytes = hash_token(binascii.unhexlify(token))
 
-    cur.execute('''SELECT Users.ID, APITokens.ValidUntil FROM Users
-                   INNER JOIN APITokens ON APITokens.UserID = Users.ID
-                   WHERE APITokens.TokenHash = %s''', (hashed_token_bytes, ))
+    # Clears the cache if a token was revoked through another worker
+    cache.check_token_generation(cur)
 
-    row = cur.fetchone()
+    # Only valid tokens are cached so guessing tokens can't fill the cache
+    row = api_token_cache.get(hashed_token_bytes)
     if row == None:
-        error = {'successful': False, 'error': "Token is invalid"}
-        return None, error
+        API_TOKEN_QUERY.execute(cur, (hashed_token_bytes, ))
 
+        row = cur.fetchone()
+        if row == None:
+            error = {'successful': False, 'error': "Token is invalid"}
+            return None, error
+
+        api_token_cache.put(hashed_token_bytes, row)
+
+    return check_token_row(row)
+
+# row is (user ID, valid until) from API_TOKEN_QUERY
+def check_token_row(row: tuple) -> tuple[int, None] | tuple[None, dict]:
     user_id, valid_until = row
 
     # If valid_until is None then the token never expires
+    # We check this even on a cache hit so tokens stop working the moment they expire
     if valid_until != None and valid_until < datetime.now().astimezone():
         error = {'successful': False, 'error': 'That token has expired'}
         return None, error
 
     return user_id, None
 
-def api_collection_search(cur: psycopg.Cursor, search_text: str, page: int, user_id):
-    cards = []
+# Deletes tokens that have expired so APITokens only holds tokens that can still be used.
+# This uses the APITokensValidUntilIndex index so it doesn't need to scan the table
+def sweep_expired_tokens(cur: psycopg.Cursor):
+    cur.execute('''DELETE FROM APITokens
+                WHERE ValidUntil < NOW()
+                ''')
+
+COLLECTION_STREAM_QUERY = '''SELECT colls.ID, cards.ID, finishes.Finish, colls.Condition, langs.Lang, colls.Signed, colls.Altered, colls.Notes, colls.Quantity FROM Collections colls
+                          INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
+                          INNER JOIN Cards cards ON finishCards.CardID = cards.ID
+                          INNER JOIN Finishes finishes ON finishCards.FinishID = finishes.ID
+                          INNER JOIN Langs langs ON cards.langID = langs.ID
+                          WHERE colls.UserID = %s AND STRPOS(LOWER(cards.Name), LOWER(%s)) > 0
+                          ORDER BY cards.Name, cards.ReleasedAt DESC, colls.ID
+                          '''
+
+# Streams the whole (filtered) collection as a JSON array of the same objects api_collection_search pages over.
+# The rows come from a server side cursor so neither we nor postgres hold the whole result in memory
+def api_collection_stream(search_text: str, user_id):
+    def generate():
+        # The route's connection goes back to the pool when it returns,
+        # so the stream borrows its own for as long as it's running
+        with get_database_connection() as con:
+            # Naming the cursor makes it a server side cursor
+            cur = con.cursor(name='collection_stream')
+            cur.itersize = 1000
+            cur.execute(COLLECTION_STREAM_QUERY, (user_id, search_text))
+
+            yield from encoder.stream_array(collection_card_dict(row) for row in cur)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# STRPOS instead of LIKE so characters like % and _ in the search text aren't treated as wildcards.
+# COUNT(*) OVER () is computed before LIMIT/OFFSET so every row carries the total number of matches
+COLLECTION_SEARCH_QUERY = queries.register('collection_search', '''SELECT colls.ID, cards.ID, finishes.Finish, colls.Condition, langs.Lang, colls.Signed, colls.Altered, colls.Notes, colls.Quantity, cards.Name, cards.ReleasedAt, COUNT(*) OVER () FROM Collections colls
+                          INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
+                          INNER JOIN Cards cards ON finishCards.CardID = cards.ID
+                          INNER JOIN Finishes finishes ON finishCards.FinishID = finishes.ID
+                          INNER JOIN Langs langs ON cards.langID = langs.ID
+                          WHERE colls.UserID = %(user_id)s AND STRPOS(LOWER(cards.Name), LOWER(%(text)s)) > 0
+                          ORDER BY cards.Name, cards.ReleasedAt DESC, colls.ID
+                          LIMIT %(limit)s OFFSET %(offset)s
+                          ''')
+
+# The page after a cursor, see pagination.py
+COLLECTION_KEYSET_QUERY = queries.register('collection_keyset', f'''SELECT colls.ID, cards.ID, finishes.Finish, colls.Condition, langs.Lang, colls.Signed, colls.Altered, colls.Notes, colls.Quantity, cards.Name, cards.ReleasedAt FROM Collections colls
+                          INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
+                          INNER JOIN Cards cards ON finishCards.CardID = cards.ID
+                          INNER JOIN Finishes finishes ON finishCards.FinishID = finishes.ID
+                          INNER JOIN Langs langs ON cards.langID = langs.ID
+                          WHERE colls.UserID = %(user_id)s AND STRPOS(LOWER(cards.Name), LOWER(%(text)s)) > 0
+                          AND {pagination.keyset_filter('cards.Name', 'cards.ReleasedAt', 'colls.ID')}
+                          ORDER BY cards.Name, cards.ReleasedAt DESC, colls.ID
+                          LIMIT %(limit)s
+                          ''')
+
+# Past the last page there are no rows to carry the window count,
+# but we still need to report the total so the page nav works
+COLLECTION_COUNT_QUERY = queries.register('collection_count', '''SELECT COUNT(*) FROM Collections colls
+                         INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
+                         INNER JOIN Cards cards ON finishCards.CardID = cards.ID
+                         WHERE colls.UserID = %(user_id)s AND STRPOS(LOWER(cards.Name), LOWER(%(text)s)) > 0
+                         ''')
+
+# Turns a row of COLLECTION_SEARCH_QUERY (or the stream query) into what the API returns
+def collection_card_dict(row: tuple) -> dict:
+    collection_id, scryfall_id, finish, condition, language, signed, altered, notes, quantity = row[:9]
+    return {'collection_id': collection_id, 'scryfall_id': scryfall_id, 'finish': finish, 'quantity': quantity,
+            'condition': condition, 'language': language, 'signed': signed,
+            'altered': altered, 'notes': notes}
+
+# The cursor for the page after a row of COLLECTION_SEARCH_QUERY or COLLECTION_KEYSET_QUERY
+def collection_cursor(row: tuple) -> str:
+    return pagination.encode_cursor(row[9], row[10], row[0])
+
+# Returns the query and parameters for a page of the collection search.
+# With a cursor we get the page after it, otherwise the page'th page
+def collection_search_query(search_text: str, page: int, cursor: str | None, user_id) -> tuple[queries.PreparedQuery, dict]:
+    params = {'user_id': user_id, 'text': search_text}
+
+    if cursor != None:
+        params.update(pagination.decode_cursor(cursor, int))
+        # One more than a page so we know if there's another one after it
+        params['limit'] = PAGE_SIZE + 1
+        return COLLECTION_KEYSET_QUERY, params
+
+    params.update(limit=PAGE_SIZE, offset=page * PAGE_SIZE)
+    return COLLECTION_SEARCH_QUERY, params
+
+# The cursor for the page after a page fetched by number, or None if it's the last one.
+# Clients can start with page=0 and follow next_cursor from there
+def page_next_cursor(rows: list[tuple], page: int, length: int, cursor_of) -> str | None:
+    if len(rows) > 0 and page * PAGE_SIZE + len(rows) < length:
+        return cursor_of(rows[-1])
+    return None
+
+def api_collection_search(cur: psycopg.Cursor, search_text: str, page: int, user_id, stream: bool = False, cursor: str | None = None):
+    if stream:
+        return api_collection_stream(search_text, user_id)
+
+    try:
+        search_query, params = collection_search_query(search_text, page, cursor, user_id)
+    except pagination.InvalidCursorError as e:
+        return encoder.dumps({'successful': False, 'error': str(e)})
+
+    res = search_query.execute(cur, params)
+    results = res.fetchall()
+
+    # Counting every match would mean looking at what came before the cursor,
+    # so the cursor path doesn't return a length
+    if cursor != None:
+        results, next_cursor = pagination.split_page(results, PAGE_SIZE, collection_cursor)
+        cards = [collection_card_dict(row) for row in results]
+        return encoder.dumps({'successful': True, 'cards': cards, 'next_cursor': next_cursor})
+
+    cards = [collection_card_dict(row) for row in results]
 
-    res = cur.execute('''SELECT colls.ID, cards.ID, cards.Name, finishes.Finish, colls.Condition, langs.Lang, colls.Signed, colls.Altered, colls.Notes, colls.Quantity FROM Collections colls
-                      INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
-                      INNER JOIN Cards cards ON finishCards.CardID = cards.ID
-                      INNER JOIN Finishes finishes ON finishCards.FinishID = finishes.ID
-                      INNER JOIN Langs langs ON cards.langID = langs.ID
-                      WHERE colls.UserID = %s
-                      ORDER BY cards.Name, cards.ReleasedAt DESC
-                      ''', (user_id,))
+    if len(results) > 0:
+        length = results[0][11]
+    elif page > 0:
+        res = COLLECTION_COUNT_QUERY.execute(cur, params)
+        length = res.fetchone()[0]
+    else:
+        length = 0
+
+    next_cursor = page_next_cursor(results, page, length, collection_cursor)
+    return encoder.dumps({'successful': True, 'cards': cards, 'length': length, 'next_cursor': next_cursor})
+
+# query=fulltext on the collection. A collection is small enough that checking
+# each of its cards against the search is cheaper than finding every match in the catalog first.
+# A card's rank is its best match across the card and its faces
+COLLECTION_FULL_TEXT_QUERY = queries.register('collection_full_text', f'''SELECT colls.ID, cards.ID, finishes.Finish, colls.Condition, langs.Lang, colls.Signed, colls.Altered, colls.Notes, colls.Quantity, COUNT(*) OVER () FROM Collections colls
+                             INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
+                             INNER JOIN Cards cards ON finishCards.CardID = cards.ID
+                             INNER JOIN Finishes finishes ON finishCards.FinishID = finishes.ID
+                             INNER JOIN Langs langs ON cards.langID = langs.ID
+                             CROSS JOIN websearch_to_tsquery('{init_database.SEARCH_CONFIG}', %(text)s) query
+                             CROSS JOIN LATERAL (SELECT MAX(ts_rank_cd(faces.SearchVector, query)) AS Rank FROM Faces faces
+                                                 WHERE faces.CardID = cards.ID AND faces.SearchVector @@ query) faceMatches
+                             WHERE colls.UserID = %(user_id)s AND (cards.SearchVector @@ query OR faceMatches.Rank IS NOT NULL)
+                             ORDER BY GREATEST(ts_rank_cd(cards.SearchVector, query), faceMatches.Rank) DESC, cards.Name, cards.ReleasedAt DESC, colls.ID
+                             LIMIT %(limit)s OFFSET %(offset)s
+                             ''')
+
+COLLECTION_FULL_TEXT_COUNT_QUERY = queries.register('collection_full_text_count', f'''SELECT COUNT(*) FROM Collections colls
+                                   INNER JOIN FinishCards finishCards ON colls.FinishCardID = finishCards.ID
+                                   INNER JOIN Cards cards ON finishCards.CardID = cards.ID
+                                   CROSS JOIN websearch_to_tsquery('{init_database.SEARCH_CONFIG}', %(text)s) query
+                                   WHERE colls.UserID = %(user_id)s AND (cards.SearchVector @@ query OR EXISTS (SELECT 1 FROM Faces faces
+                                                                                                            WHERE faces.CardID = cards.ID AND faces.SearchVector @@ query))
+                                   ''')
+
+def api_collection_full_text_search(cur: psycopg.Cursor, search_text: str, page: int, user_id):
+    params = {'text': search_text, 'user_id': user_id, 'limit': PAGE_SIZE, 'offset': page * PAGE_SIZE}
+    res = COLLECTION_FULL_TEXT_QUERY.execute(cur, params)
     results = res.fetchall()
 
-    for collection_id, scryfall_id, name, finish, condition, language, signed, altered, notes, quantity in results:
-        if search_text.lower() in name.lower():
-            cards.append({'collection_id': collection_id, 'scryfall_id': str(scryfall_id), 'finish': finish, 'quantity': quantity,
-                          'condition': condition, 'language': language, 'signed': signed,
-                          'altered': altered, 'notes': notes})
+    cards = [collection_card_dict(row) for row in results]
 
-    length = len(cards)
+    if len(results) > 0:
+        length = results[0][9]
+    elif page > 0:
+        res = COLLECTION_FULL_TEXT_COUNT_QUERY.execute(cur, params)
+        length = res.fetchone()[0]
+    else:
+        length = 0
+
+    return encoder.dumps({'successful': True, 'cards': cards, 'length': length})
+
+# The printings of a card in other languages share its set and collector number.
+# The join is answered by the UNIQUE(SetID, CollectorNumber, LangID) index on Cards,
+# so it's one primary key lookup and one index range scan
+LANGUAGES_QUERY = queries.register('languages', '''SELECT siblings.ID, siblings.DefaultLang, Langs.Lang FROM Cards card
+                                               INNER JOIN Cards siblings ON siblings.SetID = card.SetID AND siblings.CollectorNumber = card.CollectorNumber
+                                               INNER JOIN Langs ON siblings.LangID = Langs.ID
+                                               WHERE card.ID = %s''')
+
+# LANGUAGES_QUERY for many cards at once, each row starts with the card it's a language of
+LANGUAGES_MANY_QUERY = queries.register('languages_many', '''SELECT card.ID, siblings.ID, siblings.DefaultLang, Langs.Lang FROM Cards card
+                                                         INNER JOIN Cards siblings ON siblings.SetID = card.SetID AND siblings.CollectorNumber = card.CollectorNumber
+                                                         INNER JOIN Langs ON siblings.LangID = Langs.ID
+                                                         WHERE card.ID = ANY(%s)''')
+
+def language_dicts(rows: list[tuple]) -> list[dict]:
+    languages = []
+
+    for row in rows:
+        id_ = row[0]
+        default = row[1]
+        lang = row[2]
+        obj = {
+                'scryfall_id': id_,
+                'default': bool(default),
+                'lang': lang
+                }
 
-    start = PAGE_SIZE * page
-    end = start + PAGE_SIZE
-    cards = cards[start:end]
+        languages.append(obj)
 
-    return json.dumps({'successful': True, 'cards': cards, 'length': length})
+    return languages
 
 @app.route("/api/all_cards/languages")
+@catalog_response
 def api_all_cards_languages():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     with get_database_connection() as con:
         cur = con.cursor()
 
@@ -270,37 +667,117 @@ def api_all_cards_languages():
 
         if not scryfall_id:
             error = {'successful': False, 'error': 'Expected query param "scryfall_id"'}
-            return json.dumps(error)
+            return encoder.dumps(error)
+
+        cache.check_catalog_generation(cur)
+        languages = languages_cache.get(scryfall_id)
+        if languages != None:
+            return encoder.dumps(languages)
 
-        res = cur.execute('''SELECT A.ID, A.DefaultLang, Langs.Lang FROM Cards A
-                    CROSS JOIN Cards B
-                    INNER JOIN Langs ON A.LangID = Langs.ID
-                    WHERE B.ID = %s AND A.CollectorNumber = B.CollectorNumber AND A.SetID = B.SetID''', (scryfall_id,))
+        res = LANGUAGES_QUERY.execute(cur, (scryfall_id,))
 
         rows = res.fetchall()
         if len(rows) == 0:
             error = {'successful': False, 'error': f"Couldn't find a card with scryfall_id \"{scryfall_id}\""}
-            return json.dumps(error)
+            return encoder.dumps(error)
+
+        languages = language_dicts(rows)
+        languages_cache.put(scryfall_id, languages)
+        return encoder.dumps(languages)
+
+# The parts of the batch languages lookup that don't touch the database, shared with asgi.py.
+# Returns the languages we already have by id and the ids LANGUAGES_MANY_QUERY still needs to load.
+# Ids are keyed as strings so they share languages_cache with /api/all_cards/languages
+def get_cached_languages(scryfall_ids: list[str]) -> tuple[dict[str, list[dict]], list[uuid.UUID]]:
+    languages_by_id = {}
+    uncached_ids = set()
+    for scryfall_id in scryfall_ids:
+        try:
+            parsed_id = uuid.UUID(scryfall_id)
+        except (ValueError, TypeError, AttributeError):
+            # Not a UUID so it can't be in the database
+            continue
+
+        key = str(parsed_id)
+        if key in languages_by_id or parsed_id in uncached_ids:
+            continue
+        languages = languages_cache.get(key)
+        if languages == None:
+            uncached_ids.add(parsed_id)
+        else:
+            languages_by_id[key] = languages
+
+    return languages_by_id, list(uncached_ids)
+
+# Groups the rows of LANGUAGES_MANY_QUERY by card, caching them and adding them to languages_by_id
+def cache_language_rows(rows: list[tuple], languages_by_id: dict[str, list[dict]]):
+    rows_by_id = {}
+    for row in rows:
+        rows_by_id.setdefault(str(row[0]), []).append(row[1:])
+
+    for key, language_rows in rows_by_id.items():
+        languages = language_dicts(language_rows)
+        languages_cache.put(key, languages)
+        languages_by_id[key] = languages
+
+# The response for the ids the client asked for, any we don't have a card for go in not_found
+def languages_many_response(scryfall_ids: list[str], languages_by_id: dict[str, list[dict]]) -> dict:
+    data = {}
+    not_found = []
+    for scryfall_id in scryfall_ids:
+        try:
+            languages = languages_by_id.get(str(uuid.UUID(scryfall_id)))
+        except (ValueError, TypeError, AttributeError):
+            languages = None
+
+        if languages == None:
+            not_found.append(scryfall_id)
+        else:
+            data[scryfall_id] = languages
+
+    return {'data': data, 'not_found': not_found}
+
+# The language options of many cards at once, so a page of cards can have them
+# ready before any of its modals are opened. Takes the same body as /api/all_cards/many
+@app.route("/api/all_cards/languages/many", methods=["POST"])
+@catalog_response
+def api_all_cards_languages_many():
+    with get_database_connection() as con:
+        cur = con.cursor()
+
+        request_json = request.json
+
+        content_type = request.headers.get('Content-Type')
+        if (content_type != 'application/json'):
+            error = {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
+            return encoder.dumps(error)
+
+        if request_json == None:
+            error = {'successful': False, 'error': "Expected json body, but didn't find one"}
+            return encoder.dumps(error)
+
+        scryfall_ids = request_json.get('scryfall_ids')
+
+        if scryfall_ids == None:
+            error = {'successful': False, 'error': "Couldn't find expected key \"scryfall_ids\""}
+            return encoder.dumps(error)
 
-        languages = []
+        if type(scryfall_ids) != list:
+            error = {'successful': False, 'error': f"Expected key \"scryfall_ids\" to be of type list, got {str(type(scryfall_ids).__name__)}"}
+            return encoder.dumps(error)
 
-        for row in rows:
-            id_ = row[0]
-            default = row[1]
-            lang = row[2]
-            obj = {
-                    'scryfall_id': str(id_),
-                    'default': bool(default),
-                    'lang': lang
-                    }
+        cache.check_catalog_generation(cur)
+        languages_by_id, uncached_ids = get_cached_languages(scryfall_ids)
 
-            languages.append(obj)
+        if len(uncached_ids) > 0:
+            res = LANGUAGES_MANY_QUERY.execute(cur, (uncached_ids,))
+            cache_language_rows(res.fetchall(), languages_by_id)
 
-        return json.dumps(languages)
+        return encoder.dumps(languages_many_response(scryfall_ids, languages_by_id))
 
 @app.route("/api/by_id")
+@catalog_response
 def api_by_id():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     with get_database_connection() as con:
         cur = con.cursor()
 
@@ -309,59 +786,200 @@ def api_by_id():
 
         if scryfall_id == None:
             error = {'successful': False, 'error': 'Expected query param "scryfall_id"'}
-            return json.dumps(error)
+            return encoder.dumps(error)
         try:
-            card = Card(cur, scryfall_id)
+            card = get_card(cur, scryfall_id)
         except NotFoundException as e:
-            return json.dumps({'successful': False, 'error': str(e)})
+            return encoder.dumps({'successful': False, 'error': str(e)})
+
+        return encoder.dumps(card.get_dict())
+
+
+# LOWER(Name) LIKE '%...%' is served by the CardsLowerNameTrgmIndex trigram index,
+# and COUNT(*) OVER () gives us the total from the same scan as the page.
+# {default_filter} is filled in below, there's one registered query for each value of the default param
+ALL_CARDS_SEARCH_QUERY = '''SELECT ID, Name, ReleasedAt, COUNT(*) OVER () FROM Cards
+                         WHERE LOWER(Name) LIKE %(pattern)s {default_filter}
+                         ORDER BY Name, ReleasedAt DESC, ID
+                         LIMIT %(limit)s OFFSET %(offset)s
+                         '''
+
+# The page after a cursor, see pagination.py. For short or empty searches
+# this walks CardsNameReleasedAtIDIndex from the cursor and stops once the page is full
+ALL_CARDS_KEYSET_QUERY = f'''SELECT ID, Name, ReleasedAt FROM Cards
+                         WHERE LOWER(Name) LIKE %(pattern)s {{default_filter}}
+                         AND {pagination.keyset_filter('Name', 'ReleasedAt', 'ID')}
+                         ORDER BY Name, ReleasedAt DESC, ID
+                         LIMIT %(limit)s
+                         '''
+
+# Past the last page there are no rows to carry the window count
+ALL_CARDS_COUNT_QUERY = '''SELECT COUNT(*) FROM Cards
+                        WHERE LOWER(Name) LIKE %(pattern)s {default_filter}
+                        '''
+
+# default -> (page query, count query, keyset query).
+# Not prepared, the best plan for '%%' (walk the name index) and for 'bolt' (the trigram index) are different,
+# and a generic plan picked after a few executions would be used for both
+ALL_CARDS_SEARCH_QUERIES = {
+    False: (queries.register('all_cards_search', ALL_CARDS_SEARCH_QUERY.format(default_filter=''), prepare=False),
+            queries.register('all_cards_count', ALL_CARDS_COUNT_QUERY.format(default_filter=''), prepare=False),
+            queries.register('all_cards_keyset', ALL_CARDS_KEYSET_QUERY.format(default_filter=''), prepare=False)),
+    True: (queries.register('all_cards_search_default', ALL_CARDS_SEARCH_QUERY.format(default_filter='AND DefaultLang = true'), prepare=False),
+           queries.register('all_cards_count_default', ALL_CARDS_COUNT_QUERY.format(default_filter='AND DefaultLang = true'), prepare=False),
+           queries.register('all_cards_keyset_default', ALL_CARDS_KEYSET_QUERY.format(default_filter='AND DefaultLang = true'), prepare=False))
+}
+
+# The cursor for the page after a row of the search or keyset query
+def all_cards_cursor(row: tuple) -> str:
+    return pagination.encode_cursor(row[1], row[2], row[0])
+
+# Returns the page query, the count query and their parameters for search_text.
+# With a cursor the page query is the page after it, otherwise the page'th page
+def all_cards_search_queries(search_text: str, default: bool, page: int, cursor: str | None = None) -> tuple[queries.PreparedQuery, queries.PreparedQuery, dict]:
+    search_query, count_query, keyset_query = ALL_CARDS_SEARCH_QUERIES[default]
+    params = {'pattern': search.contains_pattern(search_text)}
+
+    if cursor != None:
+        params.update(pagination.decode_cursor(cursor, uuid.UUID))
+        # One more than a page so we know if there's another one after it
+        params['limit'] = PAGE_SIZE + 1
+        return keyset_query, count_query, params
+
+    params.update(limit=PAGE_SIZE, offset=page * PAGE_SIZE)
+    return search_query, count_query, params
+
+def api_all_cards_search(search_text: str, page: int, default: bool, cursor: str | None = None):
+    with get_database_connection() as con:
+        cur = con.cursor()
 
-        return json.dumps(card.get_dict())
+        try:
+            search_query, count_query, params = all_cards_search_queries(search_text, default, page, cursor)
+        except pagination.InvalidCursorError as e:
+            return encoder.dumps({'successful': False, 'error': str(e)})
 
+        res = search_query.execute(cur, params)
+        card_results = res.fetchall()
 
-def api_all_cards_search(search_text: str, page: int, default: bool):
+        # Counting every match would mean looking at what came before the cursor,
+        # so the cursor path doesn't return a length
+        if cursor != None:
+            card_results, next_cursor = pagination.split_page(card_results, PAGE_SIZE, all_cards_cursor)
+            cards = [{'scryfall_id': card[0]} for card in card_results]
+            return encoder.dumps({'cards': cards, 'next_cursor': next_cursor})
+
+        if len(card_results) > 0:
+            length = card_results[0][3]
+        elif page > 0:
+            res = count_query.execute(cur, params)
+            length = res.fetchone()[0]
+        else:
+            length = 0
+
+        cards = [{'scryfall_id': card[0]} for card in card_results]
+        next_cursor = page_next_cursor(card_results, page, length, all_cards_cursor)
+
+        return encoder.dumps({'cards': cards, 'length': length, 'next_cursor': next_cursor})
+
+# query=fulltext. websearch_to_tsquery understands "quoted phrases", or and -excluded words.
+# Each half of the UNION can use its table's SearchVector GIN index,
+# and a card's rank is its best match across the card and its faces
+FULL_TEXT_MATCHES = f'''SELECT ID AS CardID, ts_rank_cd(SearchVector, websearch_to_tsquery('{init_database.SEARCH_CONFIG}', %(text)s)) AS Rank FROM Cards
+                      WHERE SearchVector @@ websearch_to_tsquery('{init_database.SEARCH_CONFIG}', %(text)s)
+                      UNION ALL
+                      SELECT CardID, ts_rank_cd(SearchVector, websearch_to_tsquery('{init_database.SEARCH_CONFIG}', %(text)s)) FROM Faces
+                      WHERE SearchVector @@ websearch_to_tsquery('{init_database.SEARCH_CONFIG}', %(text)s)'''
+
+FULL_TEXT_SEARCH_QUERY = '''SELECT Cards.ID, COUNT(*) OVER () FROM ({matches}) matches
+                         INNER JOIN Cards ON Cards.ID = matches.CardID
+                         {default_filter}
+                         GROUP BY Cards.ID
+                         ORDER BY MAX(matches.Rank) DESC, Cards.Name, Cards.ReleasedAt DESC, Cards.ID
+                         LIMIT %(limit)s OFFSET %(offset)s
+                         '''
+
+FULL_TEXT_COUNT_QUERY = '''SELECT COUNT(DISTINCT Cards.ID) FROM ({matches}) matches
+                        INNER JOIN Cards ON Cards.ID = matches.CardID
+                        {default_filter}
+                        '''
+
+# default -> (page query, count query)
+FULL_TEXT_SEARCH_QUERIES = {
+    False: (queries.register('full_text_search', FULL_TEXT_SEARCH_QUERY.format(matches=FULL_TEXT_MATCHES, default_filter='')),
+            queries.register('full_text_count', FULL_TEXT_COUNT_QUERY.format(matches=FULL_TEXT_MATCHES, default_filter=''))),
+    True: (queries.register('full_text_search_default', FULL_TEXT_SEARCH_QUERY.format(matches=FULL_TEXT_MATCHES, default_filter='WHERE Cards.DefaultLang = true')),
+           queries.register('full_text_count_default', FULL_TEXT_COUNT_QUERY.format(matches=FULL_TEXT_MATCHES, default_filter='WHERE Cards.DefaultLang = true')))
+}
+
+def api_all_cards_full_text_search(text: str, page: int, default: bool):
     with get_database_connection() as con:
         cur = con.cursor()
 
-        cards = []
-        search_string = f'%{search_text}%'
+        search_query, count_query = FULL_TEXT_SEARCH_QUERIES[default]
+        params = {'text': text, 'limit': PAGE_SIZE, 'offset': page * PAGE_SIZE}
 
-        if default:
-            res = cur.execute('''SELECT COUNT(*) FROM Cards
-                              WHERE LOWER(Name) LIKE %s AND DefaultLang = true''',
-                              (search_string,))
-            length = res.fetchone()[0]
+        res = search_query.execute(cur, params)
+        card_results = res.fetchall()
 
-            res = cur.execute('''SELECT ID FROM Cards
-                              WHERE LOWER(Name) LIKE %s AND DefaultLang = true
-                              ORDER BY Name, ReleasedAt DESC
-                              LIMIT %s OFFSET %s
-                              ''',
-                              (search_string, PAGE_SIZE, page * PAGE_SIZE))
-        else:
-            res = cur.execute('''SELECT COUNT(*) FROM Cards
-                              WHERE LOWER(Name) LIKE %s
-                              ''',
-                              (search_string,))
+        if len(card_results) > 0:
+            length = card_results[0][1]
+        elif page > 0:
+            res = count_query.execute(cur, params)
             length = res.fetchone()[0]
+        else:
+            length = 0
+
+        cards = [{'scryfall_id': card[0]} for card in card_results]
+        return encoder.dumps({'cards': cards, 'length': length})
+
+# The WHERE clause changes with every search, so unlike ALL_CARDS_SEARCH_QUERIES these can't be prepared
+SCRYFALL_SEARCH_QUERY = '''SELECT ID, COUNT(*) OVER () FROM Cards
+                        WHERE ({where}) {default_filter}
+                        ORDER BY Name, ReleasedAt DESC
+                        LIMIT %s OFFSET %s
+                        '''
+
+SCRYFALL_COUNT_QUERY = '''SELECT COUNT(*) FROM Cards
+                       WHERE ({where}) {default_filter}
+                       '''
+
+# Compiles a scryfall style search (see search.py).
+# Returns the page query, the count query and the parameters of the search,
+# the page query also needs PAGE_SIZE and the offset after them.
+# Raises search.QuerySyntaxError if text isn't a valid search
+def scryfall_search_queries(text: str, default: bool) -> tuple[str, str, list]:
+    where, params = search.compile_query(text)
+    default_filter = 'AND DefaultLang = true' if default else ''
+
+    return SCRYFALL_SEARCH_QUERY.format(where=where, default_filter=default_filter), SCRYFALL_COUNT_QUERY.format(where=where, default_filter=default_filter), params
+
+def api_all_cards_scryfall_search(text: str, page: int, default: bool):
+    try:
+        search_query, count_query, params = scryfall_search_queries(text, default)
+    except search.QuerySyntaxError as e:
+        return encoder.dumps({'successful': False, 'error': str(e)})
 
-            res = cur.execute('''SELECT ID FROM Cards
-                              WHERE LOWER(Name) LIKE %s
-                              ORDER BY Name, ReleasedAt DESC
-                              LIMIT %s OFFSET %s
-                              ''',
-                              (search_string, PAGE_SIZE, page * PAGE_SIZE))
+    with get_database_connection() as con:
+        cur = con.cursor()
 
+        res = cur.execute(search_query, params + [PAGE_SIZE, page * PAGE_SIZE])
         card_results = res.fetchall()
 
-        for card in card_results:
-            cards.append({'scryfall_id': str(card[0])})
+        if len(card_results) > 0:
+            length = card_results[0][1]
+        elif page > 0:
+            res = cur.execute(count_query, params)
+            length = res.fetchone()[0]
+        else:
+            length = 0
 
-        return json.dumps({'cards': cards, 'length': length})
+        cards = [{'scryfall_id': card[0]} for card in card_results]
+        return encoder.dumps({'cards': cards, 'length': length})
 
 
 @app.route("/api/all_cards/many", methods=["POST"])
+@catalog_response
 def api_all_card_many():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     with get_database_connection() as con:
         cur = con.cursor()
 
@@ -370,44 +988,50 @@ def api_all_card_many():
         content_type = request.headers.get('Content-Type')
         if (content_type != 'application/json'):
             error = {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
-            return json.dumps(error)
+            return encoder.dumps(error)
 
         if request_json == None:
             error = {'successful': False, 'error': "Expected json body, but didn't find one"}
-            return json.dumps(error)
+            return encoder.dumps(error)
 
         scryfall_ids = request_json.get('scryfall_ids')
 
         if scryfall_ids == None:
             error = {'successful': False, 'error': "Couldn't find expected key \"scryfall_ids\""}
-            return json.dumps(error)
+            return encoder.dumps(error)
 
         if type(scryfall_ids) != list:
             error = {'successful': False, 'error': f"Expected key \"scryfall_ids\" to be of type list, got {str(type(scryfall_ids).__name__)}"}
-            return json.dumps(error)
+            return encoder.dumps(error)
 
 
-        cards = []
-        for scryfall_id in scryfall_ids:
-            try:
-                card = Card(cur, scryfall_id)
-            except NotFoundException as e:
-                return json.dumps({'successful': False, 'error': str(e)})
-
-            cards.append(card.get_dict())
+        cards, not_found = get_cards(cur, scryfall_ids)
 
         return_obj = {
-            'data': cards
+            'data': [card.get_dict() for card in cards],
+            'not_found': not_found
         }
 
-        return json.dumps(return_obj)
+        return encoder.dumps(return_obj)
 
 
+# The text of a query=search (or scryfall or fulltext) request. asgi.py uses this too so both serving modes answer the same.
+# An empty text matches everything, but a missing one is a mistake
+def get_search_text(args, query: str) -> tuple[str, None] | tuple[None, dict]:
+    search_text = args.get('text')
+    if search_text == None:
+        error = {'successful': False, 'error': f'Expected query param "text" with query={query}'}
+        return None, error
+
+    return search_text, None
+
 @app.route("/api/all_cards")
+@catalog_response
 def api_all_cards():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     args = request.args
     page = args.get('page')
+    # The next_cursor of the previous response. It takes the place of page
+    cursor = args.get('cursor')
     query = args.get('query')
     default = args.get('default')
 
@@ -421,20 +1045,42 @@ def api_all_cards():
     else:
         default = False
 
+    if cursor != None and query not in (None, 'search'):
+        error = {'successful': False, 'error': 'cursor only works with query=search'}
+        return encoder.dumps(error)
+
+    if query in ('search', 'scryfall', 'fulltext'):
+        search_text, error = get_search_text(args, query)
+        if error:
+            return encoder.dumps(error)
+
     if query:
         if query == 'search':
-            # TODO: Check this exists and is valid
-            search_text = args.get('text')
-            return api_all_cards_search(search_text, page, default)
+            return api_all_cards_search(search_text, page, default, cursor)
+        elif query == 'scryfall':
+            # Searches like t:creature c:rg cmc<=3, see search.py
+            return api_all_cards_scryfall_search(search_text, page, default)
+        elif query == 'fulltext':
+            # Ranked search over the name, type line and rules text
+            return api_all_cards_full_text_search(search_text, page, default)
         else:
-            # Return an error
-            pass
+            error = {'successful': False, 'error': f'Unsupported value for query parameter "query". Expected "search", "scryfall" or "fulltext". Got {query}'}
+            return encoder.dumps(error)
     else:
-        return api_all_cards_search('', page, default)
+        return api_all_cards_search('', page, default, cursor)
+
+SET_COLLECTOR_NUMBER_QUERY = queries.register('set_collector_number', '''SELECT SetID, CollectorNumber FROM Cards
+                                                                     WHERE ID = %s''')
+
+OTHER_LANGUAGE_QUERY = queries.register('other_language', '''SELECT ID FROM Cards
+                                                        WHERE
+                                                          SetID = %s AND
+                                                          CollectorNumber = %s AND
+                                                          LangID = %s
+                                                        ''')
 
-def get_other_language_id(cur: psycopg.Cursor, scryfall_id: str, lang: str) -> tuple[str, None] | tuple[None, dict]:
-    res = cur.execute('''SELECT SetID, CollectorNumber FROM Cards
-                      WHERE ID = %s''', (scryfall_id,))
+def get_other_language_id(cur: psycopg.Cursor, scryfall_id: str, lang: str) -> tuple[uuid.UUID, None] | tuple[None, dict]:
+    res = SET_COLLECTOR_NUMBER_QUERY.execute(cur, (scryfall_id,))
 
 
     set_id_collector_number = res.fetchone()
@@ -444,23 +1090,12 @@ def get_other_language_id(cur: psycopg.Cursor, scryfall_id: str, lang: str) -> t
 
     set_id, collector_number = set_id_collector_number
 
-    res = cur.execute('''SELECT ID FROM Langs
-                      WHERE Lang = %s
-                      ''', (lang,))
-
-    lang_id = res.fetchone()
+    lang_id = dimensions.get_id(cur, 'Langs', lang)
     if lang_id == None:
         error = {'successful': False, 'error': f"Couldn't find lang \"{lang}\""}
         return None, error
 
-    lang_id = lang_id[0]
-
-    res = cur.execute('''SELECT ID FROM Cards
-                      WHERE
-                        SetID = %s AND
-                        CollectorNumber = %s AND
-                        LangID = %s
-                      ''', (set_id, collector_number, lang_id))
+    res = OTHER_LANGUAGE_QUERY.execute(cur, (set_id, collector_number, lang_id))
 
     scryfall_id = res.fetchone()
 
@@ -469,27 +1104,24 @@ def get_other_language_id(cur: psycopg.Cursor, scryfall_id: str, lang: str) -> t
         error = {'successful': False, 'error': f"Couldn't find card that card in that language"}
         return None, error
 
-    scryfall_id = str(scryfall_id[0])
+    scryfall_id = scryfall_id[0]
 
     return scryfall_id, None
 
 
+FINISH_CARD_QUERY = queries.register('finish_card', '''SELECT ID FROM FinishCards
+                                                  WHERE CardID = %s AND FinishID = %s
+                                                  ''')
+
 def get_finish_card_id(cur: psycopg.Cursor, finish: str, scryfall_id: str) -> tuple[None, int] | tuple[dict, None]:
     error = None
-    res = cur.execute('''SELECT ID FROM Finishes
-                         WHERE Finish = %s
-                      ''', (finish,))
-    finish_id = res.fetchone()
+    finish_id = dimensions.get_id(cur, 'Finishes', finish)
 
     if finish_id == None:
         error = {'successful': False, 'error': f"No such finish {finish}"}
         return (error, None)
 
-    finish_id = finish_id[0]
-
-    res = cur.execute('''SELECT ID FROM FinishCards
-                      WHERE CardID = %s AND FinishID = %s
-                      ''', (scryfall_id, finish_id))
+    res = FINISH_CARD_QUERY.execute(cur, (scryfall_id, finish_id))
 
     finish_card_id = res.fetchone()
 
@@ -500,15 +1132,29 @@ def get_finish_card_id(cur: psycopg.Cursor, finish: str, scryfall_id: str) -> tu
 
     return error, finish_card_id
 
+COLLECTION_CARD_QUERY = queries.register('collection_card', '''SELECT
+                           Finishes.Finish,
+                           Colls.Condition,
+                           Colls.Signed,
+                           Colls.Altered,
+                           Colls.Notes,
+                           Colls.Quantity
+                         FROM Collections as Colls
+                         INNER JOIN FinishCards ON Colls.FinishCardID = FinishCards.ID
+                         INNER JOIN Finishes ON Finishes.ID = FinishCards.FinishID
+                         WHERE
+                           Colls.ID = %s AND
+                           Colls.UserID = %s
+                         ''')
+
 @app.route("/api/collection/by_id", methods = ['GET'])
 def api_collection_by_id():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     with get_database_connection() as con:
         cur = con.cursor()
 
         authed_user_id, error = get_user_id(cur)
         if error:
-            return json.dumps(error)
+            return encoder.dumps(error)
 
         args = request.args
         collection_id = args.get('collection_id')
@@ -516,39 +1162,26 @@ def api_collection_by_id():
 
         if username == None:
             error = {'successful': False, 'error': "Didn't find expected query parameter \"username\""}
-            return json.dumps(error)
+            return encoder.dumps(error)
         if collection_id == None:
             error = {'successful': False, 'error': "Didn't find expected query parameter \"collection_id\""}
-            return json.dumps(error)
+            return encoder.dumps(error)
 
         try:
             user_id = get_user_id_by_username(username, cur)
         except NotFoundException as e:
-            return json.dumps({'successful': False, 'error': str(e)})
+            return encoder.dumps({'successful': False, 'error': str(e)})
 
         if authed_user_id != user_id:
             error = {'successful': False, 'error': "You are not authorized to access this collection."}
-            return json.dumps(error)
-
-        cur.execute('''SELECT
-                         Finishes.Finish,
-                         Colls.Condition,
-                         Colls.Signed,
-                         Colls.Altered,
-                         Colls.Notes,
-                         Colls.Quantity
-                       FROM Collections as Colls
-                       INNER JOIN FinishCards ON Colls.FinishCardID = FinishCards.ID
-                       INNER JOIN Finishes ON Finishes.ID = FinishCards.FinishID
-                    WHERE
-                      Colls.ID = %s AND
-                      Colls.UserID = %s
-                    ''', (collection_id, authed_user_id))
+            return encoder.dumps(error)
+
+        COLLECTION_CARD_QUERY.execute(cur, (collection_id, authed_user_id))
         res = cur.fetchone()
 
         if res == None:
             error = {'successful': False, 'error': "Couldn't find card in your collection with that ID, data might be old. Try refreshing"}
-            return json.dumps(error)
+            return encoder.dumps(error)
 
         finish, condition, signed, altered, notes, quantity = res
         card = {
@@ -561,7 +1194,20 @@ def api_collection_by_id():
         }
 
         return_obj = {'successful': True, 'card': card}
-        return json.dumps(return_obj)
+        return encoder.dumps(return_obj)
+
+CARD_SUMMARY_QUERY = queries.register('card_summary', '''SELECT Cards.Name, Cards.CollectorNumber, Sets.Code FROM Cards
+                                                    INNER JOIN Sets ON Cards.SetID = Sets.ID
+                                                    WHERE Cards.ID = %s''')
+
+# One statement so concurrent +/- clicks can't race between reading and writing the quantity.
+# xmax is 0 only for a freshly inserted row, which tells us if there was a row before
+COLLECTION_ADD_QUERY = queries.register('collection_add', '''INSERT INTO Collections(UserID, FinishCardID, Condition, Signed, Altered, Notes, Quantity)
+                                                        VALUES(%s, %s, %s, %s, %s, %s, %s)
+                                                        ON CONFLICT (UserID, FinishCardID, Condition, Signed, Altered, Notes)
+                                                        DO UPDATE SET Quantity = Collections.Quantity + EXCLUDED.Quantity
+                                                        RETURNING ID, Quantity, xmax = 0
+                                                        ''')
 
 @app.route("/api/collection", methods = ['POST', 'GET', 'PATCH'])
 def api_collection():
@@ -569,61 +1215,76 @@ def api_collection():
         cur = con.cursor()
 
         if request.method == 'GET':
-            logging.info(f"Handling GET {request.path} for client {request.remote_addr}")
             args = request.args
             page = args.get('page')
+            # The next_cursor of the previous response. It takes the place of page
+            cursor = args.get('cursor')
             query = args.get('query')
 
             username = args.get('username')
             authed_user_id, error = get_user_id(cur)
             if error:
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             if username == None:
                 error = {'successful': False, 'error': "Didn't find expected query parameter \"username\""}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             try:
                 user_id = get_user_id_by_username(username, cur)
             except NotFoundException as e:
-                return json.dumps({'successful': False, 'error': str(e)})
+                return encoder.dumps({'successful': False, 'error': str(e)})
 
             if authed_user_id != user_id:
                 error = {'successful': False, 'error': "You are not authorized to access this collection."}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             if page:
                 page = int(page)
             else:
                 page = 0
 
+            # stream=true returns every matching card as one JSON array instead of a page
+            stream = args.get('stream') == 'true'
+
+            if query in ('search', 'fulltext'):
+                search_text, error = get_search_text(args, query)
+                if error:
+                    return encoder.dumps(error)
+
             if query:
                 if query == 'search':
-                    # TODO: Check this exists and is valid
-                    search_text = args.get('text')
-                    return api_collection_search(cur, search_text, page, user_id)
+                    return api_collection_search(cur, search_text, page, user_id, stream, cursor)
+                elif query == 'fulltext':
+                    # Ranked search over the name, type line and rules text
+                    if stream:
+                        error = {'successful': False, 'error': 'stream=true only works with query=search'}
+                        return encoder.dumps(error)
+                    if cursor != None:
+                        error = {'successful': False, 'error': 'cursor only works with query=search'}
+                        return encoder.dumps(error)
+                    return api_collection_full_text_search(cur, search_text, page, user_id)
                 else:
-                    error = {'successful': False, 'error': f'Unsupported value for query parameter "query". Expected "search". Got {query}'}
-                    return json.dumps(error)
+                    error = {'successful': False, 'error': f'Unsupported value for query parameter "query". Expected "search" or "fulltext". Got {query}'}
+                    return encoder.dumps(error)
             else:
-                return api_collection_search(cur, '', page, user_id)
+                return api_collection_search(cur, '', page, user_id, stream, cursor)
 
         # This is where we add cards to the database
         # We need to do as much error checking as possible here
         # to ensure we don't accidently mess up the database
         # or say we're adding a card when in reality we aren't
         elif request.method == 'POST':
-            logging.info(f"Handling POST {request.path} for client {request.remote_addr}")
             authed_user_id, error = get_user_id(cur)
             if error:
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             content_type = request.headers.get('Content-Type')
             if (content_type == 'application/json'):
                 request_json = request.json
                 if request_json == None or request_json == "":
                     error = {'successful': False, 'error': f"Expected content, got empty POST body"}
-                    return json.dumps(error)
+                    return encoder.dumps(error)
 
                 scryfall_id = request_json.get('scryfall_id')
                 quantity = request_json.get('quantity')
@@ -635,12 +1296,12 @@ def api_collection():
                 username = request_json.get('username')
                 if username == None:
                     error = {'successful': False, 'error': "Didn't find expected key \"username\""}
-                    return json.dumps(error)
+                    return encoder.dumps(error)
 
                 user_id = get_user_id_by_username(username, cur)
                 if authed_user_id != user_id:
                     error = {'successful': False, 'error': "You are not authorized to access this collection."}
-                    return json.dumps(error)
+                    return encoder.dumps(error)
 
                 param_type_map = {
                     'scryfall_id': str,
@@ -656,22 +1317,20 @@ def api_collection():
                     param_value = request_json.get(param_name)
                     if param_value == None:
                         error = {'successful': False, 'error': f'Expected key "{param_name}" not found in POST body.'}
-                        return json.dumps(error)
+                        return encoder.dumps(error)
 
                     if type(param_value) != param_type:
                         error = {'successful': False, 'error': f'Expected key "{param_name}" to be a of type {param_type}, got {str(type(param_value).__name__)}'}
-                        return json.dumps(error)
+                        return encoder.dumps(error)
 
                 # TODO: Check for unexpected keys
 
-                res = cur.execute("""SELECT Cards.Name, Cards.CollectorNumber, Sets.Code FROM Cards
-                                  INNER JOIN Sets ON Cards.SetID = Sets.ID
-                                  WHERE Cards.ID = %s""", (scryfall_id,))
+                res = CARD_SUMMARY_QUERY.execute(cur, (scryfall_id,))
                 row = res.fetchone()
 
                 if row == None:
                     error = {'successful': False, 'error': f'Couldn\'t find a card with that id "{scryfall_id}"'}
-                    return json.dumps(error)
+                    return encoder.dumps(error)
 
                 return_card = {
                         'name': row[0],
@@ -682,91 +1341,63 @@ def api_collection():
 
                 error, finish_card_id = get_finish_card_id(cur, finish, scryfall_id)
                 if error != None:
-                    return json.dumps(error)
-
-                res = cur.execute('''SELECT Quantity FROM Collections
-                                  WHERE UserID = %s AND
-                                  FinishCardID = %s AND
-                                  Condition = %s AND
-                                  Signed = %s AND
-                                  Altered = %s AND
-                                  Notes = %s
-                                  ''', (user_id, finish_card_id, condition, signed, altered, notes))
-                original_quantity = res.fetchone()
-                card_in_collection = original_quantity != None
-
-                if card_in_collection:
-                    original_quantity = original_quantity[0]
-                    res = cur.execute('''UPDATE collections SET Quantity = quantity + %s
-                                WHERE UserID = %s AND
-                                FinishCardID = %s AND
-                                Condition = %s AND
-                                Signed = %s AND
-                                Altered = %s AND
-                                Notes = %s
-                                RETURNING Quantity
-                                ''', (quantity, user_id, finish_card_id, condition, signed, altered, notes))
-                    updated_quantity = res.fetchone()[0]
-                else:
+                    return encoder.dumps(error)
+
+                res = COLLECTION_ADD_QUERY.execute(cur, (user_id, finish_card_id, condition, signed, altered, notes, quantity))
+                collection_id, updated_quantity, inserted = res.fetchone()
+
+                if inserted:
                     original_quantity = 0
-                    res = cur.execute('''INSERT INTO Collections(UserID, FinishCardID, Condition, Signed, Altered, Notes, Quantity)
-                                VALUES(%s, %s, %s, %s, %s, %s, %s)
-                                RETURNING Quantity
-                                ''', (user_id, finish_card_id, condition, signed, altered, notes, quantity))
-                    updated_quantity = res.fetchone()[0]
+                else:
+                    original_quantity = updated_quantity - quantity
 
                 # If we get a request to have 0 or negative updated_quantity we delete the row
                 # This can happen if the user clicks the - button
-                # while having 0 in the collection
+                # while having 0 in the collection.
+                # The upsert left the row locked by us, so nobody can change it in between
                 if updated_quantity <= 0:
-                    cur.execute('''DELETE FROM collections
-                            WHERE UserID = %s AND
-                            FinishCardID = %s AND
-                            Condition = %s AND
-                            Signed = %s AND
-                            Altered = %s AND
-                            Notes = %s
-                            ''', (user_id, finish_card_id, condition, signed, altered, notes))
+                    cur.execute('''DELETE FROM Collections
+                                WHERE ID = %s
+                                ''', (collection_id,))
                     updated_quantity = 0
 
                 delta = updated_quantity - original_quantity
 
                 return_obj = {'successful': True, 'card': return_card, 'delta': delta, 'new_total': updated_quantity}
                 con.commit()
-                return json.dumps(return_obj)
+                return encoder.dumps(return_obj)
             else:
                 error = {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
-                return json.dumps(error)
+                return encoder.dumps(error)
         elif request.method == "PATCH":
-            logging.info(f"Handling PATCH {request.path} for client {request.remote_addr}")
             authed_user_id, error = get_user_id(cur)
             if error != None:
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             request_json = request.json
             if request_json == None or request_json == "":
                     error = {'successful': False, 'error': f"Expected content, got empty PATCH body"}
-                    return json.dumps(error)
+                    return encoder.dumps(error)
 
             username = request_json.get('username')
             if username == None:
                 error = {'successful': False, 'error': "Didn't find expected key \"username\""}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             user_id = get_user_id_by_username(username, cur)
             if authed_user_id != user_id:
                 error = {'successful': False, 'error': "You are not authorized to access this collection."}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
 
             target_card_id = request_json.get('target')
             replacement_card = request_json.get('replacement')
             if target_card_id == None:
                 error = {'successful': False, 'error': f"Didn't find expected key 'target' in PATCH body"}
-                return json.dumps(error)
+                return encoder.dumps(error)
             if replacement_card == None:
                 error = {'successful': False, 'error': f"Didn't find expected key 'replacement' in PATCH body"}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             # TODO: Type check target and replacement
 
@@ -791,7 +1422,7 @@ def api_collection():
             defaults = res.fetchone()
             if defaults == None:
                 error = {'successful': False, 'error': f"Couldn't find target card in database"}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             default_finish_card_id, default_scryfall_id, default_quantity, default_condition, default_signed, default_altered, default_notes, default_lang, card_name, normal_image_uri = defaults
 
@@ -799,12 +1430,12 @@ def api_collection():
             # Changing languages means we need to change scryfall_id as well
             scryfall_id, error = get_other_language_id(cur, default_scryfall_id, replacement_lang)
             if scryfall_id == None:
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             replacement_finish = replacement_card.get('finish', default_finish_card_id)
             error, replacement_finish_card_id = get_finish_card_id(cur, replacement_finish, scryfall_id)
             if error != None:
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             replacement_quantity = replacement_card.get('quantity', default_quantity)
             replacement_condition = replacement_card.get('condition', default_condition)
@@ -829,7 +1460,7 @@ def api_collection():
                 # TODO: This message is really long, but doesn't stay up for very long
                 # consider extending how long messages stay up (or make it configurable or based on length)
                 error = {'successful': False, 'error': "Updating that card in that way would cause it to be identical to another card in your collection, because it's unclear what to do in that case we err on the side of caution and do nothing. To accomplish this try removing all copies of the original card from your collection and then adding any number you need to the existing entry."}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             con.commit()
             new_card = {
@@ -845,30 +1476,258 @@ def api_collection():
                 'image_src': normal_image_uri
             }
             return_obj = {'successful': True, 'replaced_card_id': target_card_id, 'new_card': new_card}
-            return json.dumps(return_obj)
+            return encoder.dumps(return_obj)
+
+# Namespace for pg_advisory_xact_lock(namespace, user id), see api_collection_batch
+COLLECTION_LOCK_NAMESPACE = 1
+
+BATCH_OPERATIONS = ['add', 'remove', 'set']
+
+# Values of the condition enum in init_database.create_schema()
+CONDITIONS = ['Damaged', 'Heavily Played', 'Moderately Played', 'Lightly Played', 'Near Mint']
+
+# Checks one operation of a batch, returns an error dict or None
+def validate_batch_operation(operation) -> dict | None:
+    if type(operation) != dict:
+        return {'successful': False, 'error': f"Expected operation to be an object, got {str(type(operation).__name__)}"}
+
+    op = operation.get('op')
+    if op not in BATCH_OPERATIONS:
+        return {'successful': False, 'error': f'Expected key "op" to be one of {BATCH_OPERATIONS}, got {op}'}
+
+    param_type_map = {
+        'scryfall_id': str,
+        'quantity': int,
+        'finish': str,
+        'condition': str,
+        'signed': bool,
+        'altered': bool,
+        'notes': str
+    }
+
+    for param_name, param_type in param_type_map.items():
+        param_value = operation.get(param_name)
+        if param_value == None:
+            return {'successful': False, 'error': f'Expected key "{param_name}" not found in operation.'}
+
+        if type(param_value) != param_type:
+            return {'successful': False, 'error': f'Expected key "{param_name}" to be a of type {param_type}, got {str(type(param_value).__name__)}'}
+
+    if operation['quantity'] < 0:
+        return {'successful': False, 'error': 'Expected key "quantity" to not be negative'}
+
+    if operation['condition'] not in CONDITIONS:
+        return {'successful': False, 'error': f'Expected key "condition" to be one of {CONDITIONS}, got {operation["condition"]}'}
+
+    try:
+        uuid.UUID(operation['scryfall_id'])
+    except ValueError:
+        return {'successful': False, 'error': f'Couldn\'t find a card with that id "{operation["scryfall_id"]}"'}
+
+    return None
+
+# Applies many add/remove/set operations to one collection in a single transaction.
+# Body: {"username": ..., "operations": [{"op": "add", "scryfall_id": ..., "quantity": ..., "finish": ...,
+#        "condition": ..., "signed": ..., "altered": ..., "notes": ...}, ...]}
+# Operations are applied in order. Each one gets a result in the same shape as a single POST /api/collection,
+# invalid operations get an error result and don't stop the rest from being applied.
+@app.route("/api/collection/batch", methods=["POST"])
+def api_collection_batch():
+    with get_database_connection() as con:
+        cur = con.cursor()
+
+        authed_user_id, error = get_user_id(cur)
+        if error:
+            return encoder.dumps(error)
+
+        content_type = request.headers.get('Content-Type')
+        if (content_type != 'application/json'):
+            error = {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
+            return encoder.dumps(error)
+
+        request_json = request.json
+        if request_json == None or request_json == "":
+            error = {'successful': False, 'error': f"Expected content, got empty POST body"}
+            return encoder.dumps(error)
+
+        username = request_json.get('username')
+        if username == None:
+            error = {'successful': False, 'error': "Didn't find expected key \"username\""}
+            return encoder.dumps(error)
+
+        try:
+            user_id = get_user_id_by_username(username, cur)
+        except NotFoundException as e:
+            return encoder.dumps({'successful': False, 'error': str(e)})
+
+        if authed_user_id != user_id:
+            error = {'successful': False, 'error': "You are not authorized to access this collection."}
+            return encoder.dumps(error)
+
+        operations = request_json.get('operations')
+        if type(operations) != list:
+            error = {'successful': False, 'error': f"Expected key \"operations\" to be of type list, got {str(type(operations).__name__)}"}
+            return encoder.dumps(error)
+
+        max_operations = int(config.get('MAX_BATCH_OPERATIONS'))
+        if len(operations) > max_operations:
+            error = {'successful': False, 'error': f"Too many operations, expected at most {max_operations} got {len(operations)}"}
+            return encoder.dumps(error)
+
+        results = [validate_batch_operation(operation) for operation in operations]
+        scryfall_ids = list(set(uuid.UUID(operation['scryfall_id']) for operation, result in zip(operations, results) if result == None))
+
+        # Resolve every card + finish in one query
+        res = cur.execute('''SELECT FinishCards.ID, Cards.ID, Finishes.Finish, Cards.Name, Cards.CollectorNumber, Sets.Code FROM FinishCards
+                          INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
+                          INNER JOIN Cards ON FinishCards.CardID = Cards.ID
+                          INNER JOIN Sets ON Cards.SetID = Sets.ID
+                          WHERE FinishCards.CardID = ANY(%s)
+                          ''', (scryfall_ids,))
+        # (scryfall_id, finish) -> (finish card id, card)
+        finish_cards = {}
+        found_ids = set()
+        for finish_card_id, scryfall_id, finish, name, collector_number, set_abbr in res.fetchall():
+            card = {'name': name, 'collector_number': collector_number, 'set_abbr': set_abbr}
+            finish_cards[(scryfall_id, finish)] = (finish_card_id, card)
+            found_ids.add(scryfall_id)
+
+        # Same order as operations, None for ones that failed
+        keys = []
+        for index, operation in enumerate(operations):
+            if results[index] != None:
+                keys.append(None)
+                continue
+
+            scryfall_id = uuid.UUID(operation['scryfall_id'])
+            if scryfall_id not in found_ids:
+                results[index] = {'successful': False, 'error': f'Couldn\'t find a card with that id "{operation["scryfall_id"]}"'}
+                keys.append(None)
+                continue
+
+            finish_card = finish_cards.get((scryfall_id, operation['finish']))
+            if finish_card == None:
+                results[index] = {'successful': False, 'error': f"That card doesn't come in the finish \"{operation['finish']}\""}
+                keys.append(None)
+                continue
+
+            finish_card_id, _ = finish_card
+            keys.append((finish_card_id, operation['condition'], operation['signed'], operation['altered'], operation['notes']))
+
+        # Only one batch per user at a time, otherwise two batches adding the same new card
+        # could both think it isn't in the collection yet and one of the additions would be lost
+        cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (COLLECTION_LOCK_NAMESPACE, user_id))
+
+        finish_card_ids = list(set(key[0] for key in keys if key != None))
+        res = cur.execute('''SELECT FinishCardID, Condition, Signed, Altered, Notes, Quantity FROM Collections
+                          WHERE UserID = %s AND FinishCardID = ANY(%s)
+                          FOR UPDATE
+                          ''', (user_id, finish_card_ids))
+        # key -> quantity, updated as we go so repeated keys see the earlier operations
+        totals = {}
+        for finish_card_id, condition, signed, altered, notes, quantity in res.fetchall():
+            totals[(finish_card_id, condition, signed, altered, notes)] = quantity
+        original_totals = dict(totals)
+        # Keys with a set, their total doesn't depend on what was in the row before
+        set_keys = set()
+
+        for index, operation in enumerate(operations):
+            key = keys[index]
+            if key == None:
+                continue
+
+            old_total = totals.get(key, 0)
+            if operation['op'] == 'add':
+                new_total = old_total + operation['quantity']
+            elif operation['op'] == 'remove':
+                new_total = max(old_total - operation['quantity'], 0)
+            else:
+                new_total = operation['quantity']
+                set_keys.add(key)
+
+            totals[key] = new_total
+            _, card = finish_cards[(uuid.UUID(operation['scryfall_id']), operation['finish'])]
+            results[index] = {'successful': True, 'card': card, 'delta': new_total - old_total, 'new_total': new_total}
+
+        # Only write the rows that actually changed. For keys without a set we write the change rather than the total
+        # so a single POST /api/collection adding a new row at the same time isn't overwritten
+        # (rows that already existed are locked, so for those it's the same thing).
+        # Keys with a set are written as the total, otherwise that same POST would turn the set into an add
+        upserts = []
+        set_upserts = []
+        deletes = []
+        for key, total in totals.items():
+            if key in set_keys:
+                if total > 0:
+                    set_upserts.append((user_id,) + key + (total,))
+                else:
+                    deletes.append((user_id,) + key)
+                continue
+
+            change = total - original_totals.get(key, 0)
+            if change == 0:
+                continue
+            if total > 0:
+                upserts.append((user_id,) + key + (change,))
+            else:
+                deletes.append((user_id,) + key)
+
+        # executemany pipelines the statements so this isn't a round trip per row
+        cur.executemany('''INSERT INTO Collections(UserID, FinishCardID, Condition, Signed, Altered, Notes, Quantity)
+                        VALUES(%s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (UserID, FinishCardID, Condition, Signed, Altered, Notes)
+                        DO UPDATE SET Quantity = Collections.Quantity + EXCLUDED.Quantity
+                        ''', upserts)
+        cur.executemany('''INSERT INTO Collections(UserID, FinishCardID, Condition, Signed, Altered, Notes, Quantity)
+                        VALUES(%s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (UserID, FinishCardID, Condition, Signed, Altered, Notes)
+                        DO UPDATE SET Quantity = EXCLUDED.Quantity
+                        ''', set_upserts)
+        cur.executemany('''DELETE FROM Collections
+                        WHERE UserID = %s AND
+                        FinishCardID = %s AND
+                        Condition = %s AND
+                        Signed = %s AND
+                        Altered = %s AND
+                        Notes = %s
+                        ''', deletes)
+
+        con.commit()
+        return encoder.dumps({'successful': True, 'results': results})
+
+# Login and signup when too many passwords are waiting to be hashed already, see passwords.py.
+# Answering right away lets the client try again instead of tying up a worker waiting
+def password_hashing_busy(template_name: str) -> Response:
+    flash("Too many people are logging in right now, try again in a moment")
+    response = make_response(render_static_page(template_name), 503)
+    response.headers['Retry-After'] = '1'
+    return response
 
 @app.route("/signup", methods=["GET", "POST"])
 def signup():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     if request.method == "GET":
-        with open('./html/signup.html', 'r') as signup_html:
-            return render_template_string(signup_html.read())
+        return render_static_page('signup.html')
     elif request.method == "POST":
-        with get_database_connection() as con:
-            cur = con.cursor()
+        username = request.form.get('username')
+        password = request.form.get('password')
 
-            username = request.form.get('username')
-            password = request.form.get('password')
+        if username == None or username == "":
+            flash("Must enter a username")
+            return redirect(request.url)
 
-            if username == None or username == "":
-                flash("Must enter a username")
-                return redirect(request.url)
+        if password == None or password == "":
+            flash("Must enter a password")
+            return redirect(request.url)
 
-            if password == None or password == "":
-                flash("Must enter a password")
-                return redirect(request.url)
+        # Before borrowing a connection, so we don't hold one while we wait for the hash
+        try:
+            password_hash = passwords.hash_password(password)
+        except passwords.Busy:
+            return password_hashing_busy('signup.html')
+
+        with get_database_connection() as con:
+            cur = con.cursor()
 
-            password_hash = ph.hash(password)
             try:
                 res = cur.execute('''INSERT INTO Users(Username, PasswordHash)
                                   VALUES(%s, %s)
@@ -891,58 +1750,163 @@ def signup():
 @app.route("/<username>/collection")
 @login_required
 def collection(username):
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
-    with open('./html/collection.html', 'r') as collection_html:
-        return render_template_string(collection_html.read(), username=username)
+    return render_template('collection.html', username=username)
 
 @app.route("/<username>/collection/add")
 @login_required
 def collection_add(username):
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
-    with open('./html/collection_add.html', 'r') as collection_add_html:
-        return render_template_string(collection_add_html.read(), username=username)
+    return render_template('collection_add.html', username=username)
 
 @app.route("/generate_token", methods=["GET", "POST"])
 @login_required
 def generate_token():
-    logging.info(f"Handling {request.path} for client {request.remote_addr}")
     if request.method == "GET":
-        with open('./html/generate_token.html', 'r') as generate_token_html:
-            return render_template_string(generate_token_html.read())
+        return render_static_page('generate_token.html')
     elif request.method == "POST":
         with get_database_connection() as con:
             cur = con.cursor()
-            hasher = hashlib.new(HASH_FUNCTION)
 
             content_type = request.headers.get('Content-Type')
             if (content_type != 'application/json'):
                 error = {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             request_json = request.json
             if request_json == None:
                 error = {'successful': False, 'error': "Expected json body, but didn't find one"}
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             valid_until = request_json.get('valid_until')
             user_id, error = get_user_id(cur)
             if error:
-                return json.dumps(error)
+                return encoder.dumps(error)
 
             token_bytes = secrets.token_bytes(64)
             token_hex = token_bytes.hex()
-            hasher.update(token_bytes)
-            hashed_token_bytes = hasher.digest()
+            hashed_token_bytes = hash_token(token_bytes)
+
+            # Tokens are only ever added here, so sweeping here keeps the table from growing forever
+            sweep_expired_tokens(cur)
 
             cur.execute('''INSERT INTO APITokens(UserID, TokenHash, ValidUntil)
                         VALUES(%s, %s, %s)
                         ''', (user_id, hashed_token_bytes, valid_until))
 
             con.commit()
-            return json.dumps({'successful': True, 'token': token_hex, 'valid-until': valid_until})
+            return encoder.dumps({'successful': True, 'token': token_hex, 'valid-until': valid_until})
     else:
         return f"Unhandled REST method {request.method}"
 
+@app.route("/api/token", methods=["DELETE"])
+def api_revoke_token():
+    with get_database_connection() as con:
+        cur = con.cursor()
+
+        user_id, error = get_user_id(cur)
+        if error:
+            return encoder.dumps(error)
+
+        content_type = request.headers.get('Content-Type')
+        if (content_type != 'application/json'):
+            error = {'successful': False, 'error': f"Expected Content-Type: application/json, found {content_type}"}
+            return encoder.dumps(error)
+
+        request_json = request.json
+        if request_json == None:
+            error = {'successful': False, 'error': "Expected json body, but didn't find one"}
+            return encoder.dumps(error)
+
+        token = request_json.get('token')
+        if type(token) != str:
+            error = {'successful': False, 'error': "Expected key \"token\" to be the token to revoke"}
+            return encoder.dumps(error)
+
+        try:
+            hashed_token_bytes = hash_token(binascii.unhexlify(token))
+        except binascii.Error:
+            error = {'successful': False, 'error': "Token is invalid"}
+            return encoder.dumps(error)
+
+        # Users can only revoke their own tokens
+        res = cur.execute('''DELETE FROM APITokens
+                          WHERE TokenHash = %s AND UserID = %s
+                          RETURNING ID
+                          ''', (hashed_token_bytes, user_id))
+        revoked = res.fetchone() != None
+        if revoked:
+            # Tells the other workers to drop the tokens they've cached, see cache.check_token_generation()
+            cur.execute('UPDATE TokenGeneration SET Generation = Generation + 1')
+        con.commit()
+
+        api_token_cache.delete(hashed_token_bytes)
+
+        if not revoked:
+            error = {'successful': False, 'error': "Couldn't find that token"}
+            return encoder.dumps(error)
+
+        return encoder.dumps({'successful': True})
+
+# Per query call counts and time spent for the queries in the queries registry,
+# plus the cache and pool counters. Only this worker's numbers
+@app.route("/api/admin/stats")
+def api_admin_stats():
+    with get_database_connection() as con:
+        cur = con.cursor()
+
+        _, error = get_admin_user_id(cur)
+        if error:
+            return encoder.dumps(error)
+
+    return_obj = {
+        'successful': True,
+        'queries': queries.get_query_stats(),
+        'caches': cache.get_cache_stats(),
+        'pool': database.get_pool_stats()
+    }
+    return encoder.dumps(return_obj)
+
+# The slow statements this worker has seen, newest first. Each worker keeps its own,
+# so ask a few times to see more than one of them
+@app.route("/api/admin/slow_queries")
+def api_admin_slow_queries():
+    with get_database_connection() as con:
+        cur = con.cursor()
+
+        _, error = get_admin_user_id(cur)
+        if error:
+            return encoder.dumps(error)
+
+    return_obj = {
+        'successful': True,
+        'pid': os.getpid(),
+        'threshold_ms': slow_queries.THRESHOLD * 1000,
+        'explain_sample_rate': slow_queries.EXPLAIN_SAMPLE_RATE,
+        'queries': slow_queries.get_slow_queries()
+    }
+    return encoder.dumps(return_obj)
+
+# The newest background jobs (see jobs.py), with how far along the running one is and how fast it's going
+@app.route("/api/admin/jobs")
+def api_admin_jobs():
+    with get_database_connection() as con:
+        cur = con.cursor()
+
+        _, error = get_admin_user_id(cur)
+        if error:
+            return encoder.dumps(error)
+
+        return_obj = {
+            'successful': True,
+            'jobs': jobs.get_jobs(con)
+        }
+    return encoder.dumps(return_obj)
+
+# For Prometheus. Counts from every worker, see metrics.py
+@app.route("/metrics")
+def metrics_endpoint():
+    data, content_type = metrics.render()
+    return Response(data, content_type=content_type)
+
 @app.route("/deckbuilder")
 @login_required
 def deckbuilder():
@@ -981,56 +1945,59 @@ def logout():
 @app.route("/login", methods=['GET', 'POST'])
 def login():
     if request.method == 'GET':
-        with open('./html/login.html', 'r') as login:
-            return render_template_string(login.read())
+        return render_static_page('login.html')
 
     elif request.method == 'POST':
-        with get_database_connection() as con:
-            cur = con.cursor()
+        username = request.form.get('username')
+        password = request.form.get('password')
+        if username == None or username == "":
+            flash("Must enter a username")
+            return redirect(request.url)
 
-            username = request.form.get('username')
-            password = request.form.get('password')
-            if username == None or username == "":
-                flash("Must enter a username")
-                return redirect(request.url)
-
-            if password == None or password == "":
-                flash("Must enter a password")
-                return redirect(request.url)
+        if password == None or password == "":
+            flash("Must enter a password")
+            return redirect(request.url)
 
+        with get_database_connection() as con:
+            cur = con.cursor()
 
             res = cur.execute('''SELECT ID, PasswordHash FROM Users
                               WHERE Username = %s
                               ''', (username, ))
 
             row = res.fetchone()
-            if row == None:
-                flash("No user with that username exists")
-                return redirect(request.url)
-
 
-            id, password_hash = row
-            try:
-                ph.verify(password_hash, password)
-            except VerifyMismatchError:
-                flash("Incorrect password")
-                return redirect(request.url)
+        if row == None:
+            flash("No user with that username exists")
+            return redirect(request.url)
 
-            if ph.check_needs_rehash(password_hash):
-                cur.execute('''UPDATE Users
+        # The connection is back in the pool while we wait for the hash
+        id, password_hash = row
+        try:
+            matches, new_password_hash = passwords.verify_password(password_hash, password)
+        except passwords.Busy:
+            return password_hashing_busy('login.html')
+
+        if not matches:
+            flash("Incorrect password")
+            return redirect(request.url)
+
+        # The ARGON2_* parameters changed since this password was hashed
+        if new_password_hash != None:
+            with get_database_connection() as con:
+                con.execute('''UPDATE Users
                             SET PasswordHash = %s
                             WHERE ID = %s
-                            ''', (ph.hash(password), id))
-                con.commit()
+                            ''', (new_password_hash, id))
 
-            user = User(id, username)
-            user.is_authenticated = True
-            login_user(user)
+        user = User(id, username)
+        user.is_authenticated = True
+        login_user(user)
 
-            next = request.args.get('next')
-            if not is_safe_url(next):
-                return abort(400)
+        next = request.args.get('next')
+        if not is_safe_url(next):
+            return abort(400)
 
-            return redirect(next or url_for('index'))
+        return redirect(next or url_for('index'))
 
 logging.info("Finished main.py, now listening for connections")
@@ -0,0 +1,115 @@
+import os, contextvars, threading, timeit
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+# Prometheus metrics served at /metrics.
+#
+# Under gunicorn each worker is its own process with its own counters. When PROMETHEUS_MULTIPROC_DIR
+# is set (the Dockerfile sets it) every process writes its metrics to files in that directory
+# and /metrics adds up the files of all of them, so it doesn't matter which worker answers the scrape.
+# gunicorn.conf.py empties the directory on start and cleans up after workers that exit.
+# Without it (flask run) there's only the one process and the default registry is used.
+
+# Scripts like convert_scryfall_to_sql.py can be run before gunicorn has made it
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+REQUESTS = Counter('umori_http_requests', 'Requests handled', ['method', 'route', 'status'])
+REQUEST_DURATION = Histogram('umori_http_request_duration_seconds', 'Time spent handling a request', ['method', 'route'])
+# livesum so workers that have exited don't count
+REQUESTS_IN_PROGRESS = Gauge('umori_http_requests_in_progress', 'Requests being handled right now', ['method', 'route'],
+                             multiprocess_mode='livesum')
+
+# Every statement run through a pooled connection's cursors while handling the request, see database.py
+REQUEST_DB_DURATION = Histogram('umori_http_request_db_seconds', 'Time a request spent waiting on the database', ['method', 'route'])
+REQUEST_DB_QUERIES = Histogram('umori_http_request_db_queries', 'Statements a request ran', ['method', 'route'],
+                               buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, float('inf')))
+
+# Includes the time spent waiting for one of the password hashing processes, see passwords.py
+PASSWORD_HASH_DURATION = Histogram('umori_password_hash_duration_seconds', 'Time a password hash or verify took', ['operation'],
+                                   buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')))
+PASSWORD_HASH_REJECTED = Counter('umori_password_hash_rejected', 'Password hashes turned away because too many were waiting', ['operation'])
+
+# psycopg_pool's get_stats() -> gauge. These are how the pool is right now
+POOL_GAUGES = {
+    'pool_size': Gauge('umori_db_pool_size', 'Connections open, in use or not', ['pool'], multiprocess_mode='livesum'),
+    'pool_available': Gauge('umori_db_pool_available', 'Connections open and not in use', ['pool'], multiprocess_mode='livesum'),
+    'requests_waiting': Gauge('umori_db_pool_requests_waiting', 'Requests waiting for a connection', ['pool'], multiprocess_mode='livesum')
+}
+
+# psycopg_pool's get_stats() -> (counter, what to divide by to get the counter's unit).
+# These only go up, so we add what they went up by since we last looked
+POOL_COUNTERS = {
+    'requests_num': (Counter('umori_db_pool_requests', 'Connections asked for', ['pool']), 1),
+    'requests_queued': (Counter('umori_db_pool_requests_queued', 'Connections asked for that had to wait', ['pool']), 1),
+    'requests_wait_ms': (Counter('umori_db_pool_requests_wait_seconds', 'Time spent waiting for a connection', ['pool']), 1000),
+    'requests_errors': (Counter('umori_db_pool_requests_errors', 'Connections asked for that failed or timed out', ['pool']), 1),
+    'usage_ms': (Counter('umori_db_pool_usage_seconds', 'Time connections were borrowed for', ['pool']), 1000),
+    'connections_num': (Counter('umori_db_pool_connections', 'Connections opened', ['pool']), 1),
+    'connections_errors': (Counter('umori_db_pool_connections_errors', 'Connections that failed to open', ['pool']), 1),
+    'connections_lost': (Counter('umori_db_pool_connections_lost', 'Connections found broken by the pool check', ['pool']), 1)
+}
+
+_last_pool_stats = {}
+_pool_stats_lock = threading.Lock()
+
+# The database time of the request being handled, None outside of a request.
+# A context variable so each thread (Flask) and each task (asgi.py) sees its own request's
+_request_db = contextvars.ContextVar('request_db', default=None)
+
+class DatabaseTime:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+# Called by the cursors in database.py after each statement
+def record_query(seconds: float):
+    db = _request_db.get()
+    if db != None:
+        db.queries += 1
+        db.seconds += seconds
+
+# Times one request. Create it when the request starts and call finish() with the status when it's done.
+# route should be the route's pattern (/api/collection) rather than the path so there's one series per route
+class RequestTimer:
+    def __init__(self, method: str, route: str):
+        self.method = method
+        self.route = route
+        self.started_at = timeit.default_timer()
+        self.db = DatabaseTime()
+        _request_db.set(self.db)
+        REQUESTS_IN_PROGRESS.labels(method, route).inc()
+
+    # Returns how long the request took in seconds
+    def finish(self, status: int) -> float:
+        duration = timeit.default_timer() - self.started_at
+        _request_db.set(None)
+        REQUESTS_IN_PROGRESS.labels(self.method, self.route).dec()
+        REQUESTS.labels(self.method, self.route, str(status)).inc()
+        REQUEST_DURATION.labels(self.method, self.route).observe(duration)
+        REQUEST_DB_DURATION.labels(self.method, self.route).observe(self.db.seconds)
+        REQUEST_DB_QUERIES.labels(self.method, self.route).observe(self.db.queries)
+        return duration
+
+# pool is sync or async, stats are from the pool's get_stats()
+def record_pool_stats(pool: str, stats: dict[str, int]):
+    for name, gauge in POOL_GAUGES.items():
+        gauge.labels(pool).set(stats.get(name, 0))
+
+    # Keyed by pid too because a forked child starts a new pool with its counters at 0.
+    # Stats read by another thread can arrive after newer ones, so we only ever count up
+    with _pool_stats_lock:
+        last = _last_pool_stats.setdefault((pool, os.getpid()), {})
+        for name, (counter, divisor) in POOL_COUNTERS.items():
+            delta = stats.get(name, 0) - last.get(name, 0)
+            if delta > 0:
+                counter.labels(pool).inc(delta / divisor)
+                last[name] = stats[name]
+
+# Returns the body and content type of the /metrics response
+def render() -> tuple[bytes, str]:
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import psycopg, database, init_database, logs, logging, sys, timeit
+
+# The schema is changed by numbered migrations. The SchemaVersion table has a row for each one
+# that has been applied, so a database is at the highest version in it.
+#
+# They're applied once per deploy, by gunicorn's on_starting hook (see gunicorn.conf.py)
+# or by running this file. Workers only check that the database is at LATEST_VERSION (see check_version()),
+# so starting one doesn't take the migration lock or run any DDL.
+#
+# To change the schema add a function to the end of MIGRATIONS. Never change or reorder ones
+# that have been deployed, databases that already ran them won't run them again
+
+# Held for the whole migration transaction, so only one process migrates at a time
+MIGRATION_LOCK_ID = 0
+
+def initial_schema(cur: psycopg.Cursor):
+    init_database.create_schema(cur)
+
+# See jobs.py
+def create_jobs(cur: psycopg.Cursor):
+    cur.execute('''CREATE TYPE JobStatus AS ENUM ('queued', 'running', 'succeeded', 'failed')''')
+
+    # Stage, ItemsDone, ItemsTotal and Progress (a percentage, when ItemsTotal is known)
+    # are what the job last reported, saved by the heartbeat
+    cur.execute('''CREATE TABLE Jobs
+                (
+                ID             INTEGER     PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+                Kind           VARCHAR                                NOT NULL,
+                Status         JobStatus                              NOT NULL DEFAULT 'queued',
+                Attempts       INTEGER                                NOT NULL DEFAULT 0,
+                MaxAttempts    INTEGER                                NOT NULL,
+                RunAfter       TIMESTAMPTZ                            NOT NULL DEFAULT now(),
+                LeasedBy       VARCHAR                                        ,
+                LeaseExpiresAt TIMESTAMPTZ                                    ,
+                Stage          VARCHAR                                        ,
+                StageStartedAt TIMESTAMPTZ                                    ,
+                ItemsDone      BIGINT                                 NOT NULL DEFAULT 0,
+                ItemsTotal     BIGINT                                         ,
+                Progress       REAL                                           ,
+                Error          VARCHAR                                        ,
+                CreatedAt      TIMESTAMPTZ                            NOT NULL DEFAULT now(),
+                StartedAt      TIMESTAMPTZ                                    ,
+                HeartbeatAt    TIMESTAMPTZ                                    ,
+                FinishedAt     TIMESTAMPTZ
+                )
+                ''')
+
+    # At most one of each kind waiting or running, so every worker and deploy can enqueue an import
+    # without them piling up
+    cur.execute('''CREATE UNIQUE INDEX JobsActiveKindIndex
+                ON Jobs (Kind)
+                WHERE Status IN ('queued', 'running')
+                ''')
+
+# Bumped by api_revoke_token in main.py, workers use it to know
+# when to throw away the API tokens they've cached (see cache.py)
+def create_token_generation(cur: psycopg.Cursor):
+    cur.execute('''CREATE TABLE TokenGeneration
+                (
+                ID         INTEGER PRIMARY KEY CHECK (ID = 1),
+                Generation BIGINT  NOT NULL
+                )
+                ''')
+    cur.execute('''INSERT INTO TokenGeneration (ID, Generation)
+                VALUES (1, 0)
+                ''')
+
+# Version 1 is MIGRATIONS[0] and so on
+MIGRATIONS = [
+    initial_schema,
+    create_jobs,
+    create_token_generation
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+# 0 if no migration has been applied yet
+def get_version(cur: psycopg.Cursor) -> int:
+    cur.execute("SELECT to_regclass('SchemaVersion') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+
+    cur.execute('SELECT MAX(Version) FROM SchemaVersion')
+    version = cur.fetchone()[0]
+    return version if version != None else 0
+
+# Applies the migrations the database doesn't have yet in one transaction, so if one fails none of them are kept.
+# Returns the version the database is at afterwards
+def migrate() -> int:
+    with database.connect() as con:
+        cur = con.cursor()
+
+        # We use a lock here because multiple concurrent CREATE TABLE commands
+        # cause issues with postgres, see here
+        # https://www.postgresql.org/message-id/CA+TgmoZAdYVtwBfp1FL2sMZbiHCWT4UPrzRLNnX1Nb30Ku3-gg@mail.gmail.com
+        #
+        # It's a transaction level lock so it's released when we commit (or roll back)
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS SchemaVersion
+                    (
+                    Version   INTEGER     PRIMARY KEY,
+                    AppliedAt TIMESTAMPTZ             NOT NULL DEFAULT now()
+                    )
+                    ''')
+
+        version = get_version(cur)
+        if version > LATEST_VERSION:
+            logging.warning("Database schema is at version %s, newer than this code's %s. Not migrating", version, LATEST_VERSION)
+            return version
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info("Applying migration %s (%s)", number, migration.__name__)
+            started_at = timeit.default_timer()
+            migration(cur)
+            cur.execute('INSERT INTO SchemaVersion (Version) VALUES (%s)', (number,))
+            logging.info("Applied migration %s in %.2f seconds", number, timeit.default_timer() - started_at)
+            version = number
+
+    return version
+
+# What workers run on startup instead of migrating. It's a couple of catalog lookups, and it exits
+# if the migrations haven't been run so we don't serve requests against the wrong schema
+def check_version() -> int:
+    with database.get_database_connection() as con:
+        version = get_version(con.cursor())
+
+    if version < LATEST_VERSION:
+        logging.error("Database schema is at version %s but this code needs version %s. Run python migrations.py", version, LATEST_VERSION)
+        exit(1)
+    elif version > LATEST_VERSION:
+        # Probably a rollback, the old code can usually still run against a newer schema
+        logging.warning("Database schema is at version %s, newer than this code's %s", version, LATEST_VERSION)
+
+    return version
+
+if __name__ == '__main__':
+    logs.setup()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        with database.connect() as con:
+            version = get_version(con.cursor())
+        print(f"Database schema is at version {version}, the latest is {LATEST_VERSION}")
+        exit(0 if version >= LATEST_VERSION else 1)
+
+    version = migrate()
+    print(f"Database schema is at version {version}")
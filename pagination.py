@@ -0,0 +1,51 @@
+import base64, binascii, json, uuid
+from datetime import date
+
+# Listings are sorted by (Name, ReleasedAt DESC, ID). A cursor is the sort key of the last
+# row on a page, and the next page is the rows that come after it in that order.
+# Unlike an OFFSET that doesn't get slower the deeper you go,
+# and cards added or removed before the cursor don't shift what's on the next page.
+#
+# To clients a cursor is an opaque string, we don't promise anything about what's in it
+
+class InvalidCursorError(Exception):
+    pass
+
+def encode_cursor(name: str, released_at: date, id_: uuid.UUID | int) -> str:
+    key = json.dumps([name, released_at.isoformat(), str(id_)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+# id_type is what the ID column holds, uuid.UUID for Cards and int for Collections.
+# Returns the parameters keyset_filter() needs
+def decode_cursor(cursor: str, id_type: type) -> dict:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        name, released_at, id_ = key
+        if not isinstance(name, str) or not isinstance(released_at, str) or not isinstance(id_, str):
+            raise ValueError()
+
+        return {
+            'after_name': name,
+            'after_released_at': date.fromisoformat(released_at),
+            'after_id': id_type(id_)
+        }
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidCursorError(f"Invalid cursor {cursor}")
+
+# The rows after decode_cursor()'s parameters. There's no row comparison for mixed directions,
+# so it's spelled out. The first comparison is implied by the rest,
+# but it gives the planner a range to start the index scan at
+def keyset_filter(name: str, released_at: str, id_: str) -> str:
+    return f'''{name} >= %(after_name)s
+               AND ({name} > %(after_name)s
+                    OR ({name} = %(after_name)s
+                        AND ({released_at} < %(after_released_at)s
+                             OR ({released_at} = %(after_released_at)s AND {id_} > %(after_id)s))))'''
+
+# Cursor pages are fetched with one row more than page_size, if it's there
+# we know there's a next page. Returns the page and the cursor for the next one
+def split_page(rows: list[tuple], page_size: int, cursor_of) -> tuple[list[tuple], str | None]:
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, cursor_of(rows[-1])
+    return rows, None
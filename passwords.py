@@ -0,0 +1,110 @@
+import argon2, config, metrics, multiprocessing, os, threading, timeit
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from argon2.exceptions import VerifyMismatchError
+
+# Argon2 is slow on purpose, with the default parameters a hash or a verify keeps a core busy for a few hundred milliseconds.
+# Done in the worker handling the request a burst of logins takes every core from the API routes,
+# so it's done by a pool of PASSWORD_HASH_PROCESSES processes instead. Each gunicorn worker has its own pool.
+#
+# At most PASSWORD_HASH_MAX_PENDING hashes can be running or waiting for a process. Past that hash_password()
+# and verify_password() raise Busy right away, instead of queueing behind the others, and login and signup answer 503.
+#
+# Changing the ARGON2_* parameters doesn't break existing hashes, each hash says what it was made with.
+# verify_password() returns a new hash for passwords whose hash was made with other parameters
+
+PROCESSES = int(config.get('PASSWORD_HASH_PROCESSES'))
+MAX_PENDING = int(config.get('PASSWORD_HASH_MAX_PENDING'))
+TIMEOUT = float(config.get('PASSWORD_HASH_TIMEOUT'))
+
+class Busy(Exception):
+    pass
+
+_pool = None
+_pool_pid = None
+_pending = None
+_pool_lock = threading.Lock()
+
+# Only set in the pool's processes
+_hasher = None
+
+def get_hasher() -> argon2.PasswordHasher:
+    return argon2.PasswordHasher(
+        time_cost=int(config.get('ARGON2_TIME_COST')),
+        # KiB
+        memory_cost=int(config.get('ARGON2_MEMORY_COST')),
+        parallelism=int(config.get('ARGON2_PARALLELISM'))
+    )
+
+def _init_process():
+    global _hasher
+    _hasher = get_hasher()
+
+def _hash(password: str) -> str:
+    return _hasher.hash(password)
+
+def _verify(password_hash: str, password: str) -> tuple[bool, str | None]:
+    try:
+        _hasher.verify(password_hash, password)
+    except VerifyMismatchError:
+        return False, None
+
+    if _hasher.check_needs_rehash(password_hash):
+        return True, _hasher.hash(password)
+    return True, None
+
+# Like database.get_pool(), a forked child can't use its parent's pool so it makes its own
+def get_pool() -> tuple[ProcessPoolExecutor, threading.BoundedSemaphore]:
+    global _pool, _pool_pid, _pending
+
+    pid = os.getpid()
+    with _pool_lock:
+        if _pool == None or _pool_pid != pid:
+            # forkserver instead of fork, forking a worker copies its threads' locks in whatever state they're in
+            _pool = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context('forkserver'), initializer=_init_process)
+            _pending = threading.BoundedSemaphore(MAX_PENDING)
+            _pool_pid = pid
+
+        return _pool, _pending
+
+def _run(operation: str, fn, *args):
+    global _pool
+
+    pool, pending = get_pool()
+    if not pending.acquire(blocking=False):
+        metrics.PASSWORD_HASH_REJECTED.labels(operation).inc()
+        raise Busy()
+
+    started_at = timeit.default_timer()
+    try:
+        future = pool.submit(fn, *args)
+    except BaseException:
+        pending.release()
+        raise
+    # Released when the process is done with it, even if we stopped waiting
+    future.add_done_callback(lambda _: pending.release())
+
+    try:
+        result = future.result(timeout=TIMEOUT)
+    except TimeoutError:
+        metrics.PASSWORD_HASH_REJECTED.labels(operation).inc()
+        raise Busy()
+    except BrokenProcessPool:
+        # One of the processes died (likely out of memory with a big ARGON2_MEMORY_COST), the next call starts a new pool
+        with _pool_lock:
+            if _pool == pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                _pool = None
+        raise
+
+    metrics.PASSWORD_HASH_DURATION.labels(operation).observe(timeit.default_timer() - started_at)
+    return result
+
+# Raises Busy if too many hashes are waiting already
+def hash_password(password: str) -> str:
+    return _run('hash', _hash, password)
+
+# Returns whether the password matches, and a new hash to save if the parameters have changed since it was hashed.
+# Raises Busy like hash_password()
+def verify_password(password_hash: str, password: str) -> tuple[bool, str | None]:
+    return _run('verify', _verify, password_hash, password)
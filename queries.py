@@ -0,0 +1,76 @@
+import psycopg, threading, timeit
+
+# The hot queries, registered by name when main.py is imported.
+# Executing one asks psycopg to prepare it. psycopg remembers which statements each
+# connection has already prepared, and the pool keeps connections around, so every
+# statement is parsed and planned once per pooled connection and reused after that.
+#
+# After five executions of a prepared statement postgres may switch to one generic plan for every parameter,
+# which is bad for queries whose best plan depends on the parameters. Register those with prepare=False,
+# they're still counted here but planned again for each execution
+_queries = {}
+
+class PreparedQuery:
+    def __init__(self, name: str, sql: str, prepare: bool = True):
+        self.name = name
+        self.sql = sql
+        self.prepare = prepare
+        self.calls = 0
+        self.errors = 0
+        # Seconds spent in execute(), which includes waiting for the results
+        self.total_time = 0.0
+        self._lock = threading.Lock()
+
+    def _record(self, started_at: float, failed: bool):
+        elapsed = timeit.default_timer() - started_at
+        with self._lock:
+            self.calls += 1
+            self.total_time += elapsed
+            if failed:
+                self.errors += 1
+
+    # Returns cur so it can be used like cur.execute()
+    def execute(self, cur: psycopg.Cursor, params: tuple | list = ()) -> psycopg.Cursor:
+        started_at = timeit.default_timer()
+        failed = True
+        try:
+            cur.execute(self.sql, params, prepare=self.prepare)
+            failed = False
+        finally:
+            self._record(started_at, failed)
+        return cur
+
+    async def execute_async(self, cur: psycopg.AsyncCursor, params: tuple | list = ()) -> psycopg.AsyncCursor:
+        started_at = timeit.default_timer()
+        failed = True
+        try:
+            await cur.execute(self.sql, params, prepare=self.prepare)
+            failed = False
+        finally:
+            self._record(started_at, failed)
+        return cur
+
+    def get_stats(self) -> dict[str, int | float]:
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'total_ms': self.total_time * 1000,
+                'mean_ms': self.total_time * 1000 / self.calls if self.calls > 0 else 0.0
+            }
+
+def register(name: str, sql: str, prepare: bool = True) -> PreparedQuery:
+    if name in _queries:
+        raise ValueError(f"A query named {name} is already registered")
+
+    query = PreparedQuery(name, sql, prepare)
+    _queries[name] = query
+    return query
+
+def get(name: str) -> PreparedQuery:
+    return _queries[name]
+
+# Sorted by total time so the queries worth tuning come first
+def get_query_stats() -> dict[str, dict[str, int | float]]:
+    stats = {name: query.get_stats() for name, query in _queries.items()}
+    return dict(sorted(stats.items(), key=lambda item: item[1]['total_ms'], reverse=True))
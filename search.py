@@ -0,0 +1,326 @@
+import re
+
+# Compiles Scryfall style searches like
+#   t:creature c:rg cmc<=3 o:"draw a card" set:stx f:modern
+# into a parameterized WHERE clause over Cards.
+#
+# Terms next to each other are ANDed, "or" between terms ORs them,
+# parentheses group and a leading - negates. Bare words match the name.
+#
+# Each kind of term is written so it can use an index created in init_database.create_schema():
+#   name, t:, o:  trigram indexes on LOWER(Name), LOWER(TypeLine) and LOWER(OracleText)
+#   c:, id:       the (ColorID, CardID) indexes on ColorCards and ColorIdentityCards
+#   kw:           the (KeywordID, CardID) index on KeywordCards
+#   cmc:          CardsCmcIndex
+#   set:          the UNIQUE(SetID, CollectorNumber, LangID) index
+# r:, f: and banned: match most of the catalog so they're applied as filters on whatever the other terms found.
+
+class QuerySyntaxError(Exception):
+    pass
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<open>\() |
+        (?P<close>\)) |
+        (?P<negate>-)(?=[^\s)]) |
+        (?P<key>[a-zA-Z]+)(?P<op><=|>=|!=|:|=|<|>)(?P<value>"[^"]*"|[^\s()"]*) |
+        (?P<word>"[^"]*"|[^\s()"]+)
+    )''', re.VERBOSE)
+
+COLORS = {'w': 'W', 'u': 'U', 'b': 'B', 'r': 'R', 'g': 'G'}
+COLOR_NAMES = {'white': 'w', 'blue': 'u', 'black': 'b', 'red': 'r', 'green': 'g'}
+
+# Format name -> the Cards column with its legality
+FORMATS = {
+    'standard': 'LegalStandardID',
+    'future': 'LegalFutureID',
+    'historic': 'LegalHistoricID',
+    'gladiator': 'LegalGladiatorID',
+    'pioneer': 'LegalPioneerID',
+    'explorer': 'LegalExplorerID',
+    'modern': 'LegalModernID',
+    'legacy': 'LegalLegacyID',
+    'pauper': 'LegalPauperID',
+    'vintage': 'LegalVintageID',
+    'penny': 'LegalPennyID',
+    'commander': 'LegalCommanderID',
+    'brawl': 'LegalBrawlID',
+    'historicbrawl': 'LegalHistoricBrawlID',
+    'alchemy': 'LegalAlchemyID',
+    'paupercommander': 'LegalPauperCommanderID',
+    'duel': 'LegalDuelID',
+    'oldschool': 'LegalOldschoolID',
+    'premodern': 'LegalPremodernID'
+}
+
+NUMBER_OPS = {':': '=', '=': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+# Escape LIKE wildcards so they're matched literally
+def escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def contains_pattern(text: str) -> str:
+    return f'%{escape_like(text.lower())}%'
+
+def tokenize(text: str) -> list[tuple]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_RE.match(text, position)
+        if match == None or match.end() == position:
+            raise QuerySyntaxError(f"Couldn't understand the search at \"{text[position:].strip()}\", is there a missing quote?")
+        position = match.end()
+
+        if match.group('open'):
+            tokens.append(('open',))
+        elif match.group('close'):
+            tokens.append(('close',))
+        elif match.group('negate'):
+            tokens.append(('negate',))
+        elif match.group('key'):
+            tokens.append(('term', match.group('key').lower(), match.group('op'), unquote(match.group('value'))))
+        else:
+            word = match.group('word')
+            if word.lower() == 'or':
+                tokens.append(('or',))
+            elif word.lower() == 'and':
+                # Terms are already ANDed, so this is just for readability
+                continue
+            else:
+                tokens.append(('term', 'name', ':', unquote(word)))
+
+    return tokens
+
+def unquote(value: str) -> str:
+    if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    return value
+
+# Recursive descent over the tokens. Each parse_* returns (sql, params)
+class Parser:
+    def __init__(self, tokens: list[tuple]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> tuple | None:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self) -> tuple:
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self) -> tuple[str, list]:
+        sql, params = self.parse_or()
+        if self.peek() != None:
+            raise QuerySyntaxError("Found a \")\" without a matching \"(\"")
+        return sql, params
+
+    def parse_or(self) -> tuple[str, list]:
+        clauses = [self.parse_and()]
+        while self.peek() == ('or',):
+            self.next()
+            clauses.append(self.parse_and())
+        return join_clauses('OR', clauses)
+
+    def parse_and(self) -> tuple[str, list]:
+        clauses = []
+        while self.peek() not in (None, ('or',), ('close',)):
+            clauses.append(self.parse_unary())
+
+        if len(clauses) == 0:
+            raise QuerySyntaxError("Expected a search term")
+        return join_clauses('AND', clauses)
+
+    def parse_unary(self) -> tuple[str, list]:
+        token = self.next()
+        if token == ('negate',):
+            if self.peek() in (None, ('or',), ('close',)):
+                raise QuerySyntaxError("Expected a search term after \"-\"")
+            sql, params = self.parse_unary()
+            return f'NOT ({sql})', params
+        elif token == ('open',):
+            sql, params = self.parse_or()
+            if self.peek() != ('close',):
+                raise QuerySyntaxError("Found a \"(\" without a matching \")\"")
+            self.next()
+            return sql, params
+        elif token[0] == 'term':
+            _, key, op, value = token
+            return compile_term(key, op, value)
+        else:
+            raise QuerySyntaxError(f"Didn't expect \"{token[0]}\" here")
+
+def join_clauses(operator: str, clauses: list[tuple[str, list]]) -> tuple[str, list]:
+    if len(clauses) == 1:
+        return clauses[0]
+
+    params = []
+    for _, clause_params in clauses:
+        params += clause_params
+    return f' {operator} '.join(f'({sql})' for sql, _ in clauses), params
+
+def require_op(key: str, op: str, allowed: tuple[str, ...]):
+    if op not in allowed:
+        raise QuerySyntaxError(f"\"{key}\" doesn't support \"{op}\", expected one of {', '.join(allowed)}")
+
+def compile_name(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, (':',))
+    return 'LOWER(Cards.Name) LIKE %s', [contains_pattern(value)]
+
+def compile_type(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, (':',))
+    # TypeLine has every face's type in it, so we don't need to look at Faces
+    return 'LOWER(Cards.TypeLine) LIKE %s', [contains_pattern(value)]
+
+def compile_oracle(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, (':',))
+    # Cards with more than one face only have oracle text on their faces.
+    # The UNION keeps both halves on their own trigram index instead of an OR that has to scan Cards
+    pattern = contains_pattern(value)
+    return '''Cards.ID IN (SELECT ID FROM Cards WHERE LOWER(OracleText) LIKE %s
+                           UNION
+                           SELECT CardID FROM Faces WHERE LOWER(OracleText) LIKE %s)''', [pattern, pattern]
+
+def parse_colors(key: str, value: str) -> list[str]:
+    value = COLOR_NAMES.get(value.lower(), value.lower())
+    colors = []
+    for letter in value:
+        if letter not in COLORS:
+            raise QuerySyntaxError(f"Unknown color \"{letter}\" in \"{key}\", expected some of w, u, b, r, g, c or m")
+        if COLORS[letter] not in colors:
+            colors.append(COLORS[letter])
+    return colors
+
+def colors_compiler(junction: str):
+    def compile_colors(key: str, op: str, value: str) -> tuple[str, list]:
+        require_op(key, op, tuple(NUMBER_OPS))
+
+        # Cards with at least one of colors
+        def has_any(colors):
+            return (f'''Cards.ID IN (SELECT CardID FROM {junction}
+                                     WHERE ColorID IN (SELECT ID FROM Colors WHERE Color = ANY(%s)))''', [colors])
+
+        # Cards with all of colors
+        def has_all(colors):
+            return (f'''Cards.ID IN (SELECT CardID FROM {junction}
+                                     WHERE ColorID IN (SELECT ID FROM Colors WHERE Color = ANY(%s))
+                                     GROUP BY CardID
+                                     HAVING COUNT(*) = %s)''', [colors, len(colors)])
+
+        # Cards without any color outside of colors
+        def only(colors):
+            outside = [color for color in COLORS.values() if color not in colors]
+            sql, params = has_any(outside)
+            return f'NOT ({sql})', params
+
+        lower_value = value.lower()
+        if lower_value in ('c', 'colorless'):
+            require_op(key, op, (':', '=', '!='))
+            sql, params = has_any(list(COLORS.values()))
+            return (sql, params) if op == '!=' else (f'NOT ({sql})', params)
+
+        if lower_value in ('m', 'multicolor'):
+            require_op(key, op, (':',))
+            return (f'''Cards.ID IN (SELECT CardID FROM {junction}
+                                     GROUP BY CardID
+                                     HAVING COUNT(*) > 1)''', [])
+
+        colors = parse_colors(key, value)
+        if op in (':', '>='):
+            return has_all(colors)
+        elif op == '<=':
+            return only(colors)
+        elif op == '=':
+            return join_clauses('AND', [has_all(colors), only(colors)])
+        elif op == '!=':
+            sql, params = join_clauses('AND', [has_all(colors), only(colors)])
+            return f'NOT ({sql})', params
+        elif op == '>':
+            outside = [color for color in COLORS.values() if color not in colors]
+            return join_clauses('AND', [has_all(colors), has_any(outside)])
+        else:
+            sql, params = has_all(colors)
+            return join_clauses('AND', [only(colors), (f'NOT ({sql})', params)])
+
+    return compile_colors
+
+def compile_cmc(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, tuple(NUMBER_OPS))
+    try:
+        number = float(value)
+    except ValueError:
+        raise QuerySyntaxError(f"Expected a number for \"{key}\", got \"{value}\"")
+    return f'Cards.Cmc {NUMBER_OPS[op]} %s', [number]
+
+def compile_set(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, (':', '='))
+    # Scryfall set codes are lower case, so this can use the UNIQUE index on Code
+    return 'Cards.SetID IN (SELECT ID FROM Sets WHERE Code = %s)', [value.lower()]
+
+def compile_rarity(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, (':', '='))
+    return 'Cards.RarityID IN (SELECT ID FROM Rarities WHERE Rarity = %s)', [value.lower()]
+
+def legality_compiler(legalities: list[str]):
+    def compile_legality(key: str, op: str, value: str) -> tuple[str, list]:
+        require_op(key, op, (':', '='))
+        column = FORMATS.get(value.lower())
+        if column == None:
+            raise QuerySyntaxError(f"Unknown format \"{value}\", expected one of {', '.join(FORMATS)}")
+        # column comes from FORMATS so it's safe to put in the SQL
+        return f'Cards.{column} IN (SELECT ID FROM Legalities WHERE Legality = ANY(%s))', [legalities]
+
+    return compile_legality
+
+def compile_keyword(key: str, op: str, value: str) -> tuple[str, list]:
+    require_op(key, op, (':', '='))
+    return '''Cards.ID IN (SELECT CardID FROM KeywordCards
+                           WHERE KeywordID IN (SELECT ID FROM Keywords WHERE LOWER(Keyword) = %s))''', [value.lower()]
+
+TERM_COMPILERS = {
+    'name': compile_name,
+    't': compile_type,
+    'type': compile_type,
+    'o': compile_oracle,
+    'oracle': compile_oracle,
+    'c': colors_compiler('ColorCards'),
+    'color': colors_compiler('ColorCards'),
+    'id': colors_compiler('ColorIdentityCards'),
+    'identity': colors_compiler('ColorIdentityCards'),
+    'cmc': compile_cmc,
+    'mv': compile_cmc,
+    'manavalue': compile_cmc,
+    's': compile_set,
+    'e': compile_set,
+    'set': compile_set,
+    'edition': compile_set,
+    'r': compile_rarity,
+    'rarity': compile_rarity,
+    # Restricted cards can still be played in the format
+    'f': legality_compiler(['legal', 'restricted']),
+    'format': legality_compiler(['legal', 'restricted']),
+    'legal': legality_compiler(['legal', 'restricted']),
+    'banned': legality_compiler(['banned']),
+    'kw': compile_keyword,
+    'keyword': compile_keyword
+}
+
+def compile_term(key: str, op: str, value: str) -> tuple[str, list]:
+    compiler = TERM_COMPILERS.get(key)
+    if compiler == None:
+        raise QuerySyntaxError(f"Unknown search keyword \"{key}\"")
+    if value == '':
+        raise QuerySyntaxError(f"Expected a value after \"{key}{op}\"")
+    return compiler(key, op, value)
+
+# Returns a WHERE clause over Cards (without the WHERE) and its parameters.
+# Raises QuerySyntaxError with a message that can be shown to the user
+def compile_query(text: str) -> tuple[str, list]:
+    tokens = tokenize(text)
+    if len(tokens) == 0:
+        return 'TRUE', []
+    return Parser(tokens).parse()
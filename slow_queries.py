@@ -0,0 +1,106 @@
+import psycopg, config, logging, random, re, threading
+from collections import deque
+from datetime import datetime, timezone
+
+# Statements that take longer than SLOW_QUERY_THRESHOLD_MS are logged by the cursors in database.py.
+# We log the shape of their parameters (types and lengths) instead of the values so user data stays out of the logs.
+# A sample of them are run again under EXPLAIN (ANALYZE, BUFFERS) and the plan is kept with them.
+# Each process keeps its last SLOW_QUERY_LOG_SIZE slow statements for /api/admin/slow_queries
+
+THRESHOLD = float(config.get('SLOW_QUERY_THRESHOLD_MS')) / 1000
+EXPLAIN_SAMPLE_RATE = float(config.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE'))
+
+_slow_queries = deque(maxlen=int(config.get('SLOW_QUERY_LOG_SIZE')))
+_lock = threading.Lock()
+
+# EXPLAIN ANALYZE runs the statement, so only explain ones that can't change anything
+READ_ONLY_RE = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+WRITE_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|FOR\s+UPDATE|FOR\s+SHARE)\b', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+def _value_shape(value) -> str:
+    if isinstance(value, (list, tuple)):
+        types = sorted({type(item).__name__ for item in value})
+        return f"{type(value).__name__}[{'|'.join(types)}] of {len(value)}"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__} of {len(value)}"
+    return type(value).__name__
+
+# ('bolt', 25, 0) -> (str of 4, int, int)
+def params_shape(params) -> str:
+    if params == None:
+        return 'None'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{key}: {_value_shape(value)}' for key, value in params.items()) + '}'
+    return '(' + ', '.join(_value_shape(value) for value in params) + ')'
+
+def query_text(query) -> str:
+    if isinstance(query, bytes):
+        query = query.decode()
+    elif not isinstance(query, str):
+        # sql.SQL and sql.Composed
+        query = repr(query)
+    return WHITESPACE_RE.sub(' ', query).strip()
+
+def should_explain(query: str) -> bool:
+    return EXPLAIN_SAMPLE_RATE > 0 and random.random() < EXPLAIN_SAMPLE_RATE \
+        and READ_ONLY_RE.match(query) != None and WRITE_RE.search(query) == None
+
+def _entry(query: str, params, seconds: float) -> dict:
+    return {
+        'at': datetime.now(timezone.utc),
+        'duration_ms': seconds * 1000,
+        'query': query,
+        'params': params_shape(params),
+        'plan': None
+    }
+
+def _log(entry: dict):
+    logging.warning("Slow query (%.0f ms): %s params %s", entry['duration_ms'], entry['query'], entry['params'])
+    with _lock:
+        _slow_queries.append(entry)
+
+# The statement is run again inside a savepoint, so if EXPLAIN fails
+# the transaction the statement was part of can carry on
+def explain(con: psycopg.Connection, query, params) -> str:
+    with con.transaction():
+        cur = psycopg.ClientCursor(con)
+        res = cur.execute(b'EXPLAIN (ANALYZE, BUFFERS) ' + cur.mogrify(query, params).encode())
+        return '\n'.join(row[0] for row in res.fetchall())
+
+async def explain_async(con: psycopg.AsyncConnection, query, params) -> str:
+    async with con.transaction():
+        cur = psycopg.AsyncClientCursor(con)
+        res = await cur.execute(b'EXPLAIN (ANALYZE, BUFFERS) ' + cur.mogrify(query, params).encode())
+        return '\n'.join(row[0] for row in await res.fetchall())
+
+# Called by the cursors in database.py after each statement that didn't raise.
+# executemany() has no one set of parameters to explain with, so it passes can_explain=False
+def record(con: psycopg.Connection, query, params, seconds: float, can_explain: bool = True):
+    if seconds < THRESHOLD:
+        return
+
+    entry = _entry(query_text(query), params, seconds)
+    if can_explain and should_explain(entry['query']):
+        try:
+            entry['plan'] = explain(con, query, params)
+        except psycopg.Error as e:
+            logging.warning("Couldn't EXPLAIN slow query: %s", e)
+    _log(entry)
+
+async def record_async(con: psycopg.AsyncConnection, query, params, seconds: float, can_explain: bool = True):
+    if seconds < THRESHOLD:
+        return
+
+    entry = _entry(query_text(query), params, seconds)
+    if can_explain and should_explain(entry['query']):
+        try:
+            entry['plan'] = await explain_async(con, query, params)
+        except psycopg.Error as e:
+            logging.warning("Couldn't EXPLAIN slow query: %s", e)
+    _log(entry)
+
+# Newest first
+def get_slow_queries() -> list[dict]:
+    with _lock:
+        return list(reversed(_slow_queries))
@@ -1,4 +1,28 @@
 var close_modal_callback = null
+// scryfall_id -> the response /api/all_cards/languages would give for it
+var preloaded_languages = new Map();
+
+// Fetches the language options of a page of cards in one request
+// so opening the modal for any of them doesn't need to
+async function preload_languages(scryfall_ids) {
+    if (scryfall_ids.length == 0) {
+        return;
+    }
+
+    const response = await fetch(`/api/all_cards/languages/many`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({"scryfall_ids": scryfall_ids})
+    });
+    const languages_response = await response.json();
+
+    preloaded_languages.clear();
+    for (const [scryfall_id, languages] of Object.entries(languages_response.data)) {
+        preloaded_languages.set(scryfall_id, languages);
+    }
+}
 
 function set_modal_card(scryfall_id) {
     var modal_card = document.getElementById("modal-card-img");
@@ -72,9 +96,14 @@ async function populate_modal(scryfall_id, collection_id = null) {
     var alter_input = document.getElementById('alter-input');
     var notes_input = document.getElementById('notes');
     var fetechs = [
-        fetch(`/api/by_id?scryfall_id=${scryfall_id}`),
-        fetch(`/api/all_cards/languages?scryfall_id=${scryfall_id}`)
+        fetch(`/api/by_id?scryfall_id=${scryfall_id}`)
     ]
+    if (preloaded_languages.has(scryfall_id)) {
+        fetechs.push(new Response(JSON.stringify(preloaded_languages.get(scryfall_id))));
+    }
+    else {
+        fetechs.push(fetch(`/api/all_cards/languages?scryfall_id=${scryfall_id}`));
+    }
     if (collection_id != null) {
         const username = new URL(window.location.href).pathname.split('/')[1];
         fetechs.push(fetch(`/api/collection/by_id?collection_id=${collection_id}&username=${username}`))
@@ -227,4 +256,4 @@ function init_modal(close_callback) {
     });
 }
 
-export {init_modal, populate_modal, set_modal_card, close_modal}
+export {init_modal, populate_modal, preload_languages, set_modal_card, close_modal}
@@ -1,5 +1,5 @@
 import {create_page_nav, add_page, initialize, create_notification} from './paged_cards.js'
-import {init_modal, populate_modal, set_modal_card, close_modal} from './card_details_modal.js'
+import {init_modal, populate_modal, preload_languages, set_modal_card, close_modal} from './card_details_modal.js'
 
 function plus_minus_listener(card, card_data, amount){
     const username = new URL(window.location.href).pathname.split('/')[1];
@@ -254,6 +254,7 @@ async function load_page(page_num, search_query) {
         grid.removeChild(grid.lastChild);
     }
     add_page(response.cards, create_card);
+    preload_languages(response.cards.map(card => card.scryfall_id));
 }
 
 async function main() {
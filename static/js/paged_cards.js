@@ -37,10 +37,13 @@ async function add_page(cards_data, create_card) {
     })
         .then(response => response.json())
         .then(cards_response => {
-            // TODO: Check the "not_found" member of cards_response
-            // to ensure we got everything
-            // TODO: Test what happens if you get only one result
-            // the "object" member, might help there
+            // data is in the same order as the ids we sent, minus any that weren't found
+            var not_found = new Set(cards_response.not_found);
+            if (not_found.size > 0) {
+                console.log("Couldn't find these cards:");
+                console.log(cards_response.not_found);
+                cards_data = cards_data.filter(card => !not_found.has(card.scryfall_id));
+            }
 
             for (var i = 0; i < cards_data.length; i++) {
                 var collection_card = cards_data[i];
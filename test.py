@@ -1,4 +1,7 @@
-import requests, unittest, subprocess, psycopg, os
+import requests, unittest, subprocess, psycopg, os, sys, json, uuid, logging, time, timeit, gzip
+import argon2
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
 import selenium
 from selenium.webdriver.common.by import By
@@ -7,9 +10,20 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support.select import Select
 from selenium.webdriver.remote.webelement import WebElement
+import assets
+import cache
 import config
 import convert_scryfall_to_sql
+import encoder
 import main
+import migrations
+import jobs
+import passwords
+import search
+import pagination
+import slow_queries
+import logs
+import flask
 from flask import Flask
 from flask_testing import LiveServerTestCase
 
@@ -306,12 +320,1322 @@ class UserTests(LiveServerTestCase):
     def tearDown(self):
         self.driver.close()
 
+class ConcurrencyTests(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        delete_dynamic_data()
+
+    def setUp(self):
+        # Sign up to get a session cookie we can use for the API
+        self.session = requests.Session()
+        response = self.session.post(self.get_server_url() + SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 200)
+
+    def create_app(self):
+
+        app = main.app
+        app.config['TESTING'] = True
+        # Default port is 5000
+        app.config['LIVESERVER_PORT'] = 8943
+        # Default timeout is 5 seconds
+        app.config['LIVESERVER_TIMEOUT'] = 10
+        return app
+
+    # Lots of +1 clicks at the same time should all be counted
+    def test_parallel_increments(self):
+        num_requests = 50
+
+        with get_database_connection() as con:
+            res = con.execute('''SELECT FinishCards.CardID FROM FinishCards
+                              INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
+                              WHERE Finishes.Finish = 'nonfoil'
+                              LIMIT 1''')
+            scryfall_id = str(res.fetchone()[0])
+
+        body = {
+            'scryfall_id': scryfall_id,
+            'quantity': 1,
+            'finish': 'nonfoil',
+            'condition': 'Near Mint',
+            'signed': False,
+            'altered': False,
+            'notes': '',
+            'username': USERNAME
+        }
+
+        def increment(_):
+            return requests.post(self.get_server_url() + '/api/collection', json=body, cookies=self.session.cookies).json()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(increment, range(num_requests)))
+
+        for result in results:
+            self.assertTrue(result['successful'], result)
+            self.assertEqual(result['delta'], 1)
+
+        # Every request saw a different total, so none of them overwrote another
+        self.assertEqual(sorted(result['new_total'] for result in results), list(range(1, num_requests + 1)))
+
+        with get_database_connection() as con:
+            res = con.execute('''SELECT Collections.Quantity FROM Collections
+                              INNER JOIN Users ON Collections.UserID = Users.ID
+                              WHERE Users.Username = %s''', (USERNAME,))
+            self.assertEqual(res.fetchall(), [(num_requests,)])
+
+class BatchTests(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        delete_dynamic_data()
+
+        with get_database_connection() as con:
+            res = con.execute('''SELECT FinishCards.CardID FROM FinishCards
+                              INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
+                              WHERE Finishes.Finish = 'nonfoil'
+                              LIMIT 2''')
+            cls.first_id, cls.second_id = [str(row[0]) for row in res.fetchall()]
+
+    def setUp(self):
+        self.session = requests.Session()
+        response = self.session.post(self.get_server_url() + SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 200)
+
+    def tearDown(self):
+        delete_dynamic_data()
+
+    def create_app(self):
+
+        app = main.app
+        app.config['TESTING'] = True
+        # Default port is 5000
+        app.config['LIVESERVER_PORT'] = 8943
+        # Default timeout is 5 seconds
+        app.config['LIVESERVER_TIMEOUT'] = 10
+        return app
+
+    def operation(self, op: str, scryfall_id: str, quantity, **kwargs) -> dict:
+        operation = {
+            'op': op,
+            'scryfall_id': scryfall_id,
+            'quantity': quantity,
+            'finish': 'nonfoil',
+            'condition': 'Near Mint',
+            'signed': False,
+            'altered': False,
+            'notes': ''
+        }
+        operation.update(kwargs)
+        return operation
+
+    def batch(self, operations: list) -> dict:
+        body = {'username': USERNAME, 'operations': operations}
+        return requests.post(self.get_server_url() + '/api/collection/batch', json=body, cookies=self.session.cookies).json()
+
+    # scryfall id -> quantity
+    def get_quantities(self) -> dict[str, int]:
+        with get_database_connection() as con:
+            res = con.execute('''SELECT FinishCards.CardID, Collections.Quantity FROM Collections
+                              INNER JOIN FinishCards ON Collections.FinishCardID = FinishCards.ID
+                              INNER JOIN Users ON Collections.UserID = Users.ID
+                              WHERE Users.Username = %s''', (USERNAME,))
+            return {str(scryfall_id): quantity for scryfall_id, quantity in res.fetchall()}
+
+    def assertChanges(self, results: list, expected: list):
+        for result in results:
+            self.assertTrue(result['successful'], result)
+        self.assertEqual([(result['delta'], result['new_total']) for result in results], expected)
+
+    # Operations on the same key see the ones before them in the batch
+    def test_ordering(self):
+        response = self.batch([
+            self.operation('add', self.first_id, 3),
+            self.operation('remove', self.first_id, 1),
+            self.operation('set', self.first_id, 5),
+            self.operation('add', self.first_id, 2),
+            self.operation('remove', self.first_id, 10),
+            self.operation('add', self.first_id, 4),
+            self.operation('add', self.second_id, 2)
+        ])
+        self.assertTrue(response['successful'], response)
+        self.assertChanges(response['results'], [(3, 3), (-1, 2), (3, 5), (2, 7), (-7, 0), (4, 4), (2, 2)])
+        self.assertEqual(self.get_quantities(), {self.first_id: 4, self.second_id: 2})
+
+        # And the ones in earlier batches
+        response = self.batch([
+            self.operation('set', self.second_id, 1),
+            self.operation('add', self.second_id, 1),
+            self.operation('add', self.first_id, 1)
+        ])
+        self.assertTrue(response['successful'], response)
+        self.assertChanges(response['results'], [(-1, 1), (1, 2), (1, 5)])
+        self.assertEqual(self.get_quantities(), {self.first_id: 5, self.second_id: 2})
+
+    def test_remove_below_zero(self):
+        self.assertTrue(self.batch([self.operation('add', self.first_id, 2)])['successful'])
+
+        response = self.batch([
+            self.operation('remove', self.first_id, 5),
+            self.operation('remove', self.second_id, 1)
+        ])
+        self.assertTrue(response['successful'], response)
+        # Clamped at zero, and the row is deleted rather than left at zero
+        self.assertChanges(response['results'], [(-2, 0), (0, 0)])
+        self.assertEqual(self.get_quantities(), {})
+
+        response = self.batch([self.operation('set', self.first_id, 0)])
+        self.assertChanges(response['results'], [(0, 0)])
+        self.assertEqual(self.get_quantities(), {})
+
+    # Bad operations get an error and the rest are still applied
+    def test_invalid_operations(self):
+        missing_finish = self.operation('add', self.first_id, 1)
+        del missing_finish['finish']
+
+        operations = [
+            self.operation('add', self.first_id, 1),
+            self.operation('add', 'not-a-uuid', 1),
+            self.operation('add', str(uuid.uuid4()), 1),
+            self.operation('add', self.first_id, 1, finish='not-a-finish'),
+            self.operation('add', self.first_id, '1'),
+            self.operation('add', self.first_id, True),
+            self.operation('add', self.first_id, -1),
+            self.operation('add', self.first_id, 1, signed='no'),
+            self.operation('add', self.first_id, 1, condition='Mint'),
+            self.operation('double', self.first_id, 1),
+            missing_finish,
+            5,
+            self.operation('add', self.first_id, 2)
+        ]
+        response = self.batch(operations)
+        self.assertTrue(response['successful'], response)
+
+        results = response['results']
+        self.assertEqual(len(results), len(operations))
+        self.assertTrue(results[0]['successful'], results[0])
+        self.assertTrue(results[-1]['successful'], results[-1])
+        for result in results[1:-1]:
+            self.assertFalse(result['successful'], result)
+            self.assertIn('error', result)
+
+        self.assertEqual((results[-1]['delta'], results[-1]['new_total']), (2, 3))
+        self.assertEqual(self.get_quantities(), {self.first_id: 3})
+
+    def test_max_operations(self):
+        max_operations = int(config.get('MAX_BATCH_OPERATIONS'))
+
+        response = self.batch([self.operation('add', self.first_id, 1)] * (max_operations + 1))
+        self.assertFalse(response['successful'])
+        self.assertEqual(self.get_quantities(), {})
+
+        response = self.batch([self.operation('add', self.first_id, 1)] * max_operations)
+        self.assertTrue(response['successful'], response)
+        self.assertEqual(len(response['results']), max_operations)
+        self.assertEqual(self.get_quantities(), {self.first_id: max_operations})
+
+    # Batches and single adds at the same time, for cards that aren't in the collection yet, all have to be counted
+    def test_concurrent_batches(self):
+        num_requests = 20
+        single_body = {
+            'scryfall_id': self.first_id,
+            'quantity': 1,
+            'finish': 'nonfoil',
+            'condition': 'Near Mint',
+            'signed': False,
+            'altered': False,
+            'notes': '',
+            'username': USERNAME
+        }
+
+        def send(index):
+            if index % 2 == 0:
+                return self.batch([self.operation('add', self.first_id, 1), self.operation('add', self.second_id, 1)])
+            return requests.post(self.get_server_url() + '/api/collection', json=single_body, cookies=self.session.cookies).json()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(send, range(num_requests * 2)))
+
+        for result in results:
+            self.assertTrue(result['successful'], result)
+
+        self.assertEqual(self.get_quantities(), {self.first_id: num_requests * 2, self.second_id: num_requests})
+
+class TokenTests(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        delete_dynamic_data()
+
+    def setUp(self):
+        self.session = requests.Session()
+        response = self.session.post(self.get_server_url() + SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 200)
+
+        with get_database_connection() as con:
+            self.user_id = con.execute('SELECT ID FROM Users WHERE Username = %s', (USERNAME,)).fetchone()[0]
+
+    def tearDown(self):
+        main.api_token_cache.clear()
+        delete_dynamic_data()
+
+    def create_app(self):
+
+        app = main.app
+        app.config['TESTING'] = True
+        # Default port is 5000
+        app.config['LIVESERVER_PORT'] = 8943
+        # Default timeout is 5 seconds
+        app.config['LIVESERVER_TIMEOUT'] = 10
+        return app
+
+    def generate_token(self, valid_until: str | None = None) -> str:
+        response = self.session.post(self.get_server_url() + '/generate_token', json={'valid_until': valid_until}).json()
+        self.assertTrue(response['successful'], response)
+        return response['token']
+
+    def get_collection(self, token: str) -> dict:
+        return requests.get(self.get_server_url() + f'/api/collection?username={USERNAME}', headers={'Authorization': f'Bearer {token}'}).json()
+
+    # The live server runs in another process, so this process has its own token cache like another worker would
+    def get_user_id_from_token(self, token: str) -> tuple[int, None] | tuple[None, dict]:
+        with main.get_database_connection() as con:
+            return main.get_user_id_from_token(con.cursor(), token)
+
+    def test_cached_token_expires(self):
+        token = self.generate_token()
+        hashed_token_bytes = main.hash_token(bytes.fromhex(token))
+
+        user_id, error = self.get_user_id_from_token(token)
+        self.assertEqual(error, None)
+        self.assertEqual(user_id, self.user_id)
+
+        # As if ValidUntil passed while the token was cached
+        main.api_token_cache.put(hashed_token_bytes, (self.user_id, datetime.now().astimezone() - timedelta(seconds=1)))
+        hits = main.api_token_cache.hits
+
+        user_id, error = self.get_user_id_from_token(token)
+        self.assertEqual(main.api_token_cache.hits, hits + 1)
+        self.assertEqual(user_id, None)
+        self.assertEqual(error['error'], 'That token has expired')
+
+    def test_revoked_token_rejected(self):
+        token = self.generate_token()
+
+        # Cached by the server and by us
+        self.assertTrue(self.get_collection(token)['successful'])
+        self.assertEqual(self.get_user_id_from_token(token), (self.user_id, None))
+
+        response = self.session.delete(self.get_server_url() + '/api/token', json={'token': token}).json()
+        self.assertTrue(response['successful'], response)
+
+        # The worker that revoked it stops accepting it right away
+        response = self.get_collection(token)
+        self.assertFalse(response['successful'])
+        self.assertEqual(response['error'], 'Token is invalid')
+
+        # Other workers do once they next check the generation
+        cache.token_generation.expire()
+        user_id, error = self.get_user_id_from_token(token)
+        self.assertEqual(user_id, None)
+        self.assertEqual(error['error'], 'Token is invalid')
+
+    def test_invalid_token_not_cached(self):
+        main.api_token_cache.clear()
+
+        for _ in range(10):
+            user_id, error = self.get_user_id_from_token(uuid.uuid4().hex)
+            self.assertEqual(user_id, None)
+            self.assertEqual(error['error'], 'Token is invalid')
+
+        self.assertEqual(main.api_token_cache.get_stats()['size'], 0)
+
+    def test_sweep_expired_tokens(self):
+        now = datetime.now().astimezone()
+        tokens = {
+            b'expired': now - timedelta(days=1),
+            b'valid': now + timedelta(days=1),
+            b'forever': None
+        }
+
+        with get_database_connection() as con:
+            cur = con.cursor()
+            for token_hash, valid_until in tokens.items():
+                cur.execute('INSERT INTO APITokens (UserID, TokenHash, ValidUntil) VALUES (%s, %s, %s)', (self.user_id, token_hash, valid_until))
+
+            main.sweep_expired_tokens(cur)
+
+            res = cur.execute('SELECT TokenHash FROM APITokens WHERE UserID = %s', (self.user_id,))
+            self.assertEqual(sorted(bytes(row[0]) for row in res.fetchall()), [b'forever', b'valid'])
+
+class ScryfallSearchTests(unittest.TestCase):
+    def test_terms_are_anded(self):
+        where, params = search.compile_query('t:creature cmc<=3')
+        self.assertEqual(where, '(LOWER(Cards.TypeLine) LIKE %s) AND (Cards.Cmc <= %s)')
+        self.assertEqual(params, ['%creature%', 3.0])
+
+    def test_or_and_negation(self):
+        where, params = search.compile_query('-t:land (bolt or "shock")')
+        self.assertEqual(where, '(NOT (LOWER(Cards.TypeLine) LIKE %s)) AND ((LOWER(Cards.Name) LIKE %s) OR (LOWER(Cards.Name) LIKE %s))')
+        self.assertEqual(params, ['%land%', '%bolt%', '%shock%'])
+
+    def test_values_are_parameters(self):
+        # Nothing the user types should end up in the SQL itself
+        where, params = search.compile_query('o:"\'; DROP TABLE Cards; --" set:stx')
+        self.assertNotIn('DROP', where)
+        self.assertIn("%'; drop table cards; --%", params)
+
+    def test_like_wildcards_are_escaped(self):
+        _, params = search.compile_query('50%_off')
+        self.assertEqual(params, ['%50\\%\\_off%'])
+
+    def test_errors(self):
+        for text in ['t:', 'x:1', 'cmc<=a', '(t:goblin', 't:goblin)', 'o:"draw', 'c:q', 'f:notaformat', 'or']:
+            with self.assertRaises(search.QuerySyntaxError, msg=text):
+                search.compile_query(text)
+
+class PaginationTests(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        card_id = uuid.uuid4()
+        cursor = pagination.encode_cursor('Lightning Bolt', date(2021, 6, 18), card_id)
+        self.assertEqual(pagination.decode_cursor(cursor, uuid.UUID),
+                         {'after_name': 'Lightning Bolt', 'after_released_at': date(2021, 6, 18), 'after_id': card_id})
+
+    def test_invalid_cursors(self):
+        card_cursor = pagination.encode_cursor('Lightning Bolt', date(2021, 6, 18), uuid.uuid4())
+        for cursor, id_type in [('', int), ('not a cursor', int), ('WzFd', int), (card_cursor, int)]:
+            with self.assertRaises(pagination.InvalidCursorError, msg=cursor):
+                pagination.decode_cursor(cursor, id_type)
+
+    # Following next_cursor should give the same cards as asking for each page by number.
+    # Needs the card data in the database
+    def test_cursor_pages_match_numbered_pages(self):
+        for default in [False, True]:
+            numbered = []
+            for page in range(3):
+                numbered += json.loads(main.api_all_cards_search('goblin', page, default))['cards']
+
+            response = json.loads(main.api_all_cards_search('goblin', 0, default))
+            followed = response['cards']
+            while len(followed) < len(numbered) and response['next_cursor'] != None:
+                response = json.loads(main.api_all_cards_search('goblin', 0, default, response['next_cursor']))
+                self.assertNotIn('length', response)
+                followed += response['cards']
+
+            self.assertEqual(followed, numbered, f"default={default}")
+
+class CacheTests(unittest.TestCase):
+    def test_lru_eviction(self):
+        lru = cache.LRUCache('test_lru', 2, catalog=False)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        # Makes b the least recently used
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+        # Putting an existing key doesn't evict anything
+        lru.put('a', 4)
+        self.assertEqual(lru.get('a'), 4)
+
+        self.assertEqual(lru.get_stats(), {'size': 2, 'max_size': 2, 'hits': 4, 'misses': 1, 'evictions': 1})
+
+    def test_ttl(self):
+        lru = cache.LRUCache('test_ttl', 10, ttl=0.1, catalog=False)
+        lru.put('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+
+        time.sleep(0.2)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.get_stats()['size'], 0)
+        self.assertEqual(lru.get_stats()['misses'], 1)
+
+    def test_new_catalog_generation_clears_catalog_caches(self):
+        catalog_cache = cache.LRUCache('test_catalog', 10)
+        other_cache = cache.LRUCache('test_not_catalog', 10, catalog=False)
+
+        with main.get_database_connection() as con:
+            cur = con.cursor()
+            cache.catalog_generation.expire()
+            cache.check_catalog_generation(cur)
+
+            catalog_cache.put('a', 1)
+            other_cache.put('a', 1)
+
+            # Nothing changed, so nothing is cleared
+            cache.catalog_generation.expire()
+            cache.check_catalog_generation(cur)
+            self.assertEqual(catalog_cache.get('a'), 1)
+
+            # What an import does
+            cur.execute('UPDATE CatalogGeneration SET Generation = Generation + 1')
+            con.commit()
+
+            # Until the next check the old generation is still trusted
+            cache.check_catalog_generation(cur)
+            self.assertEqual(catalog_cache.get('a'), 1)
+
+            cache.catalog_generation.expire()
+            cache.check_catalog_generation(cur)
+            self.assertEqual(catalog_cache.get('a'), None)
+            self.assertEqual(other_cache.get('a'), 1)
+
+    # asgi.py takes the same lock on the event loop, so it can't be held while waiting on the database
+    def test_generation_check_releases_lock(self):
+        generation = cache.Generation('TokenGeneration', 'tokens', 'API_TOKEN_REVOCATION_CHECK_INTERVAL')
+        locked = []
+
+        class Cursor:
+            def execute(self, query):
+                locked.append(generation._lock.locked())
+                return self
+
+            def fetchone(self):
+                return (7,)
+
+        self.assertEqual(generation.check(Cursor()), 7)
+        self.assertEqual(locked, [False])
+
+        # Trusted until the interval runs out
+        self.assertEqual(generation.check(Cursor()), 7)
+        self.assertEqual(locked, [False])
+
+    def test_cached_cards_match_database(self):
+        with main.get_database_connection() as con:
+            cur = con.cursor()
+            res = cur.execute('SELECT ID FROM Cards LIMIT 20')
+            scryfall_ids = [str(row[0]) for row in res.fetchall()]
+
+            main.card_cache.clear()
+            cards, not_found = main.get_cards(cur, scryfall_ids)
+            self.assertEqual(not_found, [])
+
+            parsed_ids, cards_by_id, uncached_ids = main.get_cached_cards(scryfall_ids)
+            self.assertEqual(uncached_ids, [])
+            cached_cards, cached_not_found = main.order_cards(scryfall_ids, parsed_ids, cards_by_id)
+
+            self.assertEqual([vars(card) for card in cached_cards], [vars(card) for card in cards])
+            self.assertEqual(cached_not_found, [])
+
+            # And the same as loading them again
+            main.card_cache.clear()
+            loaded_cards, _ = main.get_cards(cur, scryfall_ids)
+            self.assertEqual([vars(card) for card in loaded_cards], [vars(card) for card in cards])
+
+class CardsManyTests(unittest.TestCase):
+    def setUp(self):
+        with get_database_connection() as con:
+            res = con.execute('SELECT ID FROM Cards LIMIT 3')
+            self.scryfall_ids = [str(row[0]) for row in res.fetchall()]
+
+    def get_cards(self, scryfall_ids: list) -> tuple[list[main.Card], list]:
+        with main.get_database_connection() as con:
+            return main.get_cards(con.cursor(), scryfall_ids)
+
+    def assertCardIds(self, cards: list[main.Card], scryfall_ids: list[str]):
+        self.assertEqual([card.scryfall_id for card in cards], scryfall_ids)
+
+    def test_order_is_kept(self):
+        for scryfall_ids in [self.scryfall_ids, self.scryfall_ids[::-1]]:
+            # Once from the database and once from the cache
+            for _ in range(2):
+                cards, not_found = self.get_cards(scryfall_ids)
+                self.assertCardIds(cards, scryfall_ids)
+                self.assertEqual(not_found, [])
+
+    def test_duplicates(self):
+        first, second, _ = self.scryfall_ids
+        scryfall_ids = [first, second, first, first]
+
+        main.card_cache.clear()
+        cards, not_found = self.get_cards(scryfall_ids)
+        self.assertCardIds(cards, scryfall_ids)
+        self.assertEqual(not_found, [])
+
+    def test_unknown_ids(self):
+        first, second, _ = self.scryfall_ids
+        unknown = str(uuid.uuid4())
+        scryfall_ids = [first, unknown, 'not-a-uuid', second, unknown]
+
+        cards, not_found = self.get_cards(scryfall_ids)
+        self.assertCardIds(cards, [first, second])
+        self.assertEqual(not_found, [unknown, 'not-a-uuid', unknown])
+
+    def test_many_route(self):
+        first, second, third = self.scryfall_ids
+        unknown = str(uuid.uuid4())
+        scryfall_ids = [third, unknown, first, third, 'not-a-uuid', second]
+
+        response = main.app.test_client().post('/api/all_cards/many', json={'scryfall_ids': scryfall_ids})
+        self.assertEqual(response.status_code, 200)
+        response_json = response.get_json()
+
+        cards, _ = self.get_cards([third, first, third, second])
+        self.assertEqual(response_json['data'], [card.get_dict() for card in cards])
+        self.assertEqual(response_json['not_found'], [unknown, 'not-a-uuid'])
+
+class DimensionCacheTests(unittest.TestCase):
+    def test_maps_match_tables(self):
+        with main.get_database_connection() as con:
+            cur = con.cursor()
+            dimension_maps = cache.load_dimension_maps(cur)
+
+            for table, column in cache.DIMENSION_TABLES.items():
+                res = cur.execute(f'SELECT {column}, ID FROM {table}')
+                self.assertEqual(dimension_maps[table], dict(res.fetchall()), table)
+
+            for table in ['Finishes', 'Langs']:
+                self.assertGreater(len(dimension_maps[table]), 0, table)
+                for name, id_ in dimension_maps[table].items():
+                    self.assertEqual(main.dimensions.get_id(cur, table, name), id_)
+
+    def test_loaded_once_per_generation(self):
+        with main.get_database_connection() as con:
+            cur = con.cursor()
+            main.dimensions.get_id(cur, 'Finishes', 'nonfoil')
+            loads = main.dimensions.loads
+
+            for _ in range(10):
+                main.dimensions.get_id(cur, 'Finishes', 'foil')
+            self.assertEqual(main.dimensions.loads, loads)
+
+            cur.execute('UPDATE CatalogGeneration SET Generation = Generation + 1')
+            con.commit()
+            cache.catalog_generation.expire()
+
+            self.assertNotEqual(main.dimensions.get_id(cur, 'Finishes', 'nonfoil'), None)
+            self.assertEqual(main.dimensions.loads, loads + 1)
+
+    def test_unknown_names_rejected(self):
+        with main.get_database_connection() as con:
+            cur = con.cursor()
+            scryfall_id = cur.execute('SELECT ID FROM Cards LIMIT 1').fetchone()[0]
+
+            self.assertEqual(main.dimensions.get_id(cur, 'Finishes', 'not-a-finish'), None)
+            error, finish_card_id = main.get_finish_card_id(cur, 'not-a-finish', scryfall_id)
+            self.assertEqual(finish_card_id, None)
+            self.assertEqual(error, {'successful': False, 'error': 'No such finish not-a-finish'})
+
+            scryfall_id, error = main.get_other_language_id(cur, scryfall_id, 'not-a-lang')
+            self.assertEqual(scryfall_id, None)
+            self.assertEqual(error, {'successful': False, 'error': "Couldn't find lang \"not-a-lang\""})
+
+class CatalogETagTests(unittest.TestCase):
+    def setUp(self):
+        self.client = main.app.test_client()
+
+        with get_database_connection() as con:
+            res = con.execute('SELECT ID FROM Cards LIMIT 2')
+            self.scryfall_ids = [str(row[0]) for row in res.fetchall()]
+
+    def test_not_modified(self):
+        response = self.client.get('/api/all_cards?query=search&text=bolt')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        cache_control = response.headers['Cache-Control']
+        self.assertIn('max-age', cache_control)
+
+        response = self.client.get('/api/all_cards?query=search&text=bolt', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Cache-Control'], cache_control)
+
+    def test_arg_order_keeps_etag(self):
+        first = self.client.get('/api/all_cards?query=search&text=bolt&page=0')
+        second = self.client.get('/api/all_cards?page=0&text=bolt&query=search')
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+
+        other = self.client.get('/api/all_cards?query=search&text=shock&page=0')
+        self.assertNotEqual(first.headers['ETag'], other.headers['ETag'])
+
+    def test_body_changes_etag(self):
+        for path in ['/api/all_cards/many', '/api/all_cards/languages/many']:
+            first = self.client.post(path, json={'scryfall_ids': self.scryfall_ids[:1]})
+            second = self.client.post(path, json={'scryfall_ids': self.scryfall_ids})
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(second.status_code, 200)
+            self.assertNotEqual(first.headers['ETag'], second.headers['ETag'], path)
+
+            # The old ETag doesn't match the new body
+            response = self.client.post(path, json={'scryfall_ids': self.scryfall_ids}, headers={'If-None-Match': first.headers['ETag']})
+            self.assertEqual(response.status_code, 200, path)
+
+    def test_new_generation_changes_etag(self):
+        cache.catalog_generation.expire()
+        response = self.client.get('/api/all_cards?query=search&text=bolt')
+        etag = response.headers['ETag']
+
+        with get_database_connection() as con:
+            con.execute('UPDATE CatalogGeneration SET Generation = Generation + 1')
+            con.commit()
+        cache.catalog_generation.expire()
+
+        response = self.client.get('/api/all_cards?query=search&text=bolt', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+class AssetTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.manifest = assets.AssetManifest(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+
+    def test_asset_url(self):
+        url = self.manifest.url('js/collection.js')
+        self.assertRegex(url, r'^/static/js/collection\.[0-9a-f]{12}\.js$')
+        self.assertIs(self.manifest.get(url[len('/static/'):]), self.manifest.get('js/collection.js'))
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(self.manifest.url('js/no_such_file.js'), '/static/js/no_such_file.js')
+
+    def test_imports_are_fingerprinted(self):
+        asset = self.manifest.get('js/collection.js')
+        imports = [match.group(3) for match in assets.JS_IMPORT_RE.finditer(asset.content.decode())]
+        self.assertIn(f"./{os.path.basename(self.manifest.get('js/paged_cards.js').fingerprinted_path)}", imports)
+
+        for import_path in imports:
+            target = os.path.normpath(os.path.join('js', import_path))
+            imported = self.manifest.get(target)
+            self.assertNotEqual(imported, None, import_path)
+            self.assertEqual(imported.fingerprinted_path, target)
+
+    def test_served_encodings(self):
+        client = main.app.test_client()
+        asset = main.asset_manifest.get('js/collection.js')
+
+        expected_encodings = [('gzip', 'gzip', gzip.decompress), ('identity', None, None)]
+        if assets.brotli != None:
+            expected_encodings.insert(0, ('br, gzip', 'br', assets.brotli.decompress))
+
+        etags = set()
+        for path in [asset.fingerprinted_path, asset.path]:
+            for accept_encoding, encoding, decompress in expected_encodings:
+                response = client.get(f'/static/{path}', headers={'Accept-Encoding': accept_encoding})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers.get('Content-Encoding'), encoding)
+                self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+                if path == asset.fingerprinted_path:
+                    self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+                else:
+                    self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+                body = response.get_data()
+                self.assertEqual(body if decompress == None else decompress(body), asset.content)
+                etags.add(response.headers['ETag'])
+
+                response = client.get(f'/static/{path}', headers={'Accept-Encoding': accept_encoding, 'If-None-Match': response.headers['ETag']})
+                self.assertEqual(response.status_code, 304)
+
+        # One per encoding, the same for both paths
+        self.assertEqual(len(etags), len(expected_encodings))
+
+        self.assertEqual(client.get('/static/js/no_such_file.js').status_code, 404)
+
+class EncoderTests(unittest.TestCase):
+    OBJ = {
+        'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'released_at': date(2024, 1, 2),
+        'heartbeat_at': datetime(2024, 1, 2, 3, 4, 5, 6789, tzinfo=timezone.utc),
+        'name': 'Lim-Dûl’s Vault "Ω"\n',
+        'quantity': -3,
+        'signed': True,
+        'notes': None,
+        'finishes': ['nonfoil', 'foil'],
+        'image_uris': {},
+        'faces': []
+    }
+
+    def test_conversions(self):
+        decoded = json.loads(encoder.dumps(self.OBJ))
+        self.assertEqual(decoded['id'], '12345678-1234-5678-1234-567812345678')
+        self.assertEqual(decoded['released_at'], '2024-01-02')
+        self.assertEqual(decoded['heartbeat_at'], '2024-01-02T03:04:05.006789+00:00')
+        self.assertEqual(decoded['name'], self.OBJ['name'])
+
+        with self.assertRaises(TypeError):
+            encoder._dumps_json({'set': {1, 2}})
+
+    @unittest.skipIf(encoder.orjson == None, "orjson isn't installed")
+    def test_orjson_matches_json(self):
+        for obj in [self.OBJ, [self.OBJ, self.OBJ], {'cards': [], 'length': 0, 'next_cursor': None}, 'text', 1, None]:
+            self.assertEqual(encoder._dumps_orjson(obj), encoder._dumps_json(obj))
+
+    def test_stream_array(self):
+        for length in [0, 1, 2, encoder.STREAM_CHUNK_SIZE // 100]:
+            items = [dict(self.OBJ, quantity=index) for index in range(length)]
+            chunks = list(encoder.stream_array(iter(items)))
+            self.assertEqual(b''.join(chunks), encoder.dumps(items))
+
+            if length == encoder.STREAM_CHUNK_SIZE // 100:
+                self.assertGreater(len(chunks), 1)
+
+class CollectionStreamTests(unittest.TestCase):
+    def setUp(self):
+        delete_dynamic_data()
+
+        self.client = main.app.test_client()
+        response = self.client.post(SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+        with get_database_connection() as con:
+            res = con.execute('''SELECT FinishCards.CardID FROM FinishCards
+                              INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
+                              WHERE Finishes.Finish = 'nonfoil'
+                              LIMIT %s''', (main.PAGE_SIZE * 2 + 3,))
+            scryfall_ids = [str(row[0]) for row in res.fetchall()]
+
+        operations = [{
+            'op': 'add',
+            'scryfall_id': scryfall_id,
+            'quantity': 1,
+            'finish': 'nonfoil',
+            'condition': 'Near Mint',
+            'signed': False,
+            'altered': False,
+            'notes': ''
+        } for scryfall_id in scryfall_ids]
+        response = self.client.post('/api/collection/batch', json={'username': USERNAME, 'operations': operations}).get_json()
+        self.assertTrue(response['successful'], response)
+
+    def tearDown(self):
+        delete_dynamic_data()
+
+    def test_stream_matches_pages(self):
+        cards = []
+        page = 0
+        while True:
+            response = self.client.get(f'/api/collection?username={USERNAME}&query=search&text=&page={page}').get_json()
+            self.assertTrue(response['successful'], response)
+            if len(response['cards']) == 0:
+                break
+            cards += response['cards']
+            page += 1
+
+        self.assertEqual(len(cards), main.PAGE_SIZE * 2 + 3)
+
+        response = self.client.get(f'/api/collection?username={USERNAME}&query=search&text=&stream=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.get_data()), cards)
+
+class CollectionSearchTests(unittest.TestCase):
+    MATCHING = main.PAGE_SIZE + 5
+
+    def setUp(self):
+        delete_dynamic_data()
+
+        self.client = main.app.test_client()
+        response = self.client.post(SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+        with get_database_connection() as con:
+            query = '''SELECT FinishCards.CardID FROM FinishCards
+                    INNER JOIN Finishes ON FinishCards.FinishID = Finishes.ID
+                    INNER JOIN Cards ON FinishCards.CardID = Cards.ID
+                    WHERE Finishes.Finish = 'nonfoil' AND (STRPOS(LOWER(Cards.Name), 'goblin') > 0) = %s
+                    LIMIT %s'''
+            self.matching_ids = [str(row[0]) for row in con.execute(query, (True, self.MATCHING)).fetchall()]
+            other_ids = [str(row[0]) for row in con.execute(query, (False, 10)).fetchall()]
+        self.assertEqual(len(self.matching_ids), self.MATCHING)
+
+        operations = [{
+            'op': 'add',
+            'scryfall_id': scryfall_id,
+            'quantity': 1,
+            'finish': 'nonfoil',
+            'condition': 'Near Mint',
+            'signed': False,
+            'altered': False,
+            'notes': ''
+        } for scryfall_id in self.matching_ids + other_ids]
+        response = self.client.post('/api/collection/batch', json={'username': USERNAME, 'operations': operations}).get_json()
+        self.assertTrue(response['successful'], response)
+
+    def tearDown(self):
+        delete_dynamic_data()
+
+    def search(self, text: str, page: int | None = None, cursor: str | None = None) -> dict:
+        args = {'username': USERNAME, 'query': 'search', 'text': text}
+        if cursor != None:
+            args['cursor'] = cursor
+        else:
+            args['page'] = page
+        response = self.client.get('/api/collection', query_string=args).get_json()
+        self.assertTrue(response['successful'], response)
+        return response
+
+    def test_pages(self):
+        found = []
+        # Case doesn't matter
+        for page, expected in enumerate([main.PAGE_SIZE, self.MATCHING - main.PAGE_SIZE, 0]):
+            response = self.search('gOBLIN', page)
+            self.assertEqual(response['length'], self.MATCHING)
+            self.assertEqual(len(response['cards']), expected, page)
+            found += [card['scryfall_id'] for card in response['cards']]
+
+        # Every matching card once, and none of the others
+        self.assertEqual(sorted(found), sorted(self.matching_ids))
+
+        # Following next_cursor from the first page finds the same cards
+        response = self.search('Goblin', 0)
+        cursor_found = [card['scryfall_id'] for card in response['cards']]
+        while response['next_cursor'] != None:
+            response = self.search('Goblin', cursor=response['next_cursor'])
+            cursor_found += [card['scryfall_id'] for card in response['cards']]
+        self.assertEqual(cursor_found, found)
+
+    def test_no_matches(self):
+        # STRPOS doesn't treat % as a wildcard
+        for text in ['zzzz not a card zzzz', '%']:
+            response = self.search(text, 0)
+            self.assertEqual(response['length'], 0, text)
+            self.assertEqual(response['cards'], [], text)
+
+class SearchTextTests(unittest.TestCase):
+    def setUp(self):
+        delete_dynamic_data()
+
+        self.client = main.app.test_client()
+        response = self.client.post(SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+    def tearDown(self):
+        delete_dynamic_data()
+
+    # A missing text is an error, an empty one matches everything
+    def test_missing_text(self):
+        paths = [f'/api/all_cards?query={query}' for query in ['search', 'scryfall', 'fulltext']]
+        paths += [f'/api/collection?username={USERNAME}&query={query}' for query in ['search', 'fulltext']]
+
+        for path in paths:
+            response = self.client.get(path).get_json()
+            self.assertFalse(response['successful'], path)
+            self.assertIn('"text"', response['error'])
+
+            response = self.client.get(path + '&text=').get_json()
+            self.assertNotEqual(response.get('successful'), False, path)
+
+    def test_unknown_query(self):
+        for path in ['/api/all_cards?query=nonsense&text=bolt', f'/api/collection?username={USERNAME}&query=nonsense&text=bolt']:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertFalse(response.get_json()['successful'], path)
+            self.assertIn('Unsupported value for query parameter "query"', response.get_json()['error'])
+
+class AdminTests(unittest.TestCase):
+    PATHS = ['/api/admin/stats', '/api/admin/slow_queries', '/api/admin/jobs']
+
+    def setUp(self):
+        delete_dynamic_data()
+
+        self.client = main.app.test_client()
+        response = self.client.post(SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+        self.admin_usernames = config.config['ADMIN_USERNAMES']
+
+    def tearDown(self):
+        config.config['ADMIN_USERNAMES'] = self.admin_usernames
+        delete_dynamic_data()
+
+    def test_non_admin_rejected(self):
+        config.config['ADMIN_USERNAMES'] = 'someone_else'
+
+        for path in self.PATHS:
+            response = self.client.get(path).get_json()
+            self.assertFalse(response['successful'], path)
+            self.assertNotIn('queries', response)
+
+        # Nor without logging in at all
+        response = main.app.test_client().get('/api/admin/stats').get_json()
+        self.assertFalse(response['successful'])
+
+    def test_admin_stats(self):
+        config.config['ADMIN_USERNAMES'] = f'someone_else,{USERNAME}'
+
+        response = self.client.get('/api/admin/stats').get_json()
+        self.assertTrue(response['successful'], response)
+        self.assertIn('user_id_by_username', response['queries'])
+        self.assertIn('cards', response['caches'])
+        self.assertIn('pool', response)
+
+class RenderedPageTests(unittest.TestCase):
+    def setUp(self):
+        delete_dynamic_data()
+        main.rendered_page_cache.clear()
+
+    def tearDown(self):
+        delete_dynamic_data()
+
+    def test_footer_depends_on_login(self):
+        anonymous = main.app.test_client()
+        logged_in = main.app.test_client()
+        response = logged_in.post(SIGNUP_PATH, data={'username': USERNAME, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+        # Twice each so the second one comes from the cache
+        for _ in range(2):
+            body = anonymous.get('/login').get_data(as_text=True)
+            self.assertIn('id="login"', body)
+            self.assertNotIn('id="logout"', body)
+
+            body = logged_in.get('/login').get_data(as_text=True)
+            self.assertIn('id="logout"', body)
+            self.assertNotIn('id="login"', body)
+
+    def test_flashed_messages_not_cached(self):
+        client = main.app.test_client()
+        cached = client.get('/login').get_data()
+        size = main.rendered_page_cache.get_stats()['size']
+
+        # An empty username flashes a message and redirects back to the page
+        response = client.post('/login', data={'username': '', 'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+        flashed = client.get('/login').get_data()
+        self.assertIn(b'Must enter a username', flashed)
+        self.assertNotEqual(flashed, cached)
+        self.assertEqual(main.rendered_page_cache.get_stats()['size'], size)
+
+        # The message is only shown once, after that it's the cached page again
+        self.assertEqual(client.get('/login').get_data(), cached)
+
+    def test_cached_page_matches_render_template(self):
+        body = main.app.test_client().get('/login').get_data()
+        self.assertEqual(main.rendered_page_cache.get(('login.html', '/login', True)), body)
+
+        with main.app.test_request_context('/login'):
+            self.assertEqual(flask.render_template('login.html').encode(), body)
+
+class MetricsTests(unittest.TestCase):
+    def test_requests_are_counted(self):
+        client = main.app.test_client()
+        client.get('/api/all_cards?query=search&text=bolt')
+        client.get('/no/such/page')
+
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('umori_http_requests_total{method="GET",route="/api/all_cards",status="200"}', body)
+        self.assertIn('umori_http_requests_total{method="GET",route="unmatched",status="404"}', body)
+        self.assertIn('umori_http_request_db_queries_count{method="GET",route="/api/all_cards"}', body)
+        self.assertIn('umori_db_pool_size{pool="sync"}', body)
+
+class SlowQueryTests(unittest.TestCase):
+    def test_params_shape_hides_values(self):
+        shape = slow_queries.params_shape({'text': 'lightning', 'ids': [uuid.uuid4(), uuid.uuid4()], 'limit': 25})
+        self.assertEqual(shape, '{text: str of 9, ids: list[UUID] of 2, limit: int}')
+        self.assertNotIn('lightning', slow_queries.params_shape(('lightning', 25)))
+
+    def test_only_reads_are_explained(self):
+        sample_rate = slow_queries.EXPLAIN_SAMPLE_RATE
+        slow_queries.EXPLAIN_SAMPLE_RATE = 1
+        try:
+            self.assertTrue(slow_queries.should_explain('SELECT ID FROM Cards WHERE Name = %s'))
+            self.assertTrue(slow_queries.should_explain('WITH matches AS (SELECT 1) SELECT * FROM matches'))
+            for query in ['UPDATE Collections SET Quantity = 1', 'WITH gone AS (DELETE FROM Collections RETURNING ID) SELECT * FROM gone',
+                          'SELECT ID FROM Collections FOR UPDATE', 'INSERT INTO Users VALUES (1)']:
+                self.assertFalse(slow_queries.should_explain(query), query)
+        finally:
+            slow_queries.EXPLAIN_SAMPLE_RATE = sample_rate
+
+class LoggingTests(unittest.TestCase):
+    def access_record(self, status: int, duration_ms: float) -> logging.LogRecord:
+        record = logging.LogRecord('umori.access', logging.INFO, __file__, 0, 'GET / %s', (status,), None)
+        record.status = status
+        record.duration_ms = duration_ms
+        return record
+
+    def test_errors_and_slow_requests_are_never_sampled_out(self):
+        sampler = logs.AccessLogSampler(0, 1000)
+        self.assertFalse(sampler.filter(self.access_record(200, 5)))
+        self.assertTrue(sampler.filter(self.access_record(404, 5)))
+        self.assertTrue(sampler.filter(self.access_record(500, 5)))
+        self.assertTrue(sampler.filter(self.access_record(200, 1500)))
+
+    def test_request_ids(self):
+        self.assertEqual(logs.start_request('proxy-id.1'), 'proxy-id.1')
+        # Anything else could be used to inject into the logs
+        for header in [None, '', 'a' * 65, 'two words', 'line\nbreak']:
+            self.assertRegex(logs.start_request(header), '^[0-9a-f]{32}$')
+
+class MigrationTests(unittest.TestCase):
+    # Seconds a worker can take to import main, which is most of its startup
+    STARTUP_BUDGET = 10
+
+    def test_migrate_twice(self):
+        self.assertEqual(migrations.migrate(), migrations.LATEST_VERSION)
+        self.assertEqual(migrations.migrate(), migrations.LATEST_VERSION)
+
+        with get_database_connection() as con:
+            cur = con.cursor()
+            cur.execute('SELECT Version FROM SchemaVersion ORDER BY Version')
+            self.assertEqual([row[0] for row in cur.fetchall()], list(range(1, migrations.LATEST_VERSION + 1)))
+
+    def test_version_check_is_cheap(self):
+        migrations.check_version()
+        runs = 20
+        started_at = timeit.default_timer()
+        for _ in range(runs):
+            self.assertEqual(migrations.check_version(), migrations.LATEST_VERSION)
+        per_check = (timeit.default_timer() - started_at) / runs
+        self.assertLess(per_check, 0.05, f"schema version check took {per_check * 1000:.2f}ms")
+
+    # Holds the migration lock the whole time, so if a worker tried to migrate it would wait until the timeout
+    def test_worker_startup_does_not_migrate(self):
+        migrations.migrate()
+        with get_database_connection() as con:
+            con.execute('SELECT pg_advisory_lock(%s)', (migrations.MIGRATION_LOCK_ID,))
+            try:
+                started_at = timeit.default_timer()
+                result = subprocess.run([sys.executable, '-c', 'import main'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        capture_output=True, timeout=self.STARTUP_BUDGET * 3)
+                elapsed = timeit.default_timer() - started_at
+            finally:
+                con.execute('SELECT pg_advisory_unlock(%s)', (migrations.MIGRATION_LOCK_ID,))
+
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+        self.assertLess(elapsed, self.STARTUP_BUDGET, f"startup took {elapsed:.2f}s")
+
+class JobTests(unittest.TestCase):
+    KIND = 'test_job'
+    OTHER_KIND = 'other_test_job'
+    RUNNER = 'test-runner'
+
+    def setUp(self):
+        self.calls = 0
+        self.fail_times = 0
+        jobs.HANDLERS[self.KIND] = self.handler
+        jobs.HANDLERS[self.OTHER_KIND] = self.handler
+        self.retry_delay = jobs.RETRY_DELAY
+        jobs.RETRY_DELAY = 0
+        self.delete_jobs()
+
+    def tearDown(self):
+        del jobs.HANDLERS[self.KIND]
+        del jobs.HANDLERS[self.OTHER_KIND]
+        jobs.RETRY_DELAY = self.retry_delay
+        self.delete_jobs()
+
+    def delete_jobs(self):
+        with get_database_connection() as con:
+            con.execute('DELETE FROM Jobs WHERE Kind = ANY(%s)', ([self.KIND, self.OTHER_KIND],))
+
+    def handler(self, progress: jobs.Progress):
+        self.calls += 1
+        progress('testing', 5, 10)
+        if self.calls <= self.fail_times:
+            raise RuntimeError("Failing on purpose")
+
+    # Only our kinds, so we never take a real import someone queued
+    def run_one(self, runner: str = RUNNER) -> bool:
+        return jobs.run_one(runner, [self.KIND, self.OTHER_KIND])
+
+    def get_job(self, job_id: int) -> dict:
+        with get_database_connection() as con:
+            return next(job for job in jobs.get_jobs(con, 1000) if job['id'] == job_id)
+
+    def test_one_queued_job_per_kind(self):
+        job_id = jobs.enqueue(self.KIND)
+        self.assertNotEqual(job_id, None)
+        self.assertEqual(jobs.enqueue(self.KIND), None)
+
+        self.assertTrue(self.run_one())
+        self.assertNotEqual(jobs.enqueue(self.KIND), None)
+
+    def test_run_saves_progress(self):
+        job_id = jobs.enqueue(self.KIND)
+        self.assertTrue(self.run_one())
+        self.assertFalse(self.run_one())
+
+        job = self.get_job(job_id)
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['attempts'], 1)
+        self.assertEqual(job['progress'], 100)
+        self.assertEqual((job['stage'], job['items_done'], job['items_total']), ('testing', 5, 10))
+        self.assertEqual(job['leased_by'], self.RUNNER)
+
+    def test_failed_job_is_retried(self):
+        self.fail_times = 1
+        job_id = jobs.enqueue(self.KIND)
+
+        self.assertTrue(self.run_one())
+        job = self.get_job(job_id)
+        self.assertEqual(job['status'], 'queued')
+        self.assertIn("Failing on purpose", job['error'])
+
+        self.assertTrue(self.run_one())
+        job = self.get_job(job_id)
+        self.assertEqual((job['status'], job['attempts'], job['error']), ('succeeded', 2, None))
+
+    def test_failed_job_gives_up(self):
+        self.fail_times = 2
+        job_id = jobs.enqueue(self.KIND, max_attempts=2)
+        self.assertTrue(self.run_one())
+        self.assertTrue(self.run_one())
+        self.assertFalse(self.run_one())
+
+        job = self.get_job(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('failed', 2))
+        self.assertNotEqual(job['finished_at'], None)
+
+    def test_expired_lease_is_taken_over(self):
+        job_id = jobs.enqueue(self.KIND)
+        self.assertEqual(jobs.claim('dead-runner', [self.KIND])[0], job_id)
+        # Still leased
+        self.assertFalse(self.run_one())
+
+        with get_database_connection() as con:
+            con.execute("UPDATE Jobs SET LeaseExpiresAt = now() - INTERVAL '1 second' WHERE ID = %s", (job_id,))
+
+        self.assertTrue(self.run_one())
+        job = self.get_job(job_id)
+        self.assertEqual((job['status'], job['attempts'], job['leased_by']), ('succeeded', 2, self.RUNNER))
+
+    def test_claim_skips_locked_jobs(self):
+        locked_id = jobs.enqueue(self.KIND)
+        other_id = jobs.enqueue(self.OTHER_KIND)
+
+        # Like another runner in the middle of claiming it
+        with get_database_connection() as con:
+            con.execute('SELECT ID FROM Jobs WHERE ID = %s FOR UPDATE', (locked_id,))
+            claimed = jobs.claim(self.RUNNER, [self.KIND, self.OTHER_KIND])
+            self.assertEqual(claimed[0], other_id)
+            self.assertEqual(jobs.claim(self.RUNNER, [self.KIND, self.OTHER_KIND]), None)
+
+class PasswordTests(unittest.TestCase):
+    def test_verify(self):
+        password_hash = passwords.hash_password('correct horse')
+        self.assertEqual(passwords.verify_password(password_hash, 'correct horse'), (True, None))
+        self.assertEqual(passwords.verify_password(password_hash, 'battery staple'), (False, None))
+
+    def test_rehash_when_parameters_change(self):
+        old_hash = argon2.PasswordHasher(time_cost=1, memory_cost=8192, parallelism=1).hash('correct horse')
+        matches, new_hash = passwords.verify_password(old_hash, 'correct horse')
+        self.assertTrue(matches)
+        self.assertFalse(passwords.get_hasher().check_needs_rehash(new_hash))
+
+    def test_rejected_right_away_when_busy(self):
+        # Take every slot, like that many logins waiting on their hashes
+        _, pending = passwords.get_pool()
+        taken = 0
+        while pending.acquire(blocking=False):
+            taken += 1
+
+        try:
+            started_at = timeit.default_timer()
+            with self.assertRaises(passwords.Busy):
+                passwords.hash_password('correct horse')
+            self.assertLess(timeit.default_timer() - started_at, 0.05)
+        finally:
+            for _ in range(taken):
+                pending.release()
+
+# Makes sure the common scryfall search terms are answered from an index instead of reading whole tables.
+# Needs the card data in the database
+class QueryPlanTests(unittest.TestCase):
+    # A sequential scan (or an index scan without a condition) on one of these means a term isn't using its index
+    LARGE_TABLES = ['cards', 'faces', 'colorcards', 'coloridentitycards', 'keywordcards']
+
+    SEARCHES = [
+        'bolt',
+        't:goblin',
+        'o:"draw a card"',
+        'c:rg',
+        'id:wu',
+        'kw:flying',
+        'cmc<=3',
+        'cmc=7',
+        'set:stx',
+        't:goblin f:modern r:common',
+        't:creature c:rg cmc<=3 o:"draw a card" set:stx f:modern',
+        't:elf or t:goblin'
+    ]
+
+    def full_scans(self, plan: dict) -> list[str]:
+        scans = []
+        relation = plan.get('Relation Name', '').lower()
+        if relation in self.LARGE_TABLES:
+            if plan['Node Type'] == 'Seq Scan':
+                scans.append(f"Seq Scan on {relation}")
+            elif plan['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in plan:
+                scans.append(f"{plan['Node Type']} of all of {relation}")
+
+        for child in plan.get('Plans', []):
+            scans += self.full_scans(child)
+        return scans
+
+    def test_no_full_scans(self):
+        with get_database_connection() as con:
+            # Sequential scans are still allowed, they're just priced so high
+            # the planner only uses one when there's no index it can use instead
+            con.execute('SET enable_seqscan = off')
+            cur = psycopg.ClientCursor(con)
+
+            for text in self.SEARCHES:
+                for default in [False, True]:
+                    search_query, _, params = main.scryfall_search_queries(text, default)
+                    cur.execute('EXPLAIN (FORMAT JSON) ' + search_query, params + [main.PAGE_SIZE, 0])
+                    plan = cur.fetchone()[0][0]['Plan']
+                    self.assertEqual(self.full_scans(plan), [], f"{text} (default={default})")
+
+    def test_full_text_search_uses_index(self):
+        with get_database_connection() as con:
+            con.execute('SET enable_seqscan = off')
+            cur = psycopg.ClientCursor(con)
+
+            for text in ['draw a card', '"enters the battlefield" -creature', 'flying or reach']:
+                for default in [False, True]:
+                    search_query, _ = main.FULL_TEXT_SEARCH_QUERIES[default]
+                    cur.execute('EXPLAIN (FORMAT JSON) ' + search_query.sql, {'text': text, 'limit': main.PAGE_SIZE, 'offset': 0})
+                    plan = cur.fetchone()[0][0]['Plan']
+                    self.assertEqual(self.full_scans(plan), [], f"{text} (default={default})")
+
+    def test_keyset_uses_sort_index(self):
+        with get_database_connection() as con:
+            con.execute('SET enable_seqscan = off')
+            cur = psycopg.ClientCursor(con)
+
+            cursor = pagination.encode_cursor('Goblin Guide', date(2010, 2, 5), uuid.uuid4())
+            search_query, _, params = main.all_cards_search_queries('', False, 0, cursor)
+            cur.execute('EXPLAIN (FORMAT JSON) ' + search_query.sql, params)
+            plan = cur.fetchone()[0][0]['Plan']
+            self.assertIn('cardsnamereleasedatidindex', json.dumps(plan).lower())
+            self.assertEqual(self.full_scans(plan), [])
+
+    # Postgres considers a generic plan after a prepared statement's fifth execution,
+    # the all cards search has to keep being planned for its pattern
+    def test_all_cards_search_not_generic(self):
+        with get_database_connection() as con:
+            cur = con.cursor()
+
+            for text in ['', 'bolt']:
+                for default in [False, True]:
+                    search_query, count_query, params = main.all_cards_search_queries(text, default, 0)
+                    expected = psycopg.ClientCursor(con).execute(search_query.sql, params).fetchall()
+
+                    for _ in range(7):
+                        self.assertEqual(search_query.execute(cur, params).fetchall(), expected)
+                        count_query.execute(cur, params)
+
+            res = cur.execute("SELECT name, generic_plans FROM pg_prepared_statements WHERE position('LOWER(Name) LIKE' in statement) > 0")
+            self.assertEqual(res.fetchall(), [])
+
+    def test_languages_use_index(self):
+        with get_database_connection() as con:
+            con.execute('SET enable_seqscan = off')
+            cur = psycopg.ClientCursor(con)
+            scryfall_id = cur.execute('SELECT ID FROM Cards LIMIT 1').fetchone()[0]
+
+            for query, params in [(main.LANGUAGES_QUERY, (scryfall_id,)), (main.LANGUAGES_MANY_QUERY, ([scryfall_id],))]:
+                cur.execute('EXPLAIN (FORMAT JSON) ' + query.sql, params)
+                plan = cur.fetchone()[0][0]['Plan']
+                self.assertEqual(self.full_scans(plan), [], query.name)
+
 # Deletes data in the database that changes
 # (so basically everything but the cards)
 def delete_dynamic_data():
     with get_database_connection() as con:
         cur = con.cursor()
         cur.execute('DELETE FROM Collections')
+        cur.execute('DELETE FROM APITokens')
         cur.execute('DELETE FROM Users')
         con.commit()
 
@@ -27,4 +27,5 @@ else
     password="$POSTGRES_PASSWORD"
 fi
 
+DB_PASSWORD=$password python migrations.py
 DB_PASSWORD=$password python test.py